@@ -8,6 +8,7 @@ import distutils.core
 import cv2
 import numpy as np
 import argparse
+import multiprocessing
 import string
 import plantcv as pcv
 from datetime import datetime
@@ -109,221 +110,115 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
-def slice_stitch(sqlitedb, outdir, camera_label='vis_sv', spacer='on',makefig='yes'):
+### Genotype of a plant ID (the plant ID itself if it does not look like a barcode)
+def plant_genotype(plant_id):
+  plantgeno=re.match('^([A-Z][a-zA-Z]\d*[A-Z]{2})',plant_id)
+  if plantgeno==None:
+    return plant_id
+  span1,span2=plantgeno.span()
+  return plant_id[span1:span2]
+
+# Stitched images larger than this are built in a memory-mapped file next to the output image
+SLICE_MEMMAP_BYTES=512*1024*1024
+SLICE_ROWS=5
+SPACER_ROWS=10
+
+### Stitch the slices of one genotype into one image
+def stitch_slices(job):
+  # job = (output image file, list of slice image paths, list of day numbers, spacer)
+  # Every slice is repeated SLICE_ROWS times, a white spacer of SPACER_ROWS rows is added between days if spacer='on'
+  file_name, paths, days, spacer = job
+  days=np.asarray(days)
+  breaks=np.zeros(len(days), dtype=bool)
+  if spacer=='on':
+    breaks[1:]=days[1:]!=days[:-1]
+  # Output rows of each slice
+  starts=np.arange(len(days))*SLICE_ROWS+np.cumsum(breaks)*SPACER_ROWS
+  height=int(starts[-1])+SLICE_ROWS
+
+  first=cv2.imread(paths[0])
+  width=first.shape[0]*first.shape[1]
+  if height*width*3>SLICE_MEMMAP_BYTES:
+    stitched=np.memmap(file_name+'.tmp', dtype=np.uint8, mode='w+', shape=(height,width,3))
+  else:
+    stitched=np.empty((height,width,3), dtype=np.uint8)
+  # Spacers are white
+  stitched[:]=255
+  for i, path in enumerate(paths):
+    line=first if i==0 else cv2.imread(path)
+    stitched[starts[i]:starts[i]+SLICE_ROWS]=np.repeat(line.reshape(1,width,3), SLICE_ROWS, axis=0)
+  pcv.print_image(stitched,file_name)
+  if isinstance(stitched, np.memmap):
+    del stitched
+    os.remove(file_name+'.tmp')
+  return file_name
+
+### Y axis positions (last row of each day) and labels of a stitched image
+def slice_day_ticks(days, spacer):
+  unique_time, length_time=np.unique(days, return_counts=True)
+  ypos=length_time*SLICE_ROWS
+  if spacer=='on':
+    ypos[1:]+=SPACER_ROWS
+  return np.cumsum(ypos).tolist(), (unique_time+1).tolist()
+
+def slice_stitch(sqlitedb, outdir, camera_label='vis_sv', spacer='on',makefig='yes',processes=None):
   #sqlitedb = sqlite database to query (path to db)
   #outdir = path to outdirectory
   #camera_label = either 'vis_tv','vis_sv',or 'fluor_tv'
   #spacer = either 'on' or 'off', adds a white line between day breaks
   #makefig = either 'yes' or 'no', adds labels to days and a title
+  #processes = number of processes stitching genotypes in parallel (default: number of CPUs)
 
   i=datetime.now()
   timenow=i.strftime('%m-%d-%Y_%H:%M:%S')
   newfolder="slice_analysis_"+(str(timenow))
   
   os.mkdir((str(outdir)+newfolder))
+  folder_path=(str(outdir)+newfolder)
   
   connect=sq.connect(sqlitedb)
-  connect.row_factory = dict_factory
   connect.text_factory=str
-  c = connect.cursor()
-  h = connect.cursor()
-  m = connect.cursor()
-  k = connect.cursor()
-
-  id_array=[]
-  path_array=[]
-  unique_array=[]
   
-  for date in c.execute('select min(datetime) as first from snapshots'):
-    firstday=date['first']
+  firstday=connect.execute('select min(datetime) as first from snapshots').fetchone()[0]
   
-  for i, group in enumerate(m.execute('select * from snapshots inner join analysis_images on snapshots.image_id = analysis_images.image_id where type = "slice" order by plant_id asc')):
-    plant_id=group['plant_id']
-    plantgeno=re.match('^([A-Z][a-zA-Z]\d*[A-Z]{2})',plant_id)
-    if plantgeno==None:
-      plantgeno_id=group['plant_id']
-      id_array.append(plantgeno_id,)
-    else:
-      span1,span2=plantgeno.span()
-      plantgeno_id=group['plant_id'][span1:span2]
-      id_array.append(plantgeno_id,)
-  id_unique=np.unique(id_array)
+  # Genotypes of all plants with slices
+  id_unique=np.unique([plant_genotype(row[0]) for row in connect.execute('select distinct plant_id from snapshots inner join analysis_images on snapshots.image_id = analysis_images.image_id where type = "slice"')])
   
-  if spacer=='on':
-    for group_label in id_unique:
-      ch1=[]
-      ch2=[]
-      ch3=[]
-      time_array=[]
-      for i, data in enumerate(h.execute('select * from snapshots inner join analysis_images on snapshots.image_id = analysis_images.image_id where plant_id like ? and type = "slice" and camera=? order by datetime asc', ("%"+group_label+"%",camera_label,))):
-        date_int=((data['datetime']-firstday)/86400) 
-        time_array.append(date_int)
-      for i, data in enumerate(k.execute('select * from snapshots inner join analysis_images on snapshots.image_id = analysis_images.image_id where plant_id like ? and type = "slice" and camera=? order by datetime asc', ("%"+group_label+"%",camera_label,))): 
-        if i==0:
-          line1=cv2.imread(data['image_path'])
-          split1, split2, split3=np.dsplit(line1,3)
-          split1_f=split1.flatten()
-          split2_f=split2.flatten()
-          split3_f=split3.flatten()
-          
-          stacked_1=np.column_stack((split1_f,split1_f, split1_f, split1_f, split1_f))
-          stacked_2=np.column_stack((split2_f,split2_f, split2_f, split2_f, split2_f))
-          stacked_3=np.column_stack((split3_f,split3_f, split3_f, split3_f, split3_f)) 
-          stacked_1t=np.transpose(stacked_1)
-          stacked_2t=np.transpose(stacked_2)
-          stacked_3t=np.transpose(stacked_3)
-        
-          ch1.extend(stacked_1t)
-          ch2.extend(stacked_2t)
-          ch3.extend(stacked_3t)
-        elif time_array[i-1]==time_array[i]:
-          line1=cv2.imread(data['image_path'])
-          split1, split2, split3=np.dsplit(line1,3)
-          
-          split1_f=split1.flatten()
-          split2_f=split2.flatten()
-          split3_f=split3.flatten()
-          
-          stacked_1=np.column_stack((split1_f,split1_f, split1_f, split1_f, split1_f))
-          stacked_2=np.column_stack((split2_f,split2_f, split2_f, split2_f, split2_f))
-          stacked_3=np.column_stack((split3_f,split3_f, split3_f, split3_f, split3_f)) 
-          stacked_1t=np.transpose(stacked_1)
-          stacked_2t=np.transpose(stacked_2)
-          stacked_3t=np.transpose(stacked_3)
-        
-          ch1.extend(stacked_1t)
-          ch2.extend(stacked_2t)
-          ch3.extend(stacked_3t)
-        else:
-          line1=cv2.imread(data['image_path'])
-          split1, split2, split3=np.dsplit(line1,3)
-          
-          split1_f=split1.flatten()
-          split2_f=split2.flatten()
-          split3_f=split3.flatten()
-          
-          spacer_size=np.shape(split1_f)
-          spacer1=np.zeros(spacer_size)
-          spacer_f=spacer1+255
-          
-          stacked_1=np.column_stack((spacer_f, spacer_f, spacer_f, spacer_f, spacer_f,spacer_f, spacer_f, spacer_f, spacer_f, spacer_f))
-          stacked_2=np.column_stack((spacer_f, spacer_f, spacer_f, spacer_f, spacer_f,spacer_f, spacer_f, spacer_f, spacer_f, spacer_f))
-          stacked_3=np.column_stack((spacer_f, spacer_f, spacer_f, spacer_f, spacer_f,spacer_f, spacer_f, spacer_f, spacer_f, spacer_f)) 
-          stacked_1t=np.transpose(stacked_1)
-          stacked_2t=np.transpose(stacked_2)
-          stacked_3t=np.transpose(stacked_3)
-          
-          ch1.extend(stacked_1t)
-          ch2.extend(stacked_2t)
-          ch3.extend(stacked_3t)
-          
-          stacked_4=np.column_stack((split1_f,split1_f, split1_f, split1_f, split1_f))
-          stacked_5=np.column_stack((split2_f,split2_f, split2_f, split2_f, split2_f))
-          stacked_6=np.column_stack((split3_f,split3_f, split3_f, split3_f, split3_f)) 
-          stacked_4t=np.transpose(stacked_4)
-          stacked_5t=np.transpose(stacked_5)
-          stacked_6t=np.transpose(stacked_6)
-        
-          ch1.extend(stacked_4t)
-          ch2.extend(stacked_5t)
-          ch3.extend(stacked_6t)
-        
-      color_cat=np.dstack((ch1,ch2,ch3))
-      pcv.print_image(color_cat,(str(outdir)+str(newfolder)+"/"+str(group_label)+"_"+str(camera_label)+"_spacer_"+str(spacer)+"_slice_joined_img.png"))
-      
-  if spacer=='off':
-    for group_label in id_unique:
-      ch1=[]
-      ch2=[]
-      ch3=[]
-      for i, data in enumerate(h.execute('select * from snapshots inner join analysis_images on snapshots.image_id = analysis_images.image_id where plant_id like ? and type = "slice" and camera=? order by datetime asc', ("%"+group_label+"%",camera_label,))):
-        line1=cv2.imread(data['image_path'])
-        
-        split1, split2, split3=np.dsplit(line1,3)
-         
-        split1_f=split1.flatten()
-        split2_f=split2.flatten()
-        split3_f=split3.flatten()
-        
-        stacked_1=np.column_stack((split1_f,split1_f, split1_f, split1_f, split1_f))
-        stacked_2=np.column_stack((split2_f,split2_f, split2_f, split2_f, split2_f))
-        stacked_3=np.column_stack((split3_f,split3_f, split3_f, split3_f, split3_f)) 
-        stacked_1t=np.transpose(stacked_1)
-        stacked_2t=np.transpose(stacked_2)
-        stacked_3t=np.transpose(stacked_3)
-      
-        ch1.extend(stacked_1t)
-        ch2.extend(stacked_2t)
-        ch3.extend(stacked_3t)
-      
-      color_cat=np.dstack((ch1,ch2,ch3))
-      pcv.print_image(color_cat,(str(outdir)+newfolder+"/"+str(group_label)+"_"+str(camera_label)+"_spacer_"+str(spacer)+"_slice_joined_img.png"))
-  
-  folder_path=(str(outdir)+newfolder)
-      
-  if makefig=='yes':
-    list_files=os.listdir(folder_path)
-    sorted_list=sorted(list_files)
+  # All slices of the camera, in time order
+  slices=connect.execute('select plant_id, datetime, analysis_images.image_path from snapshots inner join analysis_images on snapshots.image_id = analysis_images.image_id where type = "slice" and camera=? order by datetime asc', (camera_label,)).fetchall()
+  connect.close()
   
-    for group_label in id_unique:
-      time_array=[]
-      length_time=[]
-      ypos=[]
-      ypos1=[]
-      ypos2=[]
-      unique_time1=[]
-      for i, data in enumerate(h.execute('select * from snapshots inner join analysis_images on snapshots.image_id = analysis_images.image_id where plant_id like ? and type = "slice" and camera=? order by datetime asc', ("%"+group_label+"%",camera_label,))):
-        date_int=((data['datetime']-firstday)/86400) 
-        time_array.append(date_int)
-    
-      unique_time=np.unique(time_array)
-      
-      for times in unique_time:
-        length=[]
-        for i,time in enumerate(time_array):
-          if time_array[i]==times:
-            tm=1
-            length.append(tm)
-          else:
-            tm=0
-            length.append(tm)
-        sum_time=np.sum(length)
-        length_time.append(sum_time) 
+  # A genotype gets the slices of every plant ID containing it (case-insensitive, as plant_id like '%genotype%')
+  groups=[]
+  for group_label in id_unique:
+    label=str(group_label).lower()
+    rows=[row for row in slices if label in row[0].lower()]
+    if rows:
+      days=[(row[1]-firstday)//86400 for row in rows]
+      groups.append((group_label, [row[2] for row in rows], days))
   
-      if spacer=='off':  
-        for i,length in enumerate(length_time):
-          if i==0:
-            yadd=length*5
-            ypos.append(yadd)
-          else:
-            yadd=(length*5)
-            ypos.append(yadd)
-      elif spacer=='on':
-        for i,length in enumerate(length_time):
-          if i==0:
-            yadd=length*5
-            ypos.append(yadd)
-          else:
-            yadd=(length*5)+10
-            ypos.append(yadd)
-            
-      for i,y in enumerate(ypos):
-        if i==0:
-          y1=y
-          ypos1.append(y1)
-        else:
-          y1=y+ypos1[i-1]
-          ypos1.append(y1)
+  if spacer in ('on','off') and groups:
+    jobs=[(str(folder_path)+"/"+str(group_label)+"_"+str(camera_label)+"_spacer_"+str(spacer)+"_slice_joined_img.png", paths, days, spacer) for group_label, paths, days in groups]
+    if processes is None:
+      processes=multiprocessing.cpu_count()
+    pool=multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+      pool.map(stitch_slices, jobs, chunksize=1)
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
       
-      for time in unique_time:
-        time1=time+1
-        unique_time1.append(time1)
+  if makefig=='yes':
+    for group_label, paths, days in groups:
+      ypos1, unique_time1=slice_day_ticks(days, spacer)
   
       file_name=str(group_label)+"_"+str(camera_label)+"_spacer_"+str(spacer)+"_slice_joined_img.png"
       img1=cv2.imread((str(folder_path)+"/"+str(file_name)), -1)
       if len(np.shape(img1))==3: 
-        ch1,ch2,ch3=np.dsplit(img1,3)
-        img=np.dstack((ch3,ch2,ch1))
+        img=img1[:,:,::-1]
         
         plt.imshow(img)
         ax = plt.subplot(111)
@@ -348,9 +243,3 @@ def slice_stitch(sqlitedb, outdir, camera_label='vis_sv', spacer='on',makefig='y
         plt.clf()
       
   return folder_path
-
-
-
-
-
-  
\ No newline at end of file
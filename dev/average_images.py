@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+# Averaged backgrounds and masks
+# Builds an average image (e.g. dev/gehan_brachy/nir_masks/nir-sv/*_avg_masks/average_NIR_SV_*.png) from any number
+# of frames. Frames are read by a pool of worker processes, each summing a chunk of frames, so memory stays at a few
+# accumulators no matter how many frames there are. The running sum (and, for medians, per-pixel histograms of the
+# 8-bit values) is kept in a state file next to the output, so new frames can be added later without reading the old
+# ones again.
+#
+# Usage:
+#   python average_images.py -i ori_images/brachy_drought_1500_h2/ -o average_NIR_SV_0_z1500_h2_g0_e65.png
+#   python average_images.py -i 'new_frames/*z1500*.png' -o average_NIR_SV_0_z1500_h2_g0_e65.png   (adds frames)
+#   python average_images.py -i frames.txt -o median.png -m -n 8
+# With -k/-z the result is also stored as a new version in the NIR background store (see background_store.py):
+#   python average_images.py -i empty_car/ -o bkgrd_ave_z500.png -k nir_sv -z z500 -r rot180
+
+import argparse
+import sys, os
+import tempfile
+import multiprocessing
+import cv2
+import numpy as np
+import plantcv as pcv
+from pipeline_batch import find_images, IMAGE_PATTERN
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Average (or median) image of many frames, updated incrementally.")
+  parser.add_argument("-i", "--input", help="Frames: directory, glob pattern or file with one path per line.",
+                      required=True)
+  parser.add_argument("-o", "--output", help="Output image file.", required=True)
+  parser.add_argument("-s", "--state", help="State file with the running sum. Default: <output>.state.npz",
+                      required=False)
+  parser.add_argument("-m", "--median", help="Per-pixel median instead of the mean (keeps 8-bit histograms).",
+                      action="store_true")
+  parser.add_argument("-n", "--processes", help="Number of processes reading frames. Default: number of CPUs.",
+                      type=int, default=multiprocessing.cpu_count())
+  parser.add_argument("-c", "--chunk", help="Frames summed by a process at a time.", type=int, default=64)
+  parser.add_argument("-x", "--pattern", help="Regular expression for image file names in a directory.",
+                      default=IMAGE_PATTERN)
+  parser.add_argument("-k", "--camera", help="Also store the result in the background store for this camera.",
+                      required=False)
+  parser.add_argument("-z", "--zoom", help="Zoom (setup) label for the background store.", required=False)
+  parser.add_argument("-r", "--orientation", help="Orientation of the stored background (see background_store.py).",
+                      default='none')
+  args = parser.parse_args()
+  if bool(args.camera) != bool(args.zoom):
+    parser.error("the background store needs both a camera (-k) and zoom (-z)")
+  return args
+
+class Accumulator(object):
+  # shape = frame shape
+  # median = True to keep per-pixel histograms of the 8-bit values
+  def __init__(self, shape, median=False):
+    self.shape = tuple(shape)
+    self.count = 0
+    self.total = np.zeros(self.shape, dtype=np.float64)
+    if median:
+      self.hist = np.zeros(self.shape + (256,), dtype=np.uint32)
+      self._offsets = np.arange(self.total.size, dtype=np.int64) * 256
+    else:
+      self.hist = None
+
+  ### Add a frame
+  def add(self, frame):
+    if frame.shape != self.shape:
+      pcv.fatal_error('Frame size ' + str(frame.shape) + ' is not ' + str(self.shape))
+    self.total += frame
+    if self.hist is not None:
+      # Every pixel has its own histogram, so the indices are unique
+      self.hist.reshape(-1)[self._offsets + frame.reshape(-1)] += 1
+    self.count += 1
+
+  ### Add the frames of another accumulator
+  def merge(self, other):
+    if other.shape != self.shape:
+      pcv.fatal_error('Frame size ' + str(other.shape) + ' is not ' + str(self.shape))
+    self.total += other.total
+    if self.hist is not None:
+      self.hist += other.hist
+    self.count += other.count
+
+  ### Rounded mean of the frames
+  def mean(self):
+    return np.round(self.total / self.count).astype(np.uint8)
+
+  ### Rounded per-pixel median of the frames
+  def median(self):
+    # The two middle ranks (the same one for an odd count), found in the cumulative histograms
+    cum = np.cumsum(self.hist, axis=-1)
+    low = np.argmax(cum > (self.count - 1) // 2, axis=-1)
+    high = np.argmax(cum > self.count // 2, axis=-1)
+    return np.round((low + high) / 2.0).astype(np.uint8)
+
+### Read a frame as 8-bit grayscale (as the NIR scripts read images and backgrounds)
+def read_frame(path):
+  frame = cv2.imread(path, flags=0)
+  if frame is None:
+    pcv.fatal_error('Failed to open ' + str(path))
+  return frame
+
+def _sum_chunk(job):
+  paths, median = job
+  acc = None
+  for path in paths:
+    frame = read_frame(path)
+    if acc is None:
+      acc = Accumulator(frame.shape, median)
+    acc.add(frame)
+  return acc
+
+### Sum of a list of frames, read in parallel
+def accumulate(paths, acc=None, median=False, processes=None, chunk=64):
+  # acc = accumulator to add the frames to (a new one if None)
+  # Returns the accumulator
+  if not paths:
+    return acc
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+  jobs = [(paths[i:i + chunk], median) for i in range(0, len(paths), chunk)]
+  if processes <= 1 or len(jobs) == 1:
+    parts = map(_sum_chunk, jobs)
+    pool = None
+  else:
+    pool = multiprocessing.Pool(min(processes, len(jobs)))
+    parts = pool.imap_unordered(_sum_chunk, jobs)
+  try:
+    for part in parts:
+      if acc is None:
+        acc = part
+      else:
+        acc.merge(part)
+    if pool is not None:
+      pool.close()
+  except:
+    if pool is not None:
+      pool.terminate()
+    raise
+  finally:
+    if pool is not None:
+      pool.join()
+  return acc
+
+### Load the state of an earlier run, returns (accumulator, list of frames) or (None, [])
+def load_state(path):
+  if not os.path.exists(path):
+    return None, []
+  state = np.load(path)
+  median = 'hist' in state.files
+  acc = Accumulator(state['total'].shape, median)
+  acc.total[:] = state['total']
+  acc.count = int(state['count'])
+  if median:
+    acc.hist[:] = state['hist']
+  return acc, [str(f) for f in state['frames']]
+
+def save_state(path, acc, frames):
+  arrays = {'total': acc.total, 'count': np.array(acc.count), 'frames': np.array(frames)}
+  if acc.hist is not None:
+    arrays['hist'] = acc.hist
+  directory = os.path.dirname(os.path.abspath(path))
+  fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+  with os.fdopen(fd, 'wb') as f:
+    np.savez(f, **arrays)
+  os.rename(tmp, path)
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  state_file = args.state or args.output + '.state.npz'
+  acc, frames = load_state(state_file)
+  if acc is not None and args.median and acc.hist is None:
+    pcv.fatal_error('The state file ' + state_file + ' has no histograms, rebuild it with -m')
+  median = args.median or (acc is not None and acc.hist is not None)
+
+  # Frames that are not in the average yet
+  done = set(frames)
+  new = [p for p in (os.path.abspath(p) for p in find_images(args.input, args.pattern)) if p not in done]
+  if not new and acc is None:
+    pcv.fatal_error('No frames found for ' + str(args.input))
+  acc = accumulate(new, acc, median, args.processes, args.chunk)
+  frames.extend(new)
+  save_state(state_file, acc, frames)
+
+  average = acc.median() if args.median else acc.mean()
+  # The averaged masks are stored as 3-channel images
+  pcv.print_image(cv2.cvtColor(average, cv2.COLOR_GRAY2BGR), args.output)
+  sys.stderr.write(args.output + ': ' + str(len(new)) + ' new frame(s), ' + str(acc.count) + ' in total\n')
+
+  if args.camera:
+    from background_store import add_version, orient
+    version = add_version(args.camera, args.zoom, orient(average, args.orientation), args.orientation, frames,
+                          'average_images.py' + (' median' if args.median else ''))
+    sys.stderr.write(args.camera + ' ' + args.zoom + ': version ' + str(version) + '\n')
+
+if __name__ == '__main__':
+  main()
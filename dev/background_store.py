@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+# NIR background store
+# The NIR scripts subtract an averaged image of the empty car from every image. They used to read the background PNG
+# (e.g. bkgrd_ave_z500.png) per image and turn both the image and the background with ndimage.rotate(..., 180), an
+# interpolating rotation used as a flip. The store keeps one averaged background per (camera, zoom), already in the
+# orientation of the flipped images, as a .npy file. It is memory-mapped read-only and loaded once per process, so all
+# the workers of a batch share the same pages and the per-image cost is the subtraction.
+#
+# Layout: <store>/<camera>/<zoom>/v<N>.npy plus manifest.json (versions, orientation, source frames, current version).
+# Store directory: PLANTCV_BACKGROUND_STORE, default ~/.cache/plantcv-dev-scripts/backgrounds
+#
+# Build a new version from empty-car frames (a directory, glob pattern or file with one path per line):
+#   python background_store.py -c nir_sv -z z500 -r rot180 -i /path/to/empty_car_frames/
+# Import an existing averaged background as a new version:
+#   python background_store.py -c nir_sv -z z500 -r rot180 -b bkgrd_ave_z500.png
+# Go back to an earlier version, list the versions:
+#   python background_store.py -c nir_sv -z z500 -s 1
+#   python background_store.py -l
+
+import argparse
+import os
+import json
+import time
+import tempfile
+import cv2
+import numpy as np
+import plantcv as pcv
+
+ORIENTATIONS = ('none', 'rot180')
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Build and version averaged NIR backgrounds.")
+  parser.add_argument("-c", "--camera", help="Camera label, e.g. nir_sv.", required=False)
+  parser.add_argument("-z", "--zoom", help="Zoom (setup) label, e.g. z500.", required=False)
+  parser.add_argument("-r", "--orientation", help="Orientation of the images the background is subtracted from.",
+                      choices=ORIENTATIONS, default='none')
+  parser.add_argument("-i", "--input", help="Empty-car frames: directory, glob pattern or file with one path per line.",
+                      required=False)
+  parser.add_argument("-b", "--background", help="Existing averaged background image to import.", required=False)
+  parser.add_argument("-s", "--select", help="Make this version the current one.", type=int, required=False)
+  parser.add_argument("-n", "--note", help="Note stored with the new version.", default='')
+  parser.add_argument("-d", "--directory", help="Background store directory.", required=False)
+  parser.add_argument("-l", "--list", help="List the stored backgrounds.", action="store_true")
+  args = parser.parse_args()
+  if not args.list:
+    if not (args.camera and args.zoom):
+      parser.error("a camera (-c) and zoom (-z) are required")
+    if [args.input, args.background, args.select].count(None) != 2:
+      parser.error("give one of -i, -b or -s")
+  return args
+
+### Default store directory
+def store_dir():
+  return os.getenv('PLANTCV_BACKGROUND_STORE',
+                   os.path.join(os.path.expanduser('~'), '.cache', 'plantcv-dev-scripts', 'backgrounds'))
+
+def _background_dir(camera, zoom, directory=None):
+  if directory is None:
+    directory = store_dir()
+  return os.path.join(directory, camera, zoom)
+
+### Turn an image the way the pipeline does (exact, no interpolation)
+def orient(img, orientation):
+  # orientation = 'none' or 'rot180' (upside-down cameras)
+  if orientation == 'none':
+    return img
+  if orientation == 'rot180':
+    return cv2.flip(img, -1)
+  pcv.fatal_error('Orientation ' + str(orientation) + ' is not "none" or "rot180"!')
+
+### Manifest of a (camera, zoom), empty if nothing is stored
+def read_manifest(camera, zoom, directory=None):
+  path = os.path.join(_background_dir(camera, zoom, directory), 'manifest.json')
+  if not os.path.exists(path):
+    return {'camera': camera, 'zoom': zoom, 'current': None, 'versions': []}
+  with open(path) as f:
+    return json.load(f)
+
+def _write_atomic(path, write):
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+  with os.fdopen(fd, 'wb') as f:
+    write(f)
+  os.rename(tmp, path)
+
+def _write_manifest(manifest, directory=None):
+  path = os.path.join(_background_dir(manifest['camera'], manifest['zoom'], directory), 'manifest.json')
+  _write_atomic(path, lambda f: f.write(json.dumps(manifest, indent=2).encode('utf-8')))
+
+### Store a background as a new version and make it the current one
+def add_version(camera, zoom, background, orientation, sources=(), note='', directory=None):
+  # background = 8-bit grayscale background, already in the given orientation
+  # sources = frames (or image file) the background was built from
+  # Returns the version number
+  if orientation not in ORIENTATIONS:
+    pcv.fatal_error('Orientation ' + str(orientation) + ' is not "none" or "rot180"!')
+  path = _background_dir(camera, zoom, directory)
+  if not os.path.exists(path):
+    os.makedirs(path)
+  manifest = read_manifest(camera, zoom, directory)
+  version = max([v['version'] for v in manifest['versions']] + [0]) + 1
+  name = 'v' + str(version) + '.npy'
+  background = np.ascontiguousarray(background, dtype=np.uint8)
+  _write_atomic(os.path.join(path, name), lambda f: np.save(f, background))
+  manifest['versions'].append({'version': version, 'file': name, 'orientation': orientation,
+                               'shape': list(background.shape), 'frames': len(sources), 'sources': list(sources),
+                               'note': note, 'created': time.strftime('%Y-%m-%d %H:%M:%S')})
+  manifest['current'] = version
+  _write_manifest(manifest, directory)
+  return version
+
+### Make a stored version the current one
+def select_version(camera, zoom, version, directory=None):
+  manifest = read_manifest(camera, zoom, directory)
+  if version not in [v['version'] for v in manifest['versions']]:
+    pcv.fatal_error('No version ' + str(version) + ' of the ' + camera + ' ' + zoom + ' background!')
+  manifest['current'] = version
+  _write_manifest(manifest, directory)
+
+### Average of a set of empty-car frames
+def average_frames(paths, orientation='none'):
+  total = None
+  for path in paths:
+    frame = cv2.imread(path, flags=0)
+    if frame is None:
+      pcv.fatal_error('Failed to open ' + str(path))
+    if total is None:
+      total = np.zeros(frame.shape, dtype=np.float64)
+    elif frame.shape != total.shape:
+      pcv.fatal_error('Frame ' + str(path) + ' is not ' + str(total.shape))
+    total += frame
+  if total is None:
+    pcv.fatal_error('No frames to average!')
+  return orient(np.round(total / len(paths)).astype(np.uint8), orientation)
+
+# Backgrounds of this process
+_backgrounds = {}
+
+### Background of a camera and zoom in the given orientation (the current stored version, or a legacy image)
+def get_background(camera, zoom, orientation='none', legacy=None, directory=None):
+  # camera = camera label, e.g. 'nir_sv'
+  # zoom = zoom (setup) label, e.g. 'z500'
+  # orientation = orientation of the images the background is subtracted from
+  # legacy = averaged background image used while the store has no version for the camera and zoom
+  # The returned array is read-only
+  key = (camera, zoom, orientation, directory)
+  if key not in _backgrounds:
+    manifest = read_manifest(camera, zoom, directory)
+    if manifest['current'] is not None:
+      stored = [v for v in manifest['versions'] if v['version'] == manifest['current']][0]
+      background = np.asarray(np.load(os.path.join(_background_dir(camera, zoom, directory), stored['file']),
+                                      mmap_mode='r'))
+      if stored['orientation'] != orientation:
+        # Both orientations are their own inverse
+        background = orient(orient(np.array(background), stored['orientation']), orientation)
+    elif legacy is not None:
+      background = cv2.imread(legacy, flags=0)
+      if background is None:
+        pcv.fatal_error('Failed to open ' + str(legacy))
+      background = orient(background, orientation)
+    else:
+      pcv.fatal_error('No background for ' + camera + ' ' + zoom + ', run background_store.py to build it!')
+    background.flags.writeable = False
+    _backgrounds[key] = background
+  return _backgrounds[key]
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  directory = args.directory or store_dir()
+  if args.list:
+    if os.path.isdir(directory):
+      for camera in sorted(os.listdir(directory)):
+        if not os.path.isdir(os.path.join(directory, camera)):
+          continue
+        for zoom in sorted(os.listdir(os.path.join(directory, camera))):
+          manifest = read_manifest(camera, zoom, directory)
+          for v in manifest['versions']:
+            print(camera + '\t' + zoom + '\tv' + str(v['version']) + ('*' if v['version'] == manifest['current'] else '') +
+                  '\t' + v['orientation'] + '\tframes: ' + str(v['frames']) + '\t' + v['created'] + '\t' + v['note'])
+    return
+
+  if args.select is not None:
+    select_version(args.camera, args.zoom, args.select, directory)
+    return
+
+  if args.input:
+    # Shared with the batch runner
+    from pipeline_batch import find_images
+    sources = [os.path.abspath(p) for p in find_images(args.input)]
+    background = average_frames(sources, args.orientation)
+  else:
+    sources = [os.path.abspath(args.background)]
+    background = cv2.imread(args.background, flags=0)
+    if background is None:
+      pcv.fatal_error('Failed to open ' + str(args.background))
+    background = orient(background, args.orientation)
+  version = add_version(args.camera, args.zoom, background, args.orientation, sources, args.note, directory)
+  print(args.camera + ' ' + args.zoom + ': version ' + str(version) + ' from ' + str(len(sources)) + ' image(s)')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+
+# Benchmark suite
+# Micro-benchmarks of the pcv steps the scripts use and end-to-end benchmarks per pipeline family, on the images that
+# ship with the repo:
+#   - VIS: the Duckweed images in dev/practice (with the Duckweed000_1 threshold mask of practice/int_python_run)
+#   - NIR SV: the brachy frames in dev/gehan_brachy/nir_masks/nir-sv/ori_images and their averaged backgrounds
+# The repo has no VIS SV frames, no VIS/NIR pairs and no PSII frames, so the VIS SV script runs on the Duckweed images
+# scaled up to VIS SV size, the VIS->NIR benchmark registers VIS SV size masks made by scaling up the NIR plant masks
+# with the z2500 scripts' registration, and the PSII benchmark uses 16-bit Fdark/Fmin/Fmax frames derived from the NIR
+# frames. All inputs are deterministic.
+#
+# Every benchmark is run once to warm up and then -r times; the best and median times and a digest of the outputs are
+# kept, so a change in the results shows up next to a change in speed. Results are compared with the stored baseline
+# (benchmark_baseline.json next to this script, one benchmark per line so regressions show up in a diff).
+#
+# Usage:
+#   python benchmark.py                         (run everything, compare with the baseline)
+#   python benchmark.py -k fill -k nir_sv       (only benchmarks whose name contains fill or nir_sv)
+#   python benchmark.py -s                      (store the results as the new baseline)
+#   python benchmark.py -o results.json -c      (write the results, exit 1 on regressions)
+
+import argparse
+import sys, os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import platform
+import tempfile
+import multiprocessing
+import cv2
+import numpy as np
+import plantcv as pcv
+
+DEV_DIR = os.path.dirname(os.path.abspath(__file__))
+PRACTICE_DIR = os.path.join(DEV_DIR, 'practice')
+NIR_DIR = os.path.join(DEV_DIR, 'gehan_brachy', 'nir_masks', 'nir-sv')
+BASELINE = os.path.join(DEV_DIR, 'benchmark_baseline.json')
+
+# NIR SV frames (zoom 2500) and their averaged background
+NIR_FRAMES = os.path.join(NIR_DIR, 'ori_images', 'brachy_drought_2500_h2', '*.png')
+NIR_BACKGROUND = os.path.join(NIR_DIR, 'brachy_drought_avg_masks', 'average_NIR_SV_0_z2500_h2_g0_e65.png')
+
+# VIS SV script and the size (rows, columns) of VIS SV frames
+VIS_SV_SCRIPT = os.path.join(DEV_DIR, '..', 'vis_sv', 'vis_sv_z1000_L1.py')
+VIS_SV_SHAPE = (2056, 2454)
+
+# Registration of the VIS/NIR SV z2500 scripts (vis-nir-sv/vis_nir_sv_z2500_h2_e82_brachy_drought.py)
+VIS_NIR_LEGACY = {'flip': 'vertical', 'scale': (0.11532, 0.11532), 'offset': (57, 2), 'position': ('top', 'right')}
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Benchmark the pcv steps and pipeline families on the repo images.")
+  parser.add_argument("-k", "--keyword", help="Only run benchmarks whose name contains this (repeatable).",
+                      action="append", default=[])
+  parser.add_argument("-r", "--repeat", help="Timed runs per benchmark.", type=int, default=5)
+  parser.add_argument("-b", "--baseline", help="Baseline results file.", default=BASELINE)
+  parser.add_argument("-s", "--save", help="Store the results as the new baseline.", action="store_true")
+  parser.add_argument("-o", "--output", help="Also write the results to this file.", required=False)
+  parser.add_argument("-t", "--tolerance", help="Slowdown of the median time reported as a regression.", type=float,
+                      default=0.25)
+  parser.add_argument("-c", "--check", help="Exit with status 1 on regressions or changed outputs.",
+                      action="store_true")
+  parser.add_argument("-l", "--list", help="List the benchmarks.", action="store_true")
+  args = parser.parse_args()
+  return args
+
+_clock = time.perf_counter if hasattr(time, 'perf_counter') else time.time
+
+### Digest of benchmark outputs (arrays by content, other values by repr)
+def digest(value):
+  md5 = hashlib.md5()
+
+  def update(v):
+    if isinstance(v, np.ndarray):
+      md5.update(str((v.shape, v.dtype.str)).encode('utf-8'))
+      md5.update(np.ascontiguousarray(v).tobytes())
+    elif isinstance(v, (list, tuple)):
+      md5.update(b'(')
+      for item in v:
+        update(item)
+      md5.update(b')')
+    elif isinstance(v, float):
+      md5.update(('%.6g' % v).encode('utf-8'))
+    else:
+      md5.update(repr(v).encode('utf-8'))
+
+  update(value)
+  return md5.hexdigest()
+
+############################### Corpus ###############################
+
+def _read(path, flags=1):
+  img = cv2.imread(path, flags)
+  if img is None:
+    pcv.fatal_error('Failed to open ' + str(path))
+  return img
+
+# Corpus of this process
+_corpus = {}
+
+### VIS images: (image, name, plant mask)
+def vis_corpus():
+  if 'vis' not in _corpus:
+    items = []
+    for path in sorted(glob.glob(os.path.join(PRACTICE_DIR, 'Duckweed*'))):
+      img = _read(path)
+      name = os.path.basename(path)
+      if name.startswith('Duckweed000_1'):
+        # Threshold mask of the practice run
+        mask = _read(os.path.join(PRACTICE_DIR, 'int_python_run', '2_binary_threshold20.png'), 0)
+      else:
+        device, s = pcv.rgb2gray_hsv(img, 's', 0, False)
+        device, mask = pcv.binary_threshold(s, 20, 255, 'light', device, False)
+      items.append((img, name, mask))
+    _corpus['vis'] = items
+  return _corpus['vis']
+
+### NIR SV frames: (BGR frame, name, grayscale frame, plant mask)
+def nir_corpus():
+  if 'nir' not in _corpus:
+    background = _read(NIR_BACKGROUND, 0)
+    items = []
+    for path in sorted(glob.glob(NIR_FRAMES)):
+      gray = _read(path, 0)
+      device, sub = pcv.image_subtract(gray, background, 0, False)
+      device, mask = pcv.binary_threshold(sub, 20, 255, 'light', device, False)
+      items.append((cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR), path, gray, mask))
+    if not items:
+      pcv.fatal_error('No NIR frames found for ' + NIR_FRAMES)
+    _corpus['nir'] = items
+  return _corpus['nir']
+
+### Objects of the VIS images inside a whole-image ROI
+def vis_objects():
+  if 'objects' not in _corpus:
+    items = []
+    for img, name, mask in vis_corpus():
+      device, objects, hierarchy = pcv.find_objects(img, mask, 0, False)
+      device, roi, roi_hierarchy = pcv.define_roi(img, 'rectangle', device, None, 'default', False, True, 0, 0, 0, 0)
+      items.append((img, name, mask, objects, hierarchy, roi, roi_hierarchy))
+    _corpus['objects'] = items
+  return _corpus['objects']
+
+### VIS-size masks of the NIR frames: (BGR frame, VIS SV size mask)
+def vis_nir_corpus():
+  if 'vis_nir' not in _corpus:
+    items = []
+    for bgr, path, gray, mask in nir_corpus():
+      # The NIR mask scaled up to VIS SV size and flipped back, as the VIS mask the scripts register
+      vis_mask = cv2.resize(mask, (VIS_SV_SHAPE[1], VIS_SV_SHAPE[0]), interpolation=cv2.INTER_NEAREST)
+      items.append((bgr, cv2.flip(vis_mask, 1)))
+    _corpus['vis_nir'] = items
+  return _corpus['vis_nir']
+
+### Combined plant of the VIS images
+def vis_plants():
+  if 'plants' not in _corpus:
+    items = []
+    for img, name, mask, objects, hierarchy, roi, roi_hierarchy in vis_objects():
+      device, roi_objects, hierarchy3, kept_mask, obj_area = pcv.roi_objects(img, 'partial', roi, roi_hierarchy,
+                                                                             objects, hierarchy, 0, False)
+      device, obj, obj_mask = pcv.object_composition(img, roi_objects, hierarchy3, device, False)
+      items.append((img, name, kept_mask, obj, obj_mask))
+    _corpus['plants'] = items
+  return _corpus['plants']
+
+######################### Micro-benchmarks ###########################
+# Each setup function prepares its inputs and returns the function that is timed, or the function and a cleanup
+# function for the scratch files and settings it made
+
+def bench_binary_threshold():
+  grays = [gray for bgr, name, gray, mask in nir_corpus()] + [cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+                                                             for img, name, mask in vis_corpus()]
+  return lambda: [pcv.binary_threshold(gray, 20, 255, 'light', 0, False)[1] for gray in grays]
+
+def bench_median_blur():
+  masks = [mask for bgr, name, gray, mask in nir_corpus()] + [mask for img, name, mask in vis_corpus()]
+  return lambda: [pcv.median_blur(mask, 5, 0, False)[1] for mask in masks]
+
+def bench_fill():
+  masks = [mask for bgr, name, gray, mask in nir_corpus()] + [mask for img, name, mask in vis_corpus()]
+  # pcv.fill fills its first argument, so every run fills a fresh copy
+  return lambda: [pcv.fill(np.copy(mask), mask, 50, 0, False)[1] for mask in masks]
+
+def bench_find_objects():
+  items = [(bgr, mask) for bgr, name, gray, mask in nir_corpus()] + [(img, mask) for img, name, mask in vis_corpus()]
+  return lambda: [pcv.find_objects(img, mask, 0, False)[1:] for img, mask in items]
+
+def bench_roi_objects():
+  items = vis_objects()
+  return lambda: [pcv.roi_objects(img, 'partial', roi, roi_hierarchy, objects, hierarchy, 0, False)[1:]
+                  for img, name, mask, objects, hierarchy, roi, roi_hierarchy in items]
+
+def bench_roi_filter():
+  from roi_filter import RoiFilter
+  items = vis_objects()
+  return lambda: [RoiFilter(mask).roi_objects(img, 'partial', roi, roi_hierarchy, 0, False)[1:]
+                  for img, name, mask, objects, hierarchy, roi, roi_hierarchy in items]
+
+def bench_analyze_object():
+  items = vis_plants()
+  return lambda: [pcv.analyze_object(img, name, obj, obj_mask, 0, False)[1:3]
+                  for img, name, kept_mask, obj, obj_mask in items]
+
+def bench_analyze_color():
+  items = vis_plants()
+  return lambda: [pcv.analyze_color(img, name, kept_mask, 256, 0, False)[1:3]
+                  for img, name, kept_mask, obj, obj_mask in items]
+
+def bench_color_histograms():
+  from color_histograms import color_histograms
+  items = vis_plants()
+  return lambda: [color_histograms(img, kept_mask, 256, 'all') for img, name, kept_mask, obj, obj_mask in items]
+
+def bench_legacy_mask():
+  from registration import legacy_mask
+  items = vis_nir_corpus()
+  return lambda: [legacy_mask(vis_mask, nir.shape, **VIS_NIR_LEGACY) for nir, vis_mask in items]
+
+######################## End-to-end benchmarks #######################
+
+### VIS SV: vis_sv/vis_sv_z1000_L1.py over the Duckweed images scaled up to VIS SV size
+def bench_vis():
+  from pipeline_worker import load_pipeline, run_job
+  frames = tempfile.mkdtemp(prefix='benchmark_vis_sv_frames_')
+  outdir = tempfile.mkdtemp(prefix='benchmark_vis_sv_')
+
+  def cleanup():
+    shutil.rmtree(frames, True)
+    shutil.rmtree(outdir, True)
+
+  try:
+    paths = []
+    for img, name, mask in vis_corpus():
+      path = os.path.join(frames, os.path.splitext(name)[0] + '.png')
+      cv2.imwrite(path, cv2.resize(img, (VIS_SV_SHAPE[1], VIS_SV_SHAPE[0]), interpolation=cv2.INTER_LINEAR))
+      paths.append(path)
+    module = load_pipeline(VIS_SV_SCRIPT)
+  except BaseException:
+    cleanup()
+    raise
+
+  def run():
+    results = []
+    for path in paths:
+      stdout, stderr, status, elapsed = run_job(module, ['-i', path, '-o', outdir])
+      if status != 0:
+        pcv.fatal_error(os.path.basename(path) + ': ' + stderr.strip().split('\n')[-1])
+      results.append(stdout)
+    return results
+  return run, cleanup
+
+### NIR SV: dev/nir_sv_z2500_L2-brachy.py over the brachy z2500 frames, background from a scratch background store
+def bench_nir_sv():
+  from pipeline_worker import load_pipeline, run_job
+  import background_store
+  store = tempfile.mkdtemp(prefix='benchmark_backgrounds_')
+  outdir = tempfile.mkdtemp(prefix='benchmark_nir_sv_')
+  saved_store = os.environ.get('PLANTCV_BACKGROUND_STORE')
+
+  def cleanup():
+    if saved_store is None:
+      os.environ.pop('PLANTCV_BACKGROUND_STORE', None)
+    else:
+      os.environ['PLANTCV_BACKGROUND_STORE'] = saved_store
+    # The background of the scratch store is kept for the process, later scripts must not get it
+    background_store._backgrounds.pop(('nir_sv', 'z3500_brachy', 'none', None), None)
+    shutil.rmtree(store, True)
+    shutil.rmtree(outdir, True)
+
+  try:
+    # The script subtracts the 'z3500_brachy' background
+    background_store.add_version('nir_sv', 'z3500_brachy', _read(NIR_BACKGROUND, 0), 'none', [NIR_BACKGROUND],
+                                 'benchmark', store)
+    os.environ['PLANTCV_BACKGROUND_STORE'] = store
+    module = load_pipeline(os.path.join(DEV_DIR, 'nir_sv_z2500_L2-brachy.py'))
+    frames = [path for bgr, path, gray, mask in nir_corpus()]
+  except BaseException:
+    cleanup()
+    raise
+
+  def run():
+    results = []
+    for path in frames:
+      stdout, stderr, status, elapsed = run_job(module, ['-i', path, '-o', outdir])
+      if status != 0:
+        pcv.fatal_error(os.path.basename(path) + ': ' + stderr.strip().split('\n')[-1])
+      results.append(stdout)
+    return results
+  return run, cleanup
+
+### VIS->NIR: register VIS SV size masks onto the NIR frames as the z2500 scripts do, then NIR objects and their
+### composition
+def bench_vis_nir():
+  import registration
+  # An empty cache directory, so a calibrated transform of this machine is not used
+  directory = tempfile.mkdtemp(prefix='benchmark_registration_')
+  items = vis_nir_corpus()
+
+  def run():
+    results = []
+    for nir, vis_mask in items:
+      reg = registration.get_registration('vis_sv-nir_sv', 'z2500_h2_e82_brachy_drought', vis_mask.shape, nir.shape,
+                                          legacy=VIS_NIR_LEGACY, directory=directory)
+      device, newmask = reg.warp(vis_mask, 0, False)
+      device, nir_objects, nir_hierarchy = pcv.find_objects(nir, newmask, device, False)
+      device, nir_combined, nir_combinedmask = pcv.object_composition(nir, nir_objects, nir_hierarchy, device, False)
+      results.append(nir_combinedmask)
+    return results
+
+  def cleanup():
+    shutil.rmtree(directory, True)
+  return run, cleanup
+
+### PSII: plant masks and the stacked Fv/Fm of 16-bit frames made from the NIR frames
+def bench_psii():
+  from psii_engine import plant_mask, fvfm_stack
+  fmax = np.array([gray.astype(np.uint16) * 16 + 100 for bgr, path, gray, mask in nir_corpus()])
+  fmin = (fmax * 0.3).astype(np.uint16)
+  fdark = np.full(fmax.shape, 50, dtype=np.uint16)
+
+  def run():
+    masks = np.array([plant_mask((frame >> 4).astype(np.uint8), 20, 5, 110, 0)[1] for frame in fmax])
+    return [data for header, data in fvfm_stack(fdark, fmin, fmax, masks)]
+  return run
+
+# name -> setup function, in run order
+BENCHMARKS = [
+  ('micro.binary_threshold', bench_binary_threshold),
+  ('micro.median_blur', bench_median_blur),
+  ('micro.fill', bench_fill),
+  ('micro.find_objects', bench_find_objects),
+  ('micro.roi_objects', bench_roi_objects),
+  ('micro.roi_filter', bench_roi_filter),
+  ('micro.analyze_object', bench_analyze_object),
+  ('micro.analyze_color', bench_analyze_color),
+  ('micro.color_histograms', bench_color_histograms),
+  ('micro.legacy_mask', bench_legacy_mask),
+  ('pipeline.vis', bench_vis),
+  ('pipeline.nir_sv', bench_nir_sv),
+  ('pipeline.vis_nir', bench_vis_nir),
+  ('pipeline.psii', bench_psii)
+]
+
+############################### Runner ###############################
+
+### Run one benchmark, returns its result record
+def run_benchmark(setup, repeat=5):
+  cleanup = None
+  try:
+    func = setup()
+    if isinstance(func, tuple):
+      func, cleanup = func
+    output = func()
+    times = []
+    for i in range(repeat):
+      start = _clock()
+      func()
+      times.append(_clock() - start)
+  except Exception as e:
+    return {'error': type(e).__name__ + ': ' + str(e)}
+  finally:
+    if cleanup is not None:
+      cleanup()
+  return {'best': min(times), 'median': float(np.median(times)), 'repeat': repeat, 'digest': digest(output)}
+
+### Versions and machine of a run
+def environment():
+  return {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+          'plantcv': getattr(pcv, '__version__', 'unknown'), 'machine': platform.machine(),
+          'system': platform.system(), 'cpus': multiprocessing.cpu_count()}
+
+### Write results (one benchmark per line)
+def write_results(path, results):
+  lines = ['{', '  "environment": ' + json.dumps(results['environment'], sort_keys=True) + ',',
+           '  "benchmarks": {']
+  names = sorted(results['benchmarks'])
+  for i, name in enumerate(names):
+    lines.append('    ' + json.dumps(name) + ': ' + json.dumps(results['benchmarks'][name], sort_keys=True) +
+                 (',' if i < len(names) - 1 else ''))
+  lines += ['  }', '}']
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+  with os.fdopen(fd, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  os.rename(tmp, path)
+
+### Compare results with a baseline, returns the number of regressions
+def compare(results, baseline, tolerance=0.25, out=sys.stdout):
+  regressions = 0
+  if baseline['environment'] != results['environment']:
+    out.write('baseline environment differs: ' + json.dumps(baseline['environment'], sort_keys=True) + '\n')
+  out.write('\t'.join(('benchmark', 'median_ms', 'baseline_ms', 'ratio', 'status')) + '\n')
+  for name in sorted(results['benchmarks']):
+    new = results['benchmarks'][name]
+    old = baseline['benchmarks'].get(name)
+    if 'error' in new:
+      status = 'ERROR ' + new['error']
+      regressions += 1
+    elif old is None or 'error' in old:
+      status = 'new'
+    elif new['digest'] != old['digest']:
+      status = 'OUTPUT CHANGED'
+      regressions += 1
+    elif new['median'] > old['median'] * (1 + tolerance):
+      status = 'SLOWER'
+      regressions += 1
+    elif new['median'] < old['median'] * (1 - tolerance):
+      status = 'faster'
+    else:
+      status = 'ok'
+    median = '%.3f' % (1000 * new['median']) if 'median' in new else '-'
+    base = '%.3f' % (1000 * old['median']) if old is not None and 'median' in old else '-'
+    ratio = '%.2f' % (new['median'] / old['median']) if median != '-' and base != '-' and old['median'] > 0 else '-'
+    out.write('\t'.join((name, median, base, ratio, status)) + '\n')
+  return regressions
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  selected = [(name, setup) for name, setup in BENCHMARKS
+              if not args.keyword or any(k in name for k in args.keyword)]
+  if args.list:
+    for name, setup in selected:
+      print(name)
+    return
+
+  results = {'environment': environment(), 'benchmarks': {}}
+  for name, setup in selected:
+    results['benchmarks'][name] = run_benchmark(setup, args.repeat)
+    record = results['benchmarks'][name]
+    sys.stderr.write(name + ': ' + (record['error'] if 'error' in record else
+                                    '%.3f ms' % (1000 * record['median'])) + '\n')
+
+  if args.output:
+    write_results(args.output, results)
+  regressions = 0
+  if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+  elif not args.save:
+    sys.stderr.write('no baseline ' + args.baseline + ', store one with -s\n')
+  if args.save:
+    if os.path.exists(args.baseline):
+      # Keep the baseline of benchmarks that were not run
+      for name, record in baseline['benchmarks'].items():
+        results['benchmarks'].setdefault(name, record)
+    write_results(args.baseline, results)
+    sys.stderr.write('baseline: ' + args.baseline + '\n')
+  if args.check and regressions:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,123 @@
+# One-pass color histograms of the masked pixels
+# pcv.analyze_color converts the whole masked image to LAB and HSV, splits every color space into planes and builds one
+# histogram per channel, besides the pseudocolored images and plots. color_histograms gathers the masked pixels once,
+# converts only those pixels and only to the color spaces of the requested channels, and counts every channel of the
+# shared conversions with cv2.calcHist. No images are rendered. The result is a compact (channels, bins) integer array;
+# histogram_data turns it into the HEADER_HISTOGRAM/HISTOGRAM_DATA rows of analyze_color for pcv.print_results or
+# results_sink.
+#
+# Values are binned as analyze_color bins them: divided by 256 / bins (integer division) and counted with
+# cv2.calcHist(..., [bins], [0, bins - 1]), which leaves out the values that land in the last bin (value 255 with 256
+# bins, so the last bin is always 0). binning='even' counts every value (value * bins // 256);
+# histogram_data labels those rows HEADER_HISTOGRAM_EVEN/HISTOGRAM_DATA_EVEN, since they differ from analyze_color's.
+# Hue is 0-179 as in the OpenCV conversion.
+#
+# Usage in a pipeline:
+#   hists = color_histograms(img, kept_mask, 256, 'all')
+#   color_header, color_data = histogram_data(hists, 'all')
+#   pcv.print_results(args.image, color_header, color_data)
+
+import cv2
+import numpy as np
+import plantcv as pcv
+
+# Channels of analyze_color: key, name in the histogram header, color space, plane of the color space
+CHANNELS = (
+  ('b', 'blue', 'bgr', 0),
+  ('g', 'green', 'bgr', 1),
+  ('r', 'red', 'bgr', 2),
+  ('l', 'lightness', 'lab', 0),
+  ('m', 'green-magenta', 'lab', 1),
+  ('y', 'blue-yellow', 'lab', 2),
+  ('h', 'hue', 'hsv', 0),
+  ('s', 'saturation', 'hsv', 1),
+  ('v', 'value', 'hsv', 2)
+)
+# Channel sets of analyze_color's hist_plot_type
+CHANNEL_SETS = {
+  'all': ('b', 'g', 'r', 'l', 'm', 'y', 'h', 's', 'v'),
+  'rgb': ('b', 'g', 'r'),
+  'lab': ('l', 'm', 'y'),
+  'hsv': ('h', 's', 'v')
+}
+CONVERSIONS = {
+  'lab': cv2.COLOR_BGR2LAB,
+  'hsv': cv2.COLOR_BGR2HSV
+}
+BINNINGS = ('analyze_color', 'even')
+# Masked pixels converted and counted at a time (bounds the temporary arrays and keeps the float32 counts of
+# cv2.calcHist exact)
+CHUNK_PIXELS = 1 << 18
+
+_channels = dict((key, (name, space, plane)) for key, name, space, plane in CHANNELS)
+
+### Channel keys of a channel set name or a sequence of keys
+def channel_list(channels):
+  if isinstance(channels, str) and channels in CHANNEL_SETS:
+    return CHANNEL_SETS[channels]
+  for key in channels:
+    if key not in _channels:
+      pcv.fatal_error('Channel ' + str(key) + ' is not one of ' + ', '.join(CHANNEL_SETS['all']) + ' or a set (' +
+                      ', '.join(sorted(CHANNEL_SETS)) + ')!')
+  return tuple(channels)
+
+### Histogram bin of every 8-bit value (-1 for values that are not counted)
+def bin_index(bins, binning='analyze_color'):
+  values = np.arange(256)
+  if binning == 'analyze_color':
+    index = values // (256 // bins)
+    index[index >= bins - 1] = -1
+  elif binning == 'even':
+    index = values * bins // 256
+  else:
+    pcv.fatal_error('Binning ' + str(binning) + ' is not one of ' + ', '.join(BINNINGS) + '!')
+  return index
+
+### Histograms of the masked pixels of an image, one row per channel
+def color_histograms(img, mask, bins=256, channels='all', binning='analyze_color'):
+  # img = BGR image
+  # mask = binary mask, the pixels where it is not zero are counted
+  # bins = number of histogram bins (1-256)
+  # channels = 'all', 'rgb', 'lab', 'hsv' or a sequence of channel keys (b, g, r, l, m, y, h, s, v)
+  # binning = 'analyze_color' or 'even' (see above)
+  # Returns a (channels, bins) int64 array in the order of the channels
+  if not 1 <= bins <= 256:
+    pcv.fatal_error('Number of bins ' + str(bins) + ' is not between 1 and 256!')
+  keys = channel_list(channels)
+  bin_index(bins, binning)
+  spaces = [space for space in ('bgr', 'lab', 'hsv') if any(_channels[key][1] == space for key in keys)]
+  # Counts of every 8-bit value, binned at the end
+  counts = np.zeros((len(keys), 256), dtype=np.int64)
+
+  pixels = img[mask > 0].reshape(-1, 1, 3)
+  for start in range(0, len(pixels), CHUNK_PIXELS):
+    # Per-pixel conversions of the masked pixels only, as an n x 1 image
+    planes = {'bgr': pixels[start:start + CHUNK_PIXELS]}
+    for space in spaces:
+      if space != 'bgr':
+        planes[space] = cv2.cvtColor(planes['bgr'], CONVERSIONS[space])
+    for i, key in enumerate(keys):
+      name, space, plane = _channels[key]
+      counts[i] += cv2.calcHist([planes[space]], [plane], None, [256], [0, 256]).ravel().astype(np.int64)
+
+  return bin_counts(counts, bins, binning)
+
+### Histograms from the counts of every 8-bit value, one row per channel
+def bin_counts(counts, bins=256, binning='analyze_color'):
+  # counts = (channels, 256) array of value counts (color_histograms with 256 bins and binning='even')
+  index = bin_index(bins, binning)
+  hists = np.zeros((len(counts), bins), dtype=np.int64)
+  kept = index >= 0
+  for i in range(len(counts)):
+    np.add.at(hists[i], index[kept], counts[i][kept])
+  return hists
+
+### Header and data rows of histograms (analyze_color's HEADER_HISTOGRAM and HISTOGRAM_DATA)
+def histogram_data(hists, channels='all', binning='analyze_color'):
+  # hists = array from color_histograms
+  # channels, binning = the channels and binning given to color_histograms
+  keys = channel_list(channels)
+  suffix = '' if binning == 'analyze_color' else '_' + binning.upper()
+  header = ('HEADER_HISTOGRAM' + suffix, 'bin-number') + tuple(_channels[key][0] for key in keys)
+  data = ('HISTOGRAM_DATA' + suffix, hists.shape[1]) + tuple(row.tolist() for row in hists)
+  return header, data
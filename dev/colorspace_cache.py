@@ -0,0 +1,99 @@
+# Per-image color-space cache
+# Converts an image to LAB and HSV at most once and hands out the channel planes of the conversion.
+# Masked copies of the image (pcv.apply_mask) only differ from the original where the mask is zero, and there
+# every pixel has the same known color (white or black), so their channel planes are derived from the cached
+# planes of the parent image with the mask instead of converting the masked image again.
+#
+# Usage (drop-in for pcv.rgb2gray_lab/rgb2gray_hsv/apply_mask):
+#   cs = ColorSpaceCache(img)
+#   device, b = cs.rgb2gray_lab('b', device, args.debug)
+#   device, masked, masked_cs = cs.apply_mask(bs, 'white', device, args.debug)
+#   device, masked_a = masked_cs.rgb2gray_lab('a', device, args.debug)
+#
+# Planes are shared between callers, do not modify them in place.
+
+import cv2
+import numpy as np
+import plantcv as pcv
+
+# Channel order of the OpenCV conversions and the names pcv uses for debug images
+CHANNELS = {
+  'lab': ('l', 'a', 'b'),
+  'hsv': ('h', 's', 'v')
+}
+NAMES = {
+  'lab': {'l': 'lightness', 'a': 'green-magenta', 'b': 'blue-yellow'},
+  'hsv': {'h': 'hue', 's': 'saturation', 'v': 'value'}
+}
+CONVERSIONS = {
+  'lab': cv2.COLOR_BGR2LAB,
+  'hsv': cv2.COLOR_BGR2HSV
+}
+MASK_COLORS = {
+  'white': 255,
+  'black': 0
+}
+
+### Color of a masked-out pixel in each color space
+def _fill_values(space, mask_color):
+  pixel = np.zeros((1, 1, 3), dtype=np.uint8) + MASK_COLORS[mask_color]
+  converted = cv2.cvtColor(pixel, CONVERSIONS[space])
+  return dict(zip(CHANNELS[space], converted[0, 0]))
+
+class ColorSpaceCache(object):
+  # img = BGR image object (as returned by pcv.readimage)
+  # parent, mask, mask_color are used internally for masked copies (see apply_mask)
+  def __init__(self, img, parent=None, mask=None, mask_color='white'):
+    if mask_color not in MASK_COLORS:
+      pcv.fatal_error('Mask Color ' + str(mask_color) + ' is not "white" or "black"!')
+    self.img = img
+    self.parent = parent
+    self.mask = mask
+    self.mask_color = mask_color
+    self.planes = {}
+
+  ### Single channel plane of a color space, converted or derived only once
+  def channel(self, space, channel):
+    # space = 'lab' or 'hsv'
+    # channel = 'l', 'a', 'b' for LAB or 'h', 's', 'v' for HSV
+    if space not in CHANNELS:
+      pcv.fatal_error('Color space ' + str(space) + ' is not "lab" or "hsv"!')
+    if channel not in CHANNELS[space]:
+      pcv.fatal_error('Channel ' + str(channel) + ' is not ' + ', '.join(CHANNELS[space]) + '!')
+
+    key = (space, channel)
+    if key not in self.planes:
+      if self.parent is None:
+        # Convert the whole image once and keep all three planes
+        converted = cv2.cvtColor(self.img, CONVERSIONS[space])
+        for name, plane in zip(CHANNELS[space], cv2.split(converted)):
+          self.planes[(space, name)] = plane
+      else:
+        # Masked copy: parent plane where the mask is set, the mask color everywhere else
+        fill = _fill_values(space, self.mask_color)[channel]
+        source = self.parent.channel(space, channel)
+        plane = np.full_like(source, fill)
+        np.copyto(plane, source, where=self.mask > 0)
+        self.planes[key] = plane
+    return self.planes[key]
+
+  ### Drop-in for pcv.rgb2gray_lab(img, channel, device, debug)
+  def rgb2gray_lab(self, channel, device, debug=False):
+    return self._gray('lab', channel, device, debug)
+
+  ### Drop-in for pcv.rgb2gray_hsv(img, channel, device, debug)
+  def rgb2gray_hsv(self, channel, device, debug=False):
+    return self._gray('hsv', channel, device, debug)
+
+  def _gray(self, space, channel, device, debug):
+    plane = self.channel(space, channel)
+    device += 1
+    if debug:
+      pcv.print_image(plane, (str(device) + '_' + space + '_' + NAMES[space][channel] + '.png'))
+    return device, plane
+
+  ### Drop-in for pcv.apply_mask(img, mask, mask_color, device, debug)
+  # Returns the masked image and a cache for it that shares this image's conversions
+  def apply_mask(self, mask, mask_color, device, debug=False):
+    device, masked = pcv.apply_mask(self.img, mask, mask_color, device, debug)
+    return device, masked, ColorSpaceCache(masked, parent=self, mask=mask, mask_color=mask_color)
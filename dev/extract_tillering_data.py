@@ -4,11 +4,10 @@ import sys, os
 import sqlite3 as sq
 import plantcv as pcv
 import math
+import multiprocessing
 from datetime import datetime as dt
 import numpy as np
-import re
 import cv2
-#import pandas as pd
 
 ### Parse command-line arguments
 def options():
@@ -16,18 +15,15 @@ def options():
   parser.add_argument("-d", "--database", help="SQLite database file from plantcv.", required=True)
   parser.add_argument("-o", "--outfile", help="Output text file.", required=True)
   parser.add_argument("-p", "--height", help="Height of images in pixels", required=True, type=int)
-  parser.add_argument("-t", "--tiller", help="Optional manual input of zoom-corrected tiller width in pixels", required=False, type=int)
+  parser.add_argument("-t", "--tiller", help="Optional manual input of zoom-corrected tiller width (used instead of the estimate)", required=False, type=float)
   parser.add_argument("-te", "--tillerest",help="number of days that should be used for tiller estimation, requires an integer", required=False, type=int)
+  parser.add_argument("-n", "--noimages", help="Do not write tiller count images.", action="store_true")
+  parser.add_argument("-T", "--threads", help="Number of processes writing tiller count images. Default: number of CPUs.", type=int, default=multiprocessing.cpu_count())
   parser.add_argument("-D", "--debug", help="Turn on debugging mode", action="store_true")
   args = parser.parse_args()
   return args
 
-### Dictionary factory for SQLite query results
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+FRAMES = (0, 90, 180, 270)
 
 ### Top-view center of mass correction
 def tv_centroid_correction(area, centroid_height):
@@ -41,241 +37,181 @@ def zoom_correction(area, zoom):
   area /= correction_factor
   return area
 
-### Length conversion
+### Length conversion (works on numbers and arrays)
 def px_to_cm(px, zoom):
   pxcm = (0.000002171 * (zoom ** 2)) + (0.002073 * zoom) + 14.27
   cm = px / pxcm
   return cm
 
+### All tiller images with their widths, one row per (datetime, plant, frame)
+def read_tillers(connect):
+  # Indexes for the join and the camera/datetime filter (no-ops when they exist)
+  connect.execute('CREATE INDEX IF NOT EXISTS snapshots_camera_datetime ON snapshots (camera, datetime)')
+  connect.execute('CREATE INDEX IF NOT EXISTS snapshots_image_id ON snapshots (image_id)')
+  connect.execute('CREATE INDEX IF NOT EXISTS tillering_data_image_id ON tillering_data (image_id)')
+  connect.execute('CREATE INDEX IF NOT EXISTS analysis_images_image_id ON analysis_images (image_id, type)')
+  connect.commit()
+
+  first = connect.execute('SELECT MIN(datetime) FROM snapshots').fetchone()[0]
+  rows = connect.execute('SELECT snapshots.datetime, snapshots.plant_id, snapshots.frame, snapshots.zoom, '
+                         'tillering_data.raw_tillering_width, analysis_images.image_path '
+                         'FROM snapshots '
+                         'INNER JOIN tillering_data ON snapshots.image_id = tillering_data.image_id '
+                         'INNER JOIN analysis_images ON snapshots.image_id = analysis_images.image_id '
+                         'WHERE snapshots.camera = "vis_sv" AND analysis_images.type = "tillers" '
+                         'ORDER BY snapshots.datetime, snapshots.plant_id, snapshots.frame, snapshots.image_id').fetchall()
+  # The last image of a frame is kept
+  tillers = {}
+  for row in rows:
+    tillers[(row[0], row[1], row[2])] = row
+  return first, [tillers[key] for key in sorted(tillers)]
+
+### Parse the width lists of all rows at once
+def parse_widths(width_strings):
+  # Returns the widths of all rows concatenated and the number of widths of each row
+  cleaned = [str(w).translate(None, '[] ') if sys.version_info[0] == 2 else str(w).translate({ord(c): None for c in '[] '})
+             for w in width_strings]
+  counts = np.array([(c.count(',') + 1) if c else 0 for c in cleaned], dtype=np.int64)
+  joined = ','.join(c for c in cleaned if c)
+  if joined:
+    widths = np.array(joined.split(','), dtype=np.int64)
+  else:
+    widths = np.zeros(0, dtype=np.int64)
+  return widths, counts
+
+### Normalized tiller count of each width
+def tiller_counts(widths_cm, width_estimate):
+  # Widths below half the estimate are not tillers, widths up to 1.75 times the estimate are one tiller and wider
+  # objects count as several tillers
+  tiller_width_est = width_estimate * 1.75
+  tiller_none = float(width_estimate / 2)
+  one = (widths_cm >= tiller_none) & (widths_cm <= tiller_width_est)
+  several = np.where(widths_cm > tiller_width_est, np.floor(widths_cm / tiller_width_est), 0)
+  return np.where(one, 1, several).astype(np.int64)
+
+### Write the tiller counts on a tiller image
+def annotate_image(job):
+  img_path, name_img, raw_count, tiller_count_total = job
+  img = cv2.imread(str(img_path))
+  if img is None:
+    return name_img, False
+  ix, iy, iz = np.shape(img)
+  x = ix // 10
+  y = iy // 10
+  y1 = iy // 7
+  text = ('Raw Tiller Count=' + str(raw_count))
+  text1 = ('Normalized Tiller Count=' + str(tiller_count_total))
+  cv2.putText(img, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 3, (0, 0, 255), 4)
+  cv2.putText(img, text1, (x, y1), cv2.FONT_HERSHEY_SIMPLEX, 3, (0, 0, 255), 4)
+  pcv.print_image(img, name_img)
+  return name_img, True
+
 ### Main pipeline
 def main():
   # Get options
   args = options()
-  
+
   # Does the database exist?
   if not os.path.exists(args.database):
     pcv.fatal_error("The database file " + str(args.database) + " does not exist");
-  
+
   # Open a connection
   try:
-    connect=sq.connect(args.database)
-  except sq.Error, e:
-    print("Error %s:" % e.args[0])
-  
-  # Open output file
-  #try:
-  #  out = open(args.outfile, 'w')
-  #except IOError:
-  #  print("IO error")
-  
+    connect = sq.connect(args.database)
+  except sq.Error as e:
+    pcv.fatal_error("Error %s:" % e.args[0])
+  # Change the text output format from unicode to UTF-8
+  connect.text_factory = str
+
   # Make Directory For Output Images
-  cwd=os.getcwd()
-  i=dt.now()
-  timenow=i.strftime('%m-%d-%Y_%H:%M:%S')
-  newfolder="slice_figs_and_images_"+(str(timenow))
-  tillering_img_path=(str(cwd)+'/tillering_images'+str(timenow)+'/')
-  if not os.path.exists(tillering_img_path):
+  cwd = os.getcwd()
+  i = dt.now()
+  timenow = i.strftime('%m-%d-%Y_%H:%M:%S')
+  tillering_img_path = (str(cwd) + '/tillering_images' + str(timenow) + '/')
+  if not args.noimages and not os.path.exists(tillering_img_path):
     os.makedirs(tillering_img_path)
-  
-  # Replace the row_factory result constructor with a dictionary constructor
-  connect.row_factory = dict_factory
-  # Change the text output format from unicode to UTF-8
-  connect.text_factory=str
-  
-  # Database handler
-  db = connect.cursor()
-  db1= connect.cursor()
-  db2= connect.cursor()
-  db3= connect.cursor()
-  t= connect.cursor()
-  
-  #Open file and print headers to file
- 
-  try:
-    filename1=args.outfile
-    signal_file1= os.open(filename1,os.O_RDWR|os.O_CREAT)
-  except IOError:
-    print("IO error")
- 
-  column_headers='date_int', 'datetime','barcode','image_path_0','image_path_90','image_path_180','image_path_270','estimated_width', 'estimated_width_std','raw_width_0','raw_width_90','raw_width_180','raw_width_270', 'normalize_width_0','normalized_width_90', 'normalized_width_180', 'normalized_width_270','raw_count_0','raw_count_90','raw_count_180','raw_count_270', 'normalized_count_0','normalized_count_90','normalized_count_180','normalized_count_270'  
-  header_fin='\t'.join(map(str,column_headers))
-  print header_fin
-  os.write(signal_file1, header_fin)
-  os.write(signal_file1, os.linesep)
 
-  # Retrieve snapshot IDs from the database
-  snapshots = []
-  
-  
-  # Find first day of dataset (tool works best with multiple days)
-  for date in t.execute('select min(datetime) as first from snapshots'):
-    firstday=date['first']
-  
-  #find unique datetimes (would find all angles)
-  for row in (db.execute('SELECT DISTINCT(`datetime`) FROM `snapshots` WHERE `camera`="vis_sv"')):
-    snapshots.append(row['datetime'])
-  if (args.debug):
-    print('Found ' + str(len(snapshots)) + ' snapshots')
-  
-###Average values from first day of experiment to estimate tillering width based on median value of tiller-width values from date-range
-  zoom_width_est=[]
-  for snaps in snapshots:
-    data_db=db1.execute('select * from snapshots inner join tillering_data on snapshots.image_id=tillering_data.image_id inner join analysis_images on snapshots.image_id=analysis_images.image_id where camera="vis_sv" and type="tillers" and datetime=?', (snaps,))
-    
-    #number of days to use for tiller estimation (if 0 includes first day only)
-    tiller_est_days=args.tillerest
-    
-    date_int=((snaps-firstday)/86400)
-    if date_int<=tiller_est_days and args.tiller==None:
-      for i, data in enumerate(data_db):
-        raw_width = re.sub('[\[\] ]', '', data['raw_tillering_width']).split(',')
-        int_raw_width=[int(l) for l in raw_width]
-        
-        for x in int_raw_width:
-          width=px_to_cm(x,data['zoom'])
-          zoom_width_est.append(width)
-  
-  zoom_width_median=np.median(zoom_width_est)
-  zoom_width_std=np.std(zoom_width_est)
+  firstday, rows = read_tillers(connect)
+  if args.debug:
+    print('Found ' + str(len(set((r[0], r[1]) for r in rows))) + ' snapshots')
+
+  datetimes = np.array([r[0] for r in rows], dtype=np.int64)
+  zooms = np.array([r[3] for r in rows], dtype=np.float64)
+  date_ints = (datetimes - firstday) // 86400 if rows else datetimes
 
-###Take the width estimation measurement and apply it to the widths to get a better estimation of the number of tillers    
-  for snaps in snapshots:
+  # Widths of all tillers, converted to cm with the zoom of their image
+  widths, counts = parse_widths([r[4] for r in rows])
+  row_index = np.repeat(np.arange(len(rows)), counts)
+  widths_cm = px_to_cm(widths.astype(np.float64), zooms[row_index])
 
-    data_all=db2.execute('select * from snapshots inner join tillering_data on snapshots.image_id=tillering_data.image_id inner join analysis_images on snapshots.image_id=analysis_images.image_id where camera="vis_sv" and type="tillers" and datetime=?', (snaps,)) 
-    data_dict={}
-    frame_data=[]
-    for c, data1 in enumerate(data_all):
-      
-      date_int=((snaps-firstday)/86400)
-      data_dict['date_int']=date_int
-      
-      datetime=data1['datetime']
-      data_dict['datetime']=datetime
-      
-      barcode=data1['plant_id']
-      data_dict['plant_id']=barcode
-      
-      data_dict['estimated_width_cm']=zoom_width_median
-      data_dict['estimated_width_cm_std']=zoom_width_std
-      
-      frame=data1['frame']
-      frame_data.append(frame)
-    
-    for angles in frame_data:
-      data_by_frame=db2.execute('select * from snapshots inner join tillering_data on snapshots.image_id=tillering_data.image_id inner join analysis_images on snapshots.image_id=analysis_images.image_id where camera="vis_sv" and type="tillers" and datetime=? and frame=?', (snaps,angles,)) 
+  ###Average values from first days of experiment to estimate tillering width based on median value of tiller-width values from date-range
+  if args.tiller is not None:
+    zoom_width_median = args.tiller
+    zoom_width_std = 0.0
+  else:
+    if args.tillerest is not None:
+      estimate = widths_cm[date_ints[row_index] <= args.tillerest]
+    else:
+      estimate = widths_cm[:0]
+    zoom_width_median = np.median(estimate) if len(estimate) else float('nan')
+    zoom_width_std = np.std(estimate) if len(estimate) else float('nan')
 
-      for i, data2 in enumerate(data_by_frame):
-        width_all=[]
-        tiller_count=[]
-        
-        frame=data2['frame']
-        img_path=data2['image_path']
-        raw_count=data2['raw_tillering_count']
-        raw_width_all = re.sub('[\[\] ]', '', data2['raw_tillering_width']).split(',')
-        int_raw_width_all=[int(l) for l in raw_width_all]
-        
-        for x in int_raw_width_all:
-          width=px_to_cm(x,data['zoom'])
-          width_all.append(width)
-        raw_count=len(width_all)
-        
-        #adjust tiller count so that 
-        for x in width_all:
-          tiller_width_est=zoom_width_median*1.75
-          tiller_none=(float(zoom_width_median/2))
-          #print tiller_none
-          if x<=tiller_width_est and x>=tiller_none:
-            count=1
-            tiller_count.append(count)
-          elif x<=tiller_none:
-            count=0
-            tiller_count.append(count)
-          elif x>=tiller_width_est:
-            count=int(x/tiller_width_est)
-            tiller_count.append(count)
-        #add tiller count to array
-        tiller_count_total=sum(tiller_count)
-        
-        #change image so that tiller number is written on the image.
-        #read in image
-        tiller_img=cv2.imread(str(img_path))
-        img=np.copy(tiller_img)
-        ix,iy,iz=np.shape(img)
-        x=ix/10
-        y=iy/10
-        y1=iy/7
-        text=('Raw Tiller Count='+str(raw_count))
-        text1=('Normalized Tiller Count='+str(tiller_count_total))
-      
-        cv2.putText(img,text, (x,y), cv2.FONT_HERSHEY_SIMPLEX, 3,(0,0,255),4)
-        cv2.putText(img,text1, (x,y1), cv2.FONT_HERSHEY_SIMPLEX, 3,(0,0,255),4)
-        name_img=str(tillering_img_path)+str(barcode)+'_'+'Frame_'+str(frame)+'_day'+str(date_int)+'_'+str(datetime) + '_tillering_img.png'
-        pcv.print_image(img,name_img)
-        
-      # Put the data for each barcode into the hash
-      if frame==0:
-        data_dict['raw_width_0']=int_raw_width_all
-        data_dict['raw_count_0']=raw_count
-        data_dict['normalized_width_0']=width_all
-        data_dict['normalized_count_0']=tiller_count_total
-        data_dict['img_path_0']=name_img
-        
-      elif frame==90:
-        data_dict['raw_width_90']=int_raw_width_all
-        data_dict['raw_count_90']=raw_count
-        data_dict['normalized_width_90']=width_all
-        data_dict['normalized_count_90']=tiller_count_total
-        data_dict['img_path_90']=name_img
+  ###Take the width estimation measurement and apply it to the widths to get a better estimation of the number of tillers
+  normalized = np.bincount(row_index, weights=tiller_counts(widths_cm, zoom_width_median),
+                           minlength=len(rows)).astype(np.int64)
+  offsets = np.concatenate(([0], np.cumsum(counts)))
 
-      elif frame==180:
-        data_dict['raw_width_180']=int_raw_width_all
-        data_dict['raw_count_180']=raw_count
-        data_dict['normalized_width_180']=width_all
-        data_dict['normalized_count_180']=tiller_count_total
-        data_dict['img_path_180']=name_img
+  # One output line per snapshot (datetime and plant), frames in columns
+  snapshots = {}
+  order = []
+  annotations = []
+  for n, (datetime, barcode, frame, zoom, raw_width, img_path) in enumerate(rows):
+    key = (datetime, barcode)
+    if key not in snapshots:
+      snapshots[key] = {'date_int': int(date_ints[n])}
+      order.append(key)
+    if frame not in FRAMES:
+      continue
+    raw_count = int(counts[n])
+    if args.noimages:
+      name_img = img_path
+    else:
+      name_img = str(tillering_img_path) + str(barcode) + '_' + 'Frame_' + str(frame) + '_day' + \
+                 str(int(date_ints[n])) + '_' + str(datetime) + '_tillering_img.png'
+      annotations.append((img_path, name_img, raw_count, int(normalized[n])))
+    snapshots[key][frame] = {'raw_width': widths[offsets[n]:offsets[n + 1]].tolist(),
+                             'raw_count': raw_count,
+                             'normalized_width': widths_cm[offsets[n]:offsets[n + 1]].tolist(),
+                             'normalized_count': int(normalized[n]),
+                             'img_path': name_img}
 
-      elif frame==270:
-        data_dict['raw_width_270']=int_raw_width_all
-        data_dict['raw_count_270']=raw_count
-        data_dict['normalized_width_270']=width_all
-        data_dict['normalized_count_270']=tiller_count_total
-        data_dict['img_path_270']=name_img
-        
+  # Output file
+  column_headers = 'date_int', 'datetime', 'barcode', 'image_path_0', 'image_path_90', 'image_path_180', 'image_path_270', 'estimated_width', 'estimated_width_std', 'raw_width_0', 'raw_width_90', 'raw_width_180', 'raw_width_270', 'normalize_width_0', 'normalized_width_90', 'normalized_width_180', 'normalized_width_270', 'raw_count_0', 'raw_count_90', 'raw_count_180', 'raw_count_270', 'normalized_count_0', 'normalized_count_90', 'normalized_count_180', 'normalized_count_270'
+  out = open(args.outfile, 'w')
+  header_fin = '\t'.join(map(str, column_headers))
+  print(header_fin)
+  out.write(header_fin + os.linesep)
+  for key in order:
+    data = snapshots[key]
     # if all angles don't exist fill in a None value.
-    if data_dict.get('raw_width_0')==None:
-      data_dict['raw_width_0']=None
-      data_dict['raw_count_0']=None
-      data_dict['normalized_width_0']=None
-      data_dict['normalized_count_0']=None
-      data_dict['img_path_0']=None
-    if data_dict.get('raw_width_90')==None:
-      data_dict['raw_width_90']=None
-      data_dict['raw_count_90']=None
-      data_dict['normalized_width_90']=None
-      data_dict['normalized_count_90']=None
-      data_dict['img_path_90']=None
-    if data_dict.get('raw_width_180')==None:
-      data_dict['raw_width_180']=None
-      data_dict['raw_count_180']=None
-      data_dict['normalized_width_180']=None
-      data_dict['normalized_count_180']=None
-      data_dict['img_path_180']=None
-    if data_dict.get('raw_width_270')==None:
-      data_dict['raw_width_270']=None
-      data_dict['raw_count_270']=None
-      data_dict['normalized_width_270']=None
-      data_dict['normalized_count_270']=None
-      data_dict['img_path_270']=None
-    
-    #print data_dict
-    # Write out data to file
-    list_data=data_dict['date_int'], data_dict['datetime'], data_dict['plant_id'], data_dict['img_path_0'], data_dict['img_path_90'], data_dict['img_path_180'], data_dict['img_path_270'], data_dict['estimated_width_cm'], data_dict['estimated_width_cm_std'], data_dict['raw_width_0'], data_dict['raw_width_90'], data_dict['raw_width_180'], data_dict['raw_width_270'], data_dict['normalized_width_0'], data_dict['normalized_width_90'], data_dict['normalized_width_180'], data_dict['normalized_width_270'], data_dict['raw_count_0'], data_dict['raw_count_90'], data_dict['raw_count_180'], data_dict['raw_count_270'], data_dict['normalized_count_0'], data_dict['normalized_count_90'], data_dict['normalized_count_180'], data_dict['normalized_count_270']
-    data_line='\t'.join(map(str,list_data))
-    print data_line
-    os.write(signal_file1, data_line)
-    os.write(signal_file1, os.linesep)
-    
-  os.close(signal_file1)
+    frames = [data.get(f, {}) for f in FRAMES]
+    list_data = [data['date_int'], key[0], key[1]] + [f.get('img_path') for f in frames] + \
+                [zoom_width_median, zoom_width_std] + \
+                [f.get(field) for field in ('raw_width', 'normalized_width', 'raw_count', 'normalized_count')
+                 for f in frames]
+    data_line = '\t'.join(map(str, list_data))
+    print(data_line)
+    out.write(data_line + os.linesep)
+  out.close()
+
+  # Tiller count images
+  if annotations:
+    pool = multiprocessing.Pool(args.threads)
+    for name_img, written in pool.imap_unordered(annotate_image, annotations, chunksize=8):
+      if not written:
+        sys.stderr.write('Failed to read the tiller image for ' + name_img + '\n')
+    pool.close()
+    pool.join()
 
 if __name__ == '__main__':
   main()
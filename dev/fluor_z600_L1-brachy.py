@@ -5,6 +5,7 @@ import numpy as np
 import argparse
 import string
 import plantcv as pcv
+from psii_engine import read_fluor, track_mask, plant_mask
 
 ### Parse command-line arguments
 def options():
@@ -23,32 +24,20 @@ def main():
   # Get options
   args = options()
   
-  # Read image (converting fmax and track to 8 bit just to create a mask, use 16-bit for all the math)
-  mask, path, filename = pcv.readimage(args.fmax)
-  #mask = cv2.imread(args.fmax)
-  track = cv2.imread(args.track)
+  # Read images once (the 8-bit Fmax view for the mask is derived from the 16-bit data used for all the math)
+  fmax, mask, path, filename = read_fluor(args.fmax)
   
   mask1, mask2, mask3= cv2.split(mask)
   
   # Pipeline step
   device = 0
   
-  # Mask pesky track autofluor
-  device, track1= pcv.rgb2gray_hsv(track, 'v', device, args.debug)
-  device, track_thresh = pcv.binary_threshold(track1, 0, 255, 'light', device, args.debug)
-  device, track_inv=pcv.invert(track_thresh, device, args.debug)
+  # Mask pesky track autofluor (the track mask is built once per process)
+  device, track_inv = track_mask(args.track, device, args.debug)
   device, track_masked = pcv.apply_mask(mask1, track_inv, 'black', device, args.debug)
   
-  # Threshold the Saturation image
-  device, fmax_thresh = pcv.binary_threshold(track_masked, 20, 255, 'light', device, args.debug)
-  
-  # Median Filter
-  device, s_mblur = pcv.median_blur(fmax_thresh, 0, device, args.debug)
-  device, s_cnt = pcv.median_blur(fmax_thresh, 0, device, args.debug)
-  
-  # Fill small objects
-  device, s_fill = pcv.fill(s_mblur, s_cnt, 5, device, args.debug)
-  device, sfill_cnt = pcv.fill(s_mblur, s_cnt, 5, device, args.debug)
+  # Threshold the Saturation image, median filter and fill small objects
+  device, sfill_cnt = plant_mask(track_masked, 20, 0, 5, device, args.debug)
   
   # Identify objects
   device, id_objects,obj_hierarchy = pcv.find_objects(mask, sfill_cnt, device, args.debug)
@@ -67,10 +56,9 @@ def main():
   # Find shape properties, output shape image (optional)
   device, shape_header,shape_data,shape_img = pcv.analyze_object(mask, args.fmax, obj, masked, device,args.debug, args.outdir+'/'+filename)
   
-  # Fluorescence Measurement (read in 16-bit images)
-  fdark=cv2.imread(args.fdark, -1)
-  fmin=cv2.imread(args.fmin, -1)
-  fmax=cv2.imread(args.fmax, -1)
+  # Fluorescence Measurement (16-bit images)
+  fdark = read_fluor(args.fdark)[0]
+  fmin = read_fluor(args.fmin)[0]
   
   device, fvfm_header, fvfm_data=pcv.fluor_fvfm(fdark,fmin,fmax,kept_mask, device, args.outdir+'/'+filename, 1000, args.debug)
 
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Cached geometry masks
+# The NIR scripts remove the car and the image edges with rectangle masks, a border mask, their union and its
+# inverse, and select plants with a rectangular ROI. These masks only depend on the image size and the fixed corner
+# coordinates of the script, so they are built once per process for each (image shape, zoom, mask spec) and handed
+# out read-only. The device counter advances by the same number of steps as the pcv calls it replaces. In debug mode
+# the masks are rebuilt with the pcv calls so that the intermediate images are printed as before.
+#
+# Usage in a pipeline:
+#   device, inv_bx1234_img = edge_mask(img, 'z500', [((128,226), (192,252)), ((1,1), (75,252))], ((1,1), (318,252)),
+#                                      device, args.debug)
+#   device, roi_img, roi_contour, roi_hierarchy = roi_rectangle(img, 'z500', (120,75), (200,226), device, args.debug)
+
+import numpy as np
+import plantcv as pcv
+
+# Masks of this process: key -> (number of pcv steps, outputs)
+_masks = {}
+
+def _read_only(value):
+  if isinstance(value, np.ndarray):
+    value.flags.writeable = False
+  elif isinstance(value, (list, tuple)):
+    for v in value:
+      _read_only(v)
+  return value
+
+def _cached(key, img, build, device, debug):
+  # build(img, device, debug) runs the pcv calls and returns (device, outputs)
+  if debug:
+    return build(img, device, debug)
+  if key not in _masks:
+    # The masks only depend on the image size
+    steps, outputs = build(np.zeros(img.shape, dtype=img.dtype), 0, False)
+    _masks[key] = (steps, _read_only(outputs))
+  steps, outputs = _masks[key]
+  return device + steps, outputs
+
+### Union of rectangle masks and a border mask, inverted (white where the image is kept)
+def edge_mask(img, zoom, rectangles, border, device, debug=False):
+  # img = image the mask is for (only its size is used)
+  # zoom = zoom (setup) label, e.g. 'z500'
+  # rectangles = list of ((x1, y1), (x2, y2)) corners for pcv.rectangle_mask
+  # border = ((x1, y1), (x2, y2)) corners for pcv.border_mask
+  rectangles = tuple((tuple(p1), tuple(p2)) for p1, p2 in rectangles)
+  border = (tuple(border[0]), tuple(border[1]))
+
+  def build(img, device, debug):
+    boxes = []
+    for p1, p2 in rectangles:
+      device, box_img, rect_contour, hierarchy = pcv.rectangle_mask(img, p1, p2, device, debug)
+      boxes.append(box_img)
+    device, box_img, rect_contour, hierarchy = pcv.border_mask(img, border[0], border[1], device, debug)
+    boxes.append(box_img)
+    combined = boxes[0]
+    for box_img in boxes[1:]:
+      device, combined = pcv.logical_or(combined, box_img, device, debug)
+    device, inverted = pcv.invert(combined, device, debug)
+    return device, inverted
+
+  key = ('edge', img.shape, zoom, rectangles, border)
+  return _cached(key, img, build, device, debug)
+
+### Rectangular region of interest (pcv.rectangle_mask outputs)
+def roi_rectangle(img, zoom, p1, p2, device, debug=False):
+  # img = image the ROI is for (only its size is used)
+  # zoom = zoom (setup) label, e.g. 'z500'
+  # p1, p2 = corners of the rectangle
+  # Returns device, ROI image, ROI contour, ROI hierarchy
+  p1 = tuple(p1)
+  p2 = tuple(p2)
+
+  def build(img, device, debug):
+    device, roi_img, roi_contour, roi_hierarchy = pcv.rectangle_mask(img, p1, p2, device, debug)
+    return device, (roi_img, roi_contour, roi_hierarchy)
+
+  key = ('roi', img.shape, zoom, p1, p2)
+  device, (roi_img, roi_contour, roi_hierarchy) = _cached(key, img, build, device, debug)
+  return device, roi_img, roi_contour, roi_hierarchy
@@ -12,9 +12,12 @@ use Time::Local;
 use POSIX qw(strftime);
 use Data::Dumper;
 use Capture::Tiny ':all';
+use IPC::Open2;
+use Storable qw(store retrieve);
+use Digest::MD5;
 
 my (%opt, $dir, $pipeline, $threads, $num, $image_dir, $sqldb, $type, %ids, $zoom_setting, $roi, $start_date, $end_date);
-our ($meta);
+our ($meta, %pending, @indexed);
 my %is_valid = (
   'vis_sv' => 1,
   'vis_tv' => 1,
@@ -23,7 +26,7 @@ my %is_valid = (
   'flu_tv' => 1
 );
 my $command = $0.' '.join(' ', @ARGV);
-getopts('d:p:t:n:i:s:T:z:m:D:rcfh', \%opt);
+getopts('d:p:t:n:i:s:T:z:m:D:rcfhwu', \%opt);
 arg_check();
 
 ## Job start time
@@ -137,6 +140,19 @@ my @run = ($ids{'run_id'}, $analysis_time, $command, $outlier_vs);
 print RUN join("\t", @run)."\n";
 ###########################################
 
+# Image index (incremental runs)
+###########################################
+my ($pipeline_md5, $params);
+if ($opt{'u'}) {
+	$dbh->do("CREATE TABLE IF NOT EXISTS `image_index` (`path` TEXT, `size` INTEGER, `mtime` INTEGER, `md5` TEXT,
+	          `pipeline_md5` TEXT, `params` TEXT, `image_id` INTEGER, `run_id` INTEGER,
+	          PRIMARY KEY (`path`, `pipeline_md5`, `params`))");
+	# Images are analyzed again when the pipeline script or its settings change
+	$pipeline_md5 = file_md5($pipeline);
+	$params = join(' ', "t=$type", "z=$zoom_setting", 'm='.($roi ? $roi.':'.file_md5($roi) : ''), "i=$image_dir");
+}
+###########################################
+
 # Read image file names
 ###########################################
 if ($opt{'f'}) {
@@ -178,6 +194,8 @@ if ($opt{'r'}) {
 } else {
 	# For each snapshot
 	while (my ($img, $mdata) = each(%{$meta})) {
+		# Skip images that were analyzed before with the same pipeline and settings
+		next if ($opt{'u'} && !image_changed($img, image_files($img, $mdata)));
 		if ($opt{'f'}) {
 			# Images are in one directory
 			my $job = job_builder($type, $pipeline, $image_dir, "'$dir/$img'", $roi);
@@ -268,6 +286,16 @@ if ($type =~ /vis/) {
   `sqlite3 -separator \$'\t' $sqldb '.import $flu_shapes flu_shapes'`;  
   `sqlite3 -separator \$'\t' $sqldb '.import $flu_signal flu_fvfm'`;  
 }
+
+# Image index: recorded after the results are imported so images of a failed run are analyzed again
+if ($opt{'u'}) {
+	$dbh->begin_work;
+	my $sth = $dbh->prepare("INSERT OR REPLACE INTO `image_index` VALUES (?, ?, ?, ?, ?, ?, ?, ?)");
+	foreach my $row (@indexed) {
+		$sth->execute(@{$row});
+	}
+	$dbh->commit;
+}
 ###########################################
 
 exit;
@@ -338,7 +366,19 @@ sub read_flat_image_dir {
 	my $type = shift;
 	my $zoom_setting = shift;
 	
+	# Directory listing of an earlier run (-u) is reused while the directory is unchanged
+	my $cache_file = index_cache_file($type, $zoom_setting);
+	my $dir_mtime = (stat($dir))[9];
+	if ($opt{'u'} && -e $cache_file) {
+		my $cache = retrieve($cache_file);
+		if ($cache->{'dir'} eq $dir && $cache->{'mtime'} == $dir_mtime) {
+			print SKIP map {$_."\n"} @{$cache->{'skipped'}};
+			return $cache->{'meta'};
+		}
+	}
+	
 	my %meta;
+	my @skipped;
 	opendir (DIR, $dir) or die "Cannot open directory $dir: $!\n\n";
 	while (my $img = readdir(DIR)) {
 		next if (substr($img,0,1) eq '.');
@@ -353,9 +393,14 @@ sub read_flat_image_dir {
 			$meta{$img}->{'lifter'} = $lifter;
 		} else {
 			print SKIP $img."\n";
+			push @skipped, $img;
 		}
 	}
 	closedir DIR;
+	
+	if ($opt{'u'}) {
+		store({'dir' => $dir, 'mtime' => $dir_mtime, 'meta' => \%meta, 'skipped' => \@skipped}, $cache_file);
+	}
 	return \%meta;
 }
 
@@ -375,7 +420,8 @@ sub read_snapshot_dir {
 	
 	my %meta;
 	# Open snapshot metadata file
-	open(CSV, "$dir/SnapshotInfo.csv") or die "Cannot open $dir/SnapshotInfo.csv: #!\n\n";
+	my $csv = "$dir/SnapshotInfo.csv";
+	open(CSV, $csv) or die "Cannot open $dir/SnapshotInfo.csv: #!\n\n";
 	# Shift off header
 	my $header = <CSV>;
 	chomp $header;
@@ -385,7 +431,22 @@ sub read_snapshot_dir {
 		$index{$header[$i]} = $i;
 	}
 	
+	# Snapshots of an earlier run (-u): SnapshotInfo.csv only grows, so parsing continues after the last line read
+	my $cache_file = index_cache_file($type, $zoom_setting);
+	if ($opt{'u'} && -e $cache_file) {
+		my $cache = retrieve($cache_file);
+		if ($cache->{'dir'} eq $dir && $cache->{'header'} eq $header && -s $csv >= $cache->{'offset'} &&
+		    file_md5($csv, $cache->{'offset'}) eq $cache->{'md5'}) {
+			%meta = %{$cache->{'meta'}};
+			seek(CSV, $cache->{'offset'}, 0);
+		}
+	}
+	
+	my $offset = tell(CSV);
 	while (my $line = <CSV>) {
+		# A line that is still being written is read again next time
+		last if ($line !~ /\n$/);
+		$offset = tell(CSV);
 		chomp $line;
 		#my ($snapshot_id, $plant_id, $car_id, $datetime, $weight_before, $weight_after, $water_vol, $completed, $measure_label, $tiles) = split /,/, $line;
 		my @fields = split /,/, $line;
@@ -403,8 +464,7 @@ sub read_snapshot_dir {
 		$month--;
 		my $epoch_time = timelocal($sec,$min,$hour,$day,$month,$year);
 		
-		# Is this snapshot within the defined date range?
-		next if ($epoch_time < $start_date || $epoch_time > $end_date);
+		# Snapshots outside of the date range are removed after reading (see below)
 		
 		my @tiles = split /;/, $tiles;
 		
@@ -425,6 +485,7 @@ sub read_snapshot_dir {
 			$meta{$matches[0]}->{'snapshot'} = $snapshot_id;
 			$meta{$matches[0]}->{'multi'} = join(',', @matches);
 			$meta{$matches[0]}->{'lifter'} = $zoom_setting;
+			$meta{$matches[0]}->{'epoch'} = $epoch_time;
 		} elsif (@matches) {
 			foreach my $tile (@matches) {
 				my @parts = split /_/, $tile;
@@ -447,14 +508,121 @@ sub read_snapshot_dir {
 				$meta{$tile}->{'plant_id'} = $plant_id;
 				$meta{$tile}->{'datetime'} = $datetime;
 				$meta{$tile}->{'snapshot'} = $snapshot_id;
+				$meta{$tile}->{'epoch'} = $epoch_time;
 			}
 		}
 	}
 	
 	close CSV;
+	if ($opt{'u'}) {
+		store({'dir' => $dir, 'header' => $header, 'offset' => $offset, 'md5' => file_md5($csv, $offset),
+		       'meta' => \%meta}, $cache_file);
+	}
+	
+	# Is this snapshot within the defined date range?
+	foreach my $tile (keys %meta) {
+		if ($meta{$tile}->{'epoch'} < $start_date || $meta{$tile}->{'epoch'} > $end_date) {
+			delete $meta{$tile};
+		}
+	}
 	return \%meta;
 }
 
+########################################
+# Function: index_cache_file
+#   File the parsed image metadata is kept
+#   in between incremental runs (-u)
+########################################
+sub index_cache_file {
+	my $type = shift;
+	my $zoom_setting = shift;
+	
+	# Without a date range only images of the zoom setting are read
+	my $selection = ($opt{'D'}) ? 'all' : 'z'.$zoom_setting;
+	return $sqldb.'.'.$type.'_'.$selection.'.index';
+}
+
+########################################
+# Function: image_files
+#   Image file(s) analyzed by a job
+########################################
+sub image_files {
+	my $img = shift;
+	my $mdata = shift;
+	
+	if ($opt{'f'}) {
+		return ("$dir/$img");
+	} elsif ($type eq 'flu_tv') {
+		return map {"$dir/snapshot$mdata->{'snapshot'}/$_.png"} split(/,/, $mdata->{'multi'});
+	}
+	return ("$dir/snapshot$mdata->{'snapshot'}/$img.png");
+}
+
+########################################
+# Function: image_changed
+#   Checks an image against the index.
+#   Files with the size and modification
+#   time of the last analysis are not
+#   read, others are compared by content
+########################################
+sub image_changed {
+	my $img = shift;
+	my @files = @_;
+	
+	my $size = 0;
+	my $mtime = 0;
+	foreach my $file (@files) {
+		my @stat = stat($file);
+		# Missing files are left to the pipeline to report
+		return 1 if (!@stat);
+		$size += $stat[7];
+		$mtime = $stat[9] if ($stat[9] > $mtime);
+	}
+	my $path = $files[0];
+	
+	my $row = $dbh->selectrow_hashref("SELECT `size`, `mtime`, `md5` FROM `image_index`
+	                                   WHERE `path` = ? AND `pipeline_md5` = ? AND `params` = ?",
+	                                  undef, $path, $pipeline_md5, $params);
+	if ($row && $row->{'size'} == $size && $row->{'mtime'} == $mtime) {
+		return 0;
+	}
+	
+	my $md5 = join(',', map {file_md5($_)} @files);
+	if ($row && $row->{'md5'} eq $md5) {
+		# Same content with a new time stamp (e.g. copied again)
+		$dbh->do("UPDATE `image_index` SET `size` = ?, `mtime` = ?
+		          WHERE `path` = ? AND `pipeline_md5` = ? AND `params` = ?",
+		         undef, $size, $mtime, $path, $pipeline_md5, $params);
+		return 0;
+	}
+	
+	$pending{$img} = {'path' => $path, 'size' => $size, 'mtime' => $mtime, 'md5' => $md5};
+	return 1;
+}
+
+########################################
+# Function: file_md5
+#   MD5 hex digest of a file (or of its
+#   first length bytes)
+########################################
+sub file_md5 {
+	my $file = shift;
+	my $length = shift;
+	
+	open(my $fh, '<', $file) or die "Cannot open file $file: $!\n\n";
+	binmode $fh;
+	my $md5 = Digest::MD5->new;
+	if (defined($length)) {
+		my $data = '';
+		read($fh, $data, $length);
+		$md5->add($data);
+	} else {
+		$md5->addfile($fh);
+	}
+	close $fh;
+	return $md5->hexdigest;
+}
+
 ########################################
 # Function: parse_filename
 #   Parses filenames from dbImportExport
@@ -503,12 +671,23 @@ sub parse_filename {
 #   Execute image processing jobs
 ########################################
 sub process {
+	# Warm pipeline worker for this thread
+	my %worker;
+	if ($opt{'w'}) {
+		start_worker(\%worker);
+	}
+	
   while (my $job = $jobq->dequeue()) {
     last if ($job eq 'EXIT');
     my $result = $job."\n";
-		my ($stdout, $stderr, $exit) = capture {
-			system($job);
-		};
+		my ($stdout, $stderr, $exit);
+		if ($opt{'w'}) {
+			($stdout, $stderr, $exit) = worker_job(\%worker, $job);
+		} else {
+			($stdout, $stderr, $exit) = capture {
+				system($job);
+			};
+		}
     #open JOB, "$job 2>> $error_log |" or die "Cannot execute job $job: $!\n\n";
     #while (my $data = <JOB>) {
     #  $result .= $data;
@@ -524,9 +703,90 @@ sub process {
 		
     $resultq->enqueue($result);
   }
+	if ($opt{'w'}) {
+		stop_worker(\%worker);
+	}
   threads->detach();
 }
 
+########################################
+# Function: start_worker
+#   Starts a persistent pipeline worker
+#   that imports the pipeline once and
+#   reads jobs from stdin
+########################################
+sub start_worker {
+	my $worker = shift;
+	
+	my ($from_worker, $to_worker);
+	my $pid = open2($from_worker, $to_worker, 'python', "$Bin/pipeline_worker.py", '-p', $pipeline);
+	binmode $from_worker;
+	$worker->{'pid'} = $pid;
+	$worker->{'in'} = $to_worker;
+	$worker->{'out'} = $from_worker;
+}
+
+########################################
+# Function: stop_worker
+#   Closes a pipeline worker
+########################################
+sub stop_worker {
+	my $worker = shift;
+	
+	close $worker->{'in'};
+	waitpid($worker->{'pid'}, 0);
+	close $worker->{'out'};
+}
+
+########################################
+# Function: worker_job
+#   Sends a job to a pipeline worker and
+#   returns stdout, stderr and exit status
+########################################
+sub worker_job {
+	my $worker = shift;
+	my $job = shift;
+	
+	# The worker takes the pipeline arguments only
+	my $job_args = $job;
+	$job_args =~ s/^python \Q$pipeline\E //;
+	
+	my $to_worker = $worker->{'in'};
+	my $from_worker = $worker->{'out'};
+	print $to_worker $job_args."\n";
+	
+	# Result header: JOB, stdout bytes, stderr bytes, exit status
+	my $header = <$from_worker>;
+	if (!defined($header)) {
+		# The worker died (e.g. segfault in OpenCV), replace it
+		waitpid($worker->{'pid'}, 0);
+		start_worker($worker);
+		return ('', "ERROR: pipeline worker exited unexpectedly\n", 1);
+	}
+	chomp $header;
+	my ($tag, $out_bytes, $err_bytes, $exit) = split /\t/, $header;
+	my $stdout = read_bytes($from_worker, $out_bytes);
+	my $stderr = read_bytes($from_worker, $err_bytes);
+	
+	return ($stdout, $stderr, $exit);
+}
+
+########################################
+# Function: read_bytes
+#   Reads an exact number of bytes
+########################################
+sub read_bytes {
+	my $fh = shift;
+	my $length = shift;
+	
+	my $data = '';
+	while (length($data) < $length) {
+		my $read = read($fh, $data, $length - length($data), length($data));
+		last if (!$read);
+	}
+	return $data;
+}
+
 ########################################
 # Function: process_results
 ########################################
@@ -650,6 +910,13 @@ sub process_results {
     return;
   }
   print SNAP join("\t", @snap)."\n";
+	
+	# Remember the image for the index
+	if ($opt{'u'} && exists($pending{$image})) {
+		my $file = $pending{$image};
+		push @indexed, [$file->{'path'}, $file->{'size'}, $file->{'mtime'}, $file->{'md5'}, $pipeline_md5, $params,
+		                $image_id, $ids{'run_id'}];
+	}
 }
 
 ########################################
@@ -933,7 +1200,7 @@ sub arg_error {
     print STDERR $error."\n";
   }
   my $usage = "
-usage: image_analysis.pl -d DIR [-f] -p PIPELINE -t TYPE -s DB -z ZOOM [-i DIR] [-T THREADS] [-r] [-n NUM] [-c] [-m ROI] [-h]
+usage: image_analysis.pl -d DIR [-f] -p PIPELINE -t TYPE -s DB -z ZOOM [-i DIR] [-T THREADS] [-w] [-u] [-r] [-n NUM] [-c] [-m ROI] [-h]
 
 Multi-threaded execution of a plantcv image processing pipeline with
 specific or randomly selected images.
@@ -947,6 +1214,10 @@ arguments:
   -s DB                 SQLite database file name.
   -i DIR                Output directory for images. Not required by all pipelines, Default = cwd;
   -T THREADS            Number of threads/CPU to use. Default = 1.
+  -w                    Run the pipeline in one persistent worker per thread (pipeline_worker.py) instead of
+                        starting a new python process for every image.
+  -u                    Update: only analyze images that are new or changed since the last run with the same
+                        pipeline and settings (image index kept in the database).
   -r                    Select a random set of images from the input directory.
   -n NUM                Number of random images to test. Only used with -r. Default = 10.
   -c                    Create output database (SQLite). Default behaviour adds to existing database.
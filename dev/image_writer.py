@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+# Asynchronous writing of debug and analysis images
+# With -D/--debug every pcv step writes its image (1_hsv_saturation.png, 2_binary_threshold20.png, ...) and with
+# -w/--writeimg analyze_object, analyze_bound, analyze_color and analyze_NIR_intensity write their shape, boundary and
+# pseudocolored images, all through pcv.print_image and all on the critical path of the image. install() replaces
+# print_image in plantcv (and in the plantcv modules that imported it) by a function that copies the image and hands
+# it to a pool of writer threads through a bounded queue (cv2.imwrite releases the GIL, so the encoding runs next to
+# the pipeline; a full queue makes the pipeline wait instead of holding more copies). The queue is flushed when the
+# process exits. The histogram plots of the analysis functions are saved by matplotlib/ggplot and are still written
+# synchronously.
+#
+# Output can be reduced to some kinds of images and to about one image job in N (chosen by image name, so the same
+# images are picked in every run and by every worker):
+#   kinds: debug (numbered step images), shapes, boundary, pseudo, hist, mask, other
+#
+# Asynchronous writing is off unless PLANTCV_IMAGE_THREADS is set. The persistent worker and the batch runner turn it
+# on for every image they run:
+#   python pipeline_batch.py -p vis_sv_z2500_L2.py -i snapshots/ -o outdir -a '-w' -W 2 -C 1 -K shapes -E 10
+#   PLANTCV_IMAGE_THREADS=2 PLANTCV_PNG_COMPRESSION=1 python pipeline_worker.py -p vis_sv_z2500_L2.py
+# Run a script once with asynchronous writing:
+#   python image_writer.py -p vis_sv_z2500_L2.py -a '-i snapshot.png -o outdir -D' -t 2 -k debug
+
+import argparse
+import sys, os
+import re
+import shlex
+import zlib
+import atexit
+import threading
+import multiprocessing.util
+import cv2
+import numpy as np
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+ANALYSIS_KINDS = ('shapes', 'boundary', 'pseudo', 'hist', 'mask')
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Run a pipeline script once with asynchronous image writing.")
+  parser.add_argument("-p", "--pipeline", help="Pipeline script file.", required=True)
+  parser.add_argument("-a", "--args", help="Arguments passed to the pipeline.", default="")
+  parser.add_argument("-t", "--threads", help="Writer threads (0 writes synchronously).", type=int, default=1)
+  parser.add_argument("-c", "--compression", help="PNG compression level (0-9). Default: OpenCV's.", type=int,
+                      required=False)
+  parser.add_argument("-k", "--kinds", help="Only write these kinds of images (comma-separated).", required=False)
+  args = parser.parse_args()
+  return args
+
+### Kind of an output image: 'debug' for the numbered step images, otherwise from the suffix of the analysis image
+def image_kind(filename):
+  name = os.path.splitext(os.path.basename(filename))[0]
+  if re.match(r'\d+_', name):
+    return 'debug'
+  for kind in ANALYSIS_KINDS:
+    if '_' + kind in name:
+      return kind
+  return 'other'
+
+class ImageWriter(object):
+  # threads = writer threads (0 writes in the calling thread)
+  # compression = PNG compression level 0-9 (None for the OpenCV default)
+  # kinds = kinds of images written (None for all)
+  # every = write the images of one image job in this many
+  # queue_size = images waiting to be written (each one is a copy)
+  def __init__(self, threads=1, compression=None, kinds=None, every=1, queue_size=8):
+    if compression is not None and not 0 <= compression <= 9:
+      raise ValueError("PNG compression level " + str(compression) + " is not between 0 and 9")
+    self.compression = compression
+    self.kinds = set(kinds) if kinds else None
+    self.every = max(int(every), 1)
+    self.selected = True
+    self.errors = []
+    self.written = 0
+    self.skipped = 0
+    self.queue = queue.Queue(maxsize=queue_size)
+    self.threads = []
+    for i in range(threads):
+      thread = threading.Thread(target=self._run, name='image-writer-' + str(i))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  ### Start the images of an image job (selects one job in every)
+  def start_image(self, image):
+    self.selected = self.every == 1 or zlib.crc32(str(image).encode('utf-8')) % self.every == 0
+
+  ### pcv.print_image replacement
+  def print_image(self, img, filename):
+    if not self.selected or (self.kinds is not None and image_kind(filename) not in self.kinds):
+      self.skipped += 1
+      return
+    if not self.threads:
+      self._write(img, filename)
+      return
+    # The pipeline may change the array after the call (pcv.fill fills in place)
+    self.queue.put((np.copy(img), filename))
+
+  def _params(self, filename):
+    if self.compression is not None and filename.lower().endswith('.png'):
+      return [cv2.IMWRITE_PNG_COMPRESSION, self.compression]
+    return []
+
+  def _write(self, img, filename):
+    try:
+      if cv2.imwrite(filename, img, self._params(filename)):
+        self.written += 1
+      else:
+        self.errors.append((filename, 'not written'))
+    except Exception as e:
+      self.errors.append((filename, str(e)))
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None:
+          return
+        self._write(*item)
+      finally:
+        self.queue.task_done()
+
+  ### Wait for the queued images, returns and clears the failed writes as (filename, error)
+  def flush(self):
+    self.queue.join()
+    errors = self.errors
+    self.errors = []
+    return errors
+
+  ### Flush and stop the writer threads
+  def close(self):
+    errors = self.flush()
+    for thread in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+    self.threads = []
+    return errors
+
+# Writer of this process
+_writer = {'writer': None}
+
+### Route pcv.print_image through a writer
+def install(threads=1, compression=None, kinds=None, every=1, queue_size=8):
+  import plantcv as pcv
+  if _writer['writer'] is not None:
+    return _writer['writer']
+  writer = ImageWriter(threads, compression, kinds, every, queue_size)
+  # The plantcv modules call the print_image they imported, plantcv itself may hold a profiled wrapper of it
+  originals = set([id(pcv.print_image), id(getattr(pcv.print_image, '__wrapped__', pcv.print_image))])
+  for name, module in list(sys.modules.items()):
+    if module is not None and (name == 'plantcv' or name.startswith('plantcv.')) and \
+        id(getattr(module, 'print_image', None)) in originals:
+      setattr(module, 'print_image', print_image)
+  _writer['writer'] = writer
+  # Pool workers leave through os._exit, which skips atexit
+  atexit.register(close)
+  multiprocessing.util.Finalize(None, close, exitpriority=10)
+  return writer
+
+### Turn asynchronous writing on if PLANTCV_IMAGE_THREADS is set
+def install_from_env():
+  threads = os.getenv('PLANTCV_IMAGE_THREADS')
+  if threads and _writer['writer'] is None:
+    compression = os.getenv('PLANTCV_PNG_COMPRESSION')
+    kinds = os.getenv('PLANTCV_IMAGE_KINDS')
+    install(int(threads), int(compression) if compression else None, kinds.split(',') if kinds else None,
+            int(os.getenv('PLANTCV_IMAGE_EVERY', 1)))
+  return _writer['writer'] is not None
+
+def active():
+  return _writer['writer'] is not None
+
+### pcv.print_image of the installed writer (a plain function, so pipeline_profile can time it)
+def print_image(img, filename):
+  _writer['writer'].print_image(img, filename)
+
+### Start the images of an image job
+def start_image(job_args):
+  # job_args = pipeline arguments, the image is the value of -i/--image
+  image = ' '.join(job_args)
+  for i, arg in enumerate(job_args[:-1]):
+    if arg in ('-i', '--image'):
+      image = job_args[i + 1]
+  _writer['writer'].start_image(image)
+
+### Write out the queued images and stop the writer
+def close():
+  # Later images are written synchronously
+  writer = _writer['writer']
+  if writer is None:
+    return
+  for filename, error in writer.close():
+    sys.stderr.write('image_writer: ' + filename + ': ' + error + '\n')
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  # pipeline_worker writes through the imported module, not this __main__ one
+  import image_writer
+  from pipeline_worker import load_pipeline, run_job
+  image_writer.install(args.threads, args.compression, args.kinds.split(',') if args.kinds else None)
+  module = load_pipeline(args.pipeline)
+  stdout, stderr, status, elapsed = run_job(module, shlex.split(args.args))
+  image_writer.close()
+  sys.stdout.write(stdout)
+  sys.stderr.write(stderr)
+  if status:
+    sys.exit(status)
+
+if __name__ == '__main__':
+  main()
@@ -8,6 +8,7 @@ import numpy as np
 import argparse
 import string
 import plantcv as pcv
+from object_table import label_objects, write_object_masks
 
 
 def options():
@@ -54,14 +55,9 @@ def main():
   # Decide which objects to keep
   device,roi_objects, roi_obj_hierarchy, kept_mask, obj_area = pcv.roi_objects(img,'partial',roi,roi_hierarchy,id_objects,obj_hierarchy,device, args.debug)
   
-  for i in range(0, len(roi_objects)):
-    # Object combine kept objects
-    device, obj, mask = pcv.object_composition(img, [roi_objects[i]], np.array([[roi_obj_hierarchy[0][i]]]), 
-                                            device, args.debug)
-
-    y=i+1
-    maskname=(str(args.outdir)+"/"+str(filename[:-4])+"-mask-"+str(y)+".jpg")
-    pcv.print_image(mask,maskname)
+  # Write a mask per kept object, cropped to its bounding box
+  objects = label_objects(kept_mask)
+  write_object_masks(objects, str(args.outdir) + "/" + str(filename[:-4]) + "-mask-")
   
 if __name__ == '__main__':
   main()
@@ -1,50 +1,104 @@
 #!/usr/bin/env python
 
+# Leaf scan runner
+# Runs a leaf-scan pipeline (e.g. leafscan-rebekah-chitwood-masks.py) over the scans of a directory with a pool of
+# worker processes (see pipeline_batch.py). Images that finished are appended to a manifest in the output directory,
+# so an interrupted run started again with the same output directory only runs the images that are not done yet.
+# Delete the manifest to run everything again.
+#
+# Usage:
+#   python leafscan-rebekah-chitwood-shell-build.py -d /path/to/scans/ -p leafscan-rebekah-chitwood-masks.py -o outdir
+#   python leafscan-rebekah-chitwood-shell-build.py -d /path/to/scans/ -p leafscan-rebekah-chitwood-masks.py -o outdir -s
+#     (only write the old outdir/leafscan.sh)
+
 import argparse
 import sys, os
-import re
-import shutil
-import numpy as np
+import time
+import multiprocessing
+from pipeline_batch import find_images, image_args, run_batch, report
+
+# Flatbed scans (.jpg/.jpeg, any case)
+SCAN_PATTERN = r'\.jpe?g$'
 
 ### Parse command-line arguments
 def options():
-  parser = argparse.ArgumentParser(description="Get file names to run cufflinks over")
-  parser.add_argument("-d", "--directory", help="directory to run script over.")
-  parser.add_argument("-p", "--pipeline", help="directory to run script over.")
-  parser.add_argument("-o", "--outdir", help="directory to run script over.")
+  parser = argparse.ArgumentParser(description="Run a leaf-scan pipeline over a directory of scans.")
+  parser.add_argument("-d", "--directory", help="Directory of scan images.", required=True)
+  parser.add_argument("-p", "--pipeline", help="Pipeline script file.", required=True)
+  parser.add_argument("-o", "--outdir", help="Output directory.", required=True)
+  parser.add_argument("-m", "--manifest", help="Manifest of finished images. Default: <outdir>/leafscan.done",
+                      required=False)
+  parser.add_argument("-r", "--result", help="File for the pipeline output. Default: stdout.", required=False)
+  parser.add_argument("-n", "--processes", help="Number of worker processes. Default: number of CPUs.", type=int,
+                      default=multiprocessing.cpu_count())
+  parser.add_argument("-e", "--every", help="Print progress every N images.", type=int, default=25)
+  parser.add_argument("-s", "--shell", help="Only write <outdir>/leafscan.sh with one pipeline command per image.",
+                      action="store_true")
   args = parser.parse_args()
   return args
 
-def build_leafscan(directory,pipeline,outdir):
-    dirs=os.listdir(directory)
-    files=[]
-    path=[]
-    
-    for x in dirs:
-      if re.search('.jpg',x):
-        b=str(directory)+str(x)
-        path.append(b)
-            
-    for i,a in enumerate(path):
-      b=(str(pipeline)+" -i "+str(a)+" -o "+str(outdir))      
-      files.append(b)
-      print(b)
-            
-    files1='\n'.join(files)
-    
-    shellname=str(outdir)+"/leafscan.sh"
-    fwrite=os.open(shellname,os.O_RDWR|os.O_CREAT)
-    os.write(fwrite,files1)
-    os.close(fwrite)
-    
+### Write the list of pipeline commands as a shell script
+def build_leafscan(directory, pipeline, outdir):
+  files = []
+  for image in find_images(directory, SCAN_PATTERN):
+    b = str(pipeline) + " -i " + image + " -o " + str(outdir)
+    files.append(b)
+    print(b)
+
+  shellname = str(outdir) + "/leafscan.sh"
+  with open(shellname, 'w') as f:
+    f.write('\n'.join(files))
+
+### Images finished by earlier runs
+def read_manifest(path):
+  if not os.path.exists(path):
+    return set()
+  with open(path) as f:
+    return set(line.rstrip('\n') for line in f if line.strip())
+
+### Run the pipeline over the scans that are not in the manifest yet
+def run_leafscan(directory, pipeline, outdir, manifest, processes=None, out=sys.stdout, every=25):
+  images = [os.path.abspath(image) for image in find_images(directory, SCAN_PATTERN)]
+  done = read_manifest(manifest)
+  todo = [image for image in images if image not in done]
+  sys.stderr.write(str(len(images)) + ' scans, ' + str(len(images) - len(todo)) + ' already done, ' +
+                   str(len(todo)) + ' to run\n')
+  jobs = [(image, image_args(image, outdir)) for image in todo]
+  progress = {'count': 0, 'start': time.time()}
+
+  with open(manifest, 'a') as finished:
+    def record(image, status):
+      # Only images that finished without errors are skipped next time
+      if status == 0:
+        finished.write(image + '\n')
+        finished.flush()
+      progress['count'] += 1
+      if progress['count'] % every == 0 or progress['count'] == len(jobs):
+        elapsed = time.time() - progress['start']
+        sys.stderr.write(str(progress['count']) + '/' + str(len(jobs)) + ' scans, ' +
+                         '%.2f' % (progress['count'] / elapsed) + ' images/sec\n')
+    return run_batch(pipeline, jobs, processes, out, callback=record)
 
 ### Main pipeline
 def main():
   # Get options
   args = options()
-  
-  build_leafscan(args.directory,args.pipeline,args.outdir)
-  
+
+  if not os.path.exists(args.outdir):
+    os.makedirs(args.outdir)
+  if args.shell:
+    build_leafscan(args.directory, args.pipeline, args.outdir)
+    return
+
+  manifest = args.manifest or os.path.join(args.outdir, 'leafscan.done')
+  if args.result:
+    with open(args.result, 'a') as out:
+      stats = run_leafscan(args.directory, args.pipeline, args.outdir, manifest, args.processes, out, args.every)
+  else:
+    stats = run_leafscan(args.directory, args.pipeline, args.outdir, manifest, args.processes, every=args.every)
+  report(stats)
+  if stats['failed']:
+    sys.exit(1)
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  main()
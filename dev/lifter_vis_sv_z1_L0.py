@@ -5,6 +5,7 @@ import numpy as np
 import argparse
 import string
 import plantcv as pcv
+from roi_filter import RoiFilter
 
 ### Parse command-line arguments
 def options():
@@ -53,10 +54,13 @@ def main():
   # Apply mask (for vis images, mask_color=white)
   device, masked2 = pcv.apply_mask(masked, ab_fill, 'white', device, args.debug)
   
+  # Label the objects of ab_fill once for the three ROIs below (each counts the find_objects step it replaces)
+  objects = RoiFilter(ab_fill)
+  
   # Select area with black bars and find overlapping plant material
   device, roi1, roi_hierarchy1= pcv.define_roi(masked2,'rectangle', device, None, 'default', args.debug,True, 0, 0,-1700,0)
-  device, id_objects1,obj_hierarchy1 = pcv.find_objects(masked2, ab_fill, device, args.debug)
-  device,roi_objects1, hierarchy1, kept_mask1, obj_area1 = pcv.roi_objects(masked2,'cutto',roi1,roi_hierarchy1,id_objects1,obj_hierarchy1,device, args.debug)
+  device += 1
+  device,roi_objects1, hierarchy1, kept_mask1, obj_area1 = objects.roi_objects(masked2,'cutto',roi1,roi_hierarchy1,device, args.debug)
   device, masked3 = pcv.apply_mask(masked2, kept_mask1, 'white', device, args.debug)
   device, masked_a1 = pcv.rgb2gray_lab(masked3, 'a', device, args.debug)
   device, masked_b1 = pcv.rgb2gray_lab(masked3, 'b', device, args.debug)
@@ -68,8 +72,8 @@ def main():
 
   
   device, roi2, roi_hierarchy2= pcv.define_roi(masked2,'rectangle', device, None, 'default', args.debug,True, 1700, 0,0,0)
-  device, id_objects2,obj_hierarchy2 = pcv.find_objects(masked2, ab_fill, device, args.debug)
-  device,roi_objects2, hierarchy2, kept_mask2, obj_area2 = pcv.roi_objects(masked2,'cutto',roi2,roi_hierarchy2,id_objects2,obj_hierarchy2,device, args.debug)
+  device += 1
+  device,roi_objects2, hierarchy2, kept_mask2, obj_area2 = objects.roi_objects(masked2,'cutto',roi2,roi_hierarchy2,device, args.debug)
   device, masked4 = pcv.apply_mask(masked2, kept_mask2, 'white', device, args.debug)
   device, masked_a2 = pcv.rgb2gray_lab(masked4, 'a', device, args.debug)
   device, masked_b2 = pcv.rgb2gray_lab(masked4, 'b', device, args.debug)
@@ -82,14 +86,14 @@ def main():
   device, ab_cnt3 = pcv.logical_or(ab_fill1, ab_fill2, device, args.debug)
   device, masked3 = pcv.apply_mask(masked2, ab_cnt3, 'white', device, args.debug)
   
-  # Identify objects
-  device, id_objects3,obj_hierarchy3 = pcv.find_objects(masked2, ab_fill, device, args.debug)
+  # Identify objects (labeled above)
+  device += 1
 
   # Define ROI
   device, roi3, roi_hierarchy3= pcv.define_roi(masked2,'rectangle', device, None, 'default', args.debug,True, 650, 0,-650,-120)
  
   # Decide which objects to keep and combine with objects overlapping with black bars
-  device,roi_objects3, hierarchy3, kept_mask3, obj_area1 = pcv.roi_objects(img,'cutto',roi3,roi_hierarchy3,id_objects3,obj_hierarchy3,device, args.debug)
+  device,roi_objects3, hierarchy3, kept_mask3, obj_area1 = objects.roi_objects(img,'cutto',roi3,roi_hierarchy3,device, args.debug)
   device, kept_mask4 = pcv.logical_or(ab_cnt3, kept_mask3, device, args.debug)
   device, masked5 = pcv.apply_mask(masked2, kept_mask4, 'white', device, args.debug)
   device, masked5_a = pcv.rgb2gray_lab(masked5, 'a', device, args.debug)
@@ -98,9 +102,10 @@ def main():
   device, masked5_a_fill = pcv.fill(masked5_a_thresh, masked5_a_cnt, 200, device, args.debug)
   device, masked5_mblur = pcv.median_blur(masked5_a_fill, 7, device, args.debug)
 
-  device, id_objects4,obj_hierarchy4 = pcv.find_objects(masked5, masked5_mblur, device, args.debug)
+  objects4 = RoiFilter(masked5_mblur)
+  device += 1
   device, roi4, roi_hierarchy4= pcv.define_roi(masked2,'rectangle', device, None, 'default', args.debug,False, 0, 0,0,0)
-  device,roi_objects4, hierarchy4, kept_mask4, obj_area = pcv.roi_objects(img,'partial',roi4,roi_hierarchy4,id_objects4,obj_hierarchy4,device, args.debug)
+  device,roi_objects4, hierarchy4, kept_mask4, obj_area = objects4.roi_objects(img,'partial',roi4,roi_hierarchy4,device, args.debug)
 
  # Object combine kept objects
   device, obj, mask = pcv.object_composition(img, roi_objects4, hierarchy4, device, args.debug)
@@ -8,6 +8,7 @@ import numpy as np
 import argparse
 import string
 import plantcv as pcv
+from object_table import label_objects, object_table
 
 
 def options():
@@ -52,18 +53,12 @@ def main():
                                                                                   'detect', 3600, 950, -200, -1700,
                                                                                   'white', 'dark', 's', 110)
   
-  shape_header = []
-  table = []
+  # Measure every kept object in one pass over the labeled mask
+  objects = label_objects(kept_mask)
+  shape_header, table = object_table(objects)
+  for row in table:
+    print(row[2])
   
-  for i in range(0, len(roi_objects)):
-    # Object combine kept objects
-    device, obj, mask = pcv.object_composition(img, [roi_objects[i]], np.array([[roi_obj_hierarchy[0][i]]]), 
-                                            device, args.debug)
-    if obj is not None:
-        device, shape_header, shape_data, shape_img = pcv.analyze_object(img, args.image, obj, mask, device, args.debug)
-        table.append(shape_data)
-        print(shape_data[1])
-
   # Save results to file
   results = open("TestQuinoaArea.txt", 'w')
   results.write('\t'.join(map(str, shape_header)) + '\n')
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Fused NIR edge sharpening and directional erosion
+# The NIR pipelines find plant edges with a chain of full-frame steps (see reference_chain): Laplacian sharpening,
+# Sobel x + y, a median blur of size 1, inversion, adding the two, a 'dark' threshold, four erosions with 3x3
+# directional kernels and three logical_or merges. The histogram-equalized image computed at the start is only
+# plotted. sharpened_edges gives the same binary image in a few passes with reused scratch buffers:
+#   edges = (img - laplacian) + ~(sobel_x + sobel_y)   (8-bit wrap-around, as the pcv adds and subtracts)
+#   mask = edges <= threshold
+#   mask = mask & (any of its 4 neighbours)              (the union of the four directional erosions)
+#
+# Equivalence check against the pcv chain:
+#   python nir_edges.py --check NIR_SV_0_z500_*.png -t 145
+
+import argparse
+import sys
+import cv2
+import numpy as np
+import plantcv as pcv
+
+# pcv steps replaced by sharpened_edges (HistEqualization, laplace, subtract, 2 x sobel, add, median blur, invert, add,
+# threshold, 4 x erode, 3 x logical_or)
+STEPS = 17
+
+# 4-neighbourhood without the center pixel
+_NEIGHBOURS = np.array([[0, 1, 0], [1, 0, 1], [0, 1, 0]], dtype=np.uint8)
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Check the fused NIR edge mask against the pcv chain.")
+  parser.add_argument("--check", help="NIR images to compare.", nargs="+", required=True)
+  parser.add_argument("-t", "--threshold", help="Threshold of the sharpened image.", type=int, default=145)
+  args = parser.parse_args()
+  return args
+
+# Scratch buffers of this process by image shape
+_buffers = {}
+
+def _scratch(shape):
+  if shape not in _buffers:
+    _buffers[shape] = [np.empty(shape, dtype=np.uint8) for i in range(3)]
+  return _buffers[shape]
+
+### Binary edge mask of a grayscale NIR image, fused
+def fused_edges(img, threshold):
+  # img = 8-bit grayscale image
+  # threshold = 'dark' threshold of the sharpened image (pixels <= threshold are kept)
+  lap, sbx, sby = _scratch(img.shape)
+  cv2.Laplacian(img, -1, dst=lap, ksize=1, scale=1)
+  cv2.Sobel(img, -1, 1, 0, dst=sbx, ksize=1, scale=1)
+  cv2.Sobel(img, -1, 0, 1, dst=sby, ksize=1, scale=1)
+  # Inverted Sobel sum plus the Laplacian sharpened image
+  np.add(sbx, sby, out=sbx)
+  np.invert(sbx, out=sbx)
+  np.subtract(img, lap, out=lap)
+  np.add(sbx, lap, out=sbx)
+  mask = cv2.threshold(sbx, threshold, 255, cv2.THRESH_BINARY_INV)[1]
+  # Keep pixels with a kept 4-neighbour (pixels outside the image count as kept, as in cv2.erode)
+  cv2.dilate(mask, _NEIGHBOURS, dst=sby, borderType=cv2.BORDER_CONSTANT, borderValue=255)
+  return cv2.bitwise_and(mask, sby)
+
+### The pcv chain the NIR pipelines used
+def reference_chain(img, threshold, device, debug=False):
+  device, he_img = pcv.HistEqualization(img, device, debug)
+  if debug:
+    pcv.plot_hist(he_img, 'hist_img_he')
+  device, lp_img = pcv.laplace_filter(img, 1, 1, device, debug)
+  if debug:
+    pcv.plot_hist(lp_img, 'hist_lp')
+  device, lp_shrp_img = pcv.image_subtract(img, lp_img, device, debug)
+  if debug:
+    pcv.plot_hist(lp_shrp_img, 'hist_lp_shrp')
+  device, sbx_img = pcv.sobel_filter(img, 1, 0, 1, 1, device, debug)
+  if debug:
+    pcv.plot_hist(sbx_img, 'hist_sbx')
+  device, sby_img = pcv.sobel_filter(img, 0, 1, 1, 1, device, debug)
+  if debug:
+    pcv.plot_hist(sby_img, 'hist_sby')
+  device, sb_img = pcv.image_add(sbx_img, sby_img, device, debug)
+  if debug:
+    pcv.plot_hist(sb_img, 'hist_sb_comb_img')
+  device, mblur_img = pcv.median_blur(sb_img, 1, device, debug)
+  device, mblur_invert_img = pcv.invert(mblur_img, device, debug)
+  device, edge_shrp_img = pcv.image_add(mblur_invert_img, lp_shrp_img, device, debug)
+  if debug:
+    pcv.plot_hist(edge_shrp_img, 'hist_edge_shrp_img')
+  device, tr_es_img = pcv.binary_threshold(edge_shrp_img, threshold, 255, 'dark', device, debug)
+
+  kern = np.zeros((3,3), dtype=np.uint8)
+  kern1 = np.copy(kern)
+  kern1[1,1:3]=1
+  kern2 = np.copy(kern)
+  kern2[1,0:2]=1
+  kern3 = np.copy(kern)
+  kern3[0:2,1]=1
+  kern4 = np.copy(kern)
+  kern4[1:3,1]=1
+  device, e1_img = pcv.erode(tr_es_img, kern1, 1, device, debug)
+  device, e2_img = pcv.erode(tr_es_img, kern2, 1, device, debug)
+  device, e3_img = pcv.erode(tr_es_img, kern3, 1, device, debug)
+  device, e4_img = pcv.erode(tr_es_img, kern4, 1, device, debug)
+  device, c12_img = pcv.logical_or(e1_img, e2_img, device, debug)
+  device, c123_img = pcv.logical_or(c12_img, e3_img, device, debug)
+  device, c1234_img = pcv.logical_or(c123_img, e4_img, device, debug)
+  return device, c1234_img
+
+### Pipeline step: edge sharpening, threshold and directional erosion
+def sharpened_edges(img, threshold, device, debug=False):
+  # img = 8-bit grayscale NIR image
+  # threshold = 'dark' threshold of the sharpened image
+  # In debug mode the pcv chain is run so that the intermediate images and histograms are printed
+  if debug:
+    return reference_chain(img, threshold, device, debug)
+  return device + STEPS, fused_edges(img, threshold)
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  failed = 0
+  for image in args.check:
+    img = cv2.imread(image, flags=0)
+    if img is None:
+      pcv.fatal_error('Failed to open ' + str(image))
+    device, expected = reference_chain(img, args.threshold, 0)
+    result = fused_edges(img, args.threshold)
+    diff = np.count_nonzero(expected != result)
+    print(image + '\t' + ('ok' if diff == 0 else str(diff) + ' pixels differ'))
+    if diff:
+      failed += 1
+  if failed:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
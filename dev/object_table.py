@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Multi-object analysis from labeled connected components
+# Seed and leaf scans keep hundreds of objects. Running pcv.object_composition and pcv.analyze_object (or
+# pcv.print_image) on the full image for every object costs objects x image size. Here the kept mask is labeled once
+# (8-connected, the same neighbourhood as the contours pcv finds) and every object is measured in its bounding box:
+# area, hull, solidity and perimeter of its outer contour as in pcv.analyze_object, plus the pixel area, bounding box
+# and center of mass. One table row per object. Objects are numbered in label order (top to bottom, left to right
+# by their first pixel).
+#
+# Usage in a pipeline:
+#   device, roi_objects, roi_obj_hierarchy, kept_mask, obj_area = pcv.roi_objects(img, 'partial', ...)
+#   objects = label_objects(kept_mask)
+#   header, rows = object_table(objects)
+#   write_object_masks(objects, args.outdir + '/' + filename[:-4] + '-mask-')
+
+import cv2
+import numpy as np
+import plantcv as pcv
+
+HEADER = ('HEADER_OBJECTS', 'object', 'area', 'pixel_area', 'hull-area', 'solidity', 'perimeter', 'x', 'y', 'width',
+          'height', 'center-of-mass-x', 'center-of-mass-y', 'hull_vertices')
+
+class LabeledObjects(object):
+  # mask = binary mask of the kept objects
+  # min_size = drop objects with fewer pixels
+  def __init__(self, mask, min_size=0):
+    if len(np.shape(mask)) != 2:
+      pcv.fatal_error('The object mask must be a binary (single channel) image!')
+    count, self.labels, stats, centroids = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8),
+                                                                              connectivity=8)
+    # Label 0 is the background
+    self.ids = [i for i in range(1, count) if stats[i, cv2.CC_STAT_AREA] > min_size]
+    self.stats = stats
+    self.centroids = centroids
+
+  def __len__(self):
+    return len(self.ids)
+
+  ### Bounding box (x, y, width, height) of an object
+  def box(self, label):
+    s = self.stats[label]
+    return (int(s[cv2.CC_STAT_LEFT]), int(s[cv2.CC_STAT_TOP]), int(s[cv2.CC_STAT_WIDTH]), int(s[cv2.CC_STAT_HEIGHT]))
+
+  ### Mask of an object cropped to its bounding box
+  def crop(self, label):
+    x, y, w, h = self.box(label)
+    return np.where(self.labels[y:y + h, x:x + w] == label, 255, 0).astype(np.uint8)
+
+  ### Outer contour of an object in image coordinates
+  def contour(self, label):
+    x, y, w, h = self.box(label)
+    found = cv2.findContours(self.crop(label), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(x, y))
+    # OpenCV 2/4 return (contours, hierarchy), OpenCV 3 returns (image, contours, hierarchy)
+    contours = found[-2]
+    # A connected component has one outer contour
+    return max(contours, key=len)
+
+### Label the kept objects once
+def label_objects(mask, min_size=0):
+  return LabeledObjects(mask, min_size)
+
+### Shape measurements of every object, returns (header, list of rows)
+def object_table(objects):
+  rows = []
+  for number, label in enumerate(objects.ids, 1):
+    cnt = objects.contour(label)
+    x, y, w, h = objects.box(label)
+    area = cv2.contourArea(cnt)
+    hull = cv2.convexHull(cnt)
+    hull_area = cv2.contourArea(hull)
+    solidity = area / hull_area if hull_area > 0 else 1
+    perimeter = cv2.arcLength(cnt, True)
+    m = cv2.moments(cnt)
+    if m['m00'] > 0:
+      cmx = m['m10'] / m['m00']
+      cmy = m['m01'] / m['m00']
+    else:
+      # Lines and single pixels have no contour area
+      cmx, cmy = [float(v) for v in objects.centroids[label]]
+    rows.append(('OBJECT_DATA', number, area, int(objects.stats[label, cv2.CC_STAT_AREA]), hull_area, solidity,
+                 perimeter, x, y, w, h, cmx, cmy, len(hull)))
+  return HEADER, rows
+
+### Write a cropped mask image per object (<prefix><object number>.jpg)
+def write_object_masks(objects, prefix, extension='.jpg'):
+  names = []
+  for number, label in enumerate(objects.ids, 1):
+    name = prefix + str(number) + extension
+    pcv.print_image(objects.crop(label), name)
+    names.append(name)
+  return names
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# Batch mode for pipeline scripts
+# Runs a pipeline script (any script with a main() that takes -i/--image) over a directory, a glob pattern or a
+# manifest file (one image path per line) with a pool of worker processes. Each worker imports the pipeline once
+# (see pipeline_worker.py) and calls main() per image. The output of the jobs is collected by the parent process,
+# which is the only writer of the results file.
+#
+# Usage:
+#   python pipeline_batch.py -p vis_sv_z2500_L2.py -i /path/to/snapshots/ -o /path/to/outdir -r results.txt
+#   python pipeline_batch.py -p vis_sv_z2500_L2.py -i '/path/to/snapshots/*z2500*.png' -o outdir -n 8
+#   python pipeline_batch.py -p nir_sv_z2500_L2-brachy.py -i images.txt -o outdir -a '-r nir_results.txt'
+#   python pipeline_batch.py -p vis_sv_z2500_L2.py -i snapshots/ -o outdir -P trace.jsonl   (pcv step profiling)
+#   python pipeline_batch.py -p vis_sv_z2500_L2.py -i snapshots/ -o outdir -a '-w' -W 2 -K shapes -E 10
+#     (shape images of one image in ten, written by 2 background threads per worker; see image_writer.py)
+#
+# At the end the throughput (images/sec) and per-image latency percentiles are printed to stderr.
+
+import argparse
+import sys, os, traceback
+import re
+import glob
+import shlex
+import time
+import multiprocessing
+import numpy as np
+from pipeline_worker import load_pipeline, run_job
+
+IMAGE_PATTERN = r'\.(png|jpe?g|tiff?)$'
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Run a plantcv pipeline script over many images with a process pool.")
+  parser.add_argument("-p", "--pipeline", help="Pipeline script file.", required=True)
+  parser.add_argument("-i", "--input", help="Image directory, glob pattern or file with one image path per line.", required=True)
+  parser.add_argument("-o", "--outdir", help="Output directory passed to the pipeline (-o).", required=False)
+  parser.add_argument("-r", "--result", help="Results file for the pipeline output. Default: stdout.", required=False)
+  parser.add_argument("-a", "--args", help="Extra arguments passed to the pipeline for every image.", default="")
+  parser.add_argument("-n", "--processes", help="Number of worker processes. Default: number of CPUs.", type=int,
+                      default=multiprocessing.cpu_count())
+  parser.add_argument("-x", "--pattern", help="Regular expression for image file names in a directory.",
+                      default=IMAGE_PATTERN)
+  parser.add_argument("-P", "--profile", help="Trace the pcv steps of every image to this file (see pipeline_profile.py).",
+                      required=False)
+  parser.add_argument("-W", "--image-threads", help="Write debug and analysis images with this many background threads "
+                      "per worker (see image_writer.py).", type=int, required=False)
+  parser.add_argument("-C", "--compression", help="PNG compression level (0-9) of the images written in the background.",
+                      type=int, required=False)
+  parser.add_argument("-K", "--kinds", help="Only write these kinds of images in the background (comma-separated: "
+                      "debug, shapes, boundary, pseudo, hist, mask, other).", required=False)
+  parser.add_argument("-E", "--every", help="Only write the images of one image in this many.", type=int, default=1)
+  args = parser.parse_args()
+  return args
+
+### List the images of a directory, glob pattern or manifest file
+def find_images(source, pattern=IMAGE_PATTERN):
+  if os.path.isdir(source):
+    regex = re.compile(pattern, re.IGNORECASE)
+    return sorted(os.path.join(source, f) for f in os.listdir(source) if regex.search(f))
+  if os.path.isfile(source):
+    images = []
+    with open(source) as f:
+      for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+          images.append(line)
+    return images
+  images = sorted(glob.glob(source))
+  if not images:
+    raise IOError("No images found for " + str(source))
+  return images
+
+### Pipeline arguments for one image
+def image_args(image, outdir=None, extra=()):
+  job_args = ['-i', image]
+  if outdir:
+    job_args.extend(['-o', outdir])
+  return job_args + list(extra)
+
+# Pipeline module of a worker process, or the error that kept it from loading
+_module = None
+_load_error = None
+
+def _init_worker(pipeline):
+  global _module, _load_error
+  # An initializer that raises makes the pool start a new worker forever, the jobs fail instead
+  try:
+    _module = load_pipeline(pipeline)
+  except Exception:
+    _load_error = traceback.format_exc()
+
+def _run_image(job):
+  image, job_args = job
+  if _load_error is not None:
+    return image, '', _load_error, 1, 0.0
+  stdout, stderr, status, elapsed = run_job(_module, job_args)
+  return image, stdout, stderr, status, elapsed
+
+### Run a pipeline over a list of (image, pipeline arguments) jobs
+def run_batch(pipeline, jobs, processes=None, out=sys.stdout, err=sys.stderr, callback=None):
+  # pipeline = pipeline script file
+  # jobs = list of (image, argument list) pairs
+  # processes = pool size (default: number of CPUs)
+  # out, err = where the job output goes; only this process writes to them
+  # callback = optional function called with (image, status) after each job is written
+  # Returns a dictionary of batch statistics (see report)
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+  # A script that does not load fails here, before any worker starts
+  load_pipeline(pipeline, from_env=False)
+  latencies = []
+  failed = []
+  start = time.time()
+  pool = multiprocessing.Pool(processes, _init_worker, (os.path.abspath(pipeline),))
+  try:
+    for image, stdout, stderr, status, elapsed in pool.imap_unordered(_run_image, jobs, chunksize=1):
+      latencies.append(elapsed)
+      if stdout:
+        out.write(stdout)
+      if stderr:
+        err.write(''.join(str(image) + ': ' + line + '\n' for line in stderr.rstrip('\n').split('\n')))
+      if status != 0:
+        failed.append(image)
+      if callback is not None:
+        callback(image, status)
+    pool.close()
+  except BaseException:
+    # Interrupted or failed while writing the output: stop the workers without running the remaining jobs
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  out.flush()
+  return {'images': len(latencies), 'failed': failed, 'processes': processes, 'wall': time.time() - start,
+          'latencies': latencies}
+
+### Throughput and latency summary of a batch
+def report(stats, out=sys.stderr):
+  wall = stats['wall']
+  out.write('images: ' + str(stats['images']) + ', failed: ' + str(len(stats['failed'])) +
+            ', processes: ' + str(stats['processes']) + ', wall time: ' + '%.2f' % wall + ' s\n')
+  if stats['images'] == 0:
+    return
+  latencies = np.array(stats['latencies'])
+  p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+  out.write('throughput: ' + '%.2f' % (stats['images'] / wall) + ' images/sec\n')
+  out.write('latency (s): mean ' + '%.3f' % latencies.mean() + ', p50 ' + '%.3f' % p50 + ', p90 ' + '%.3f' % p90 +
+            ', p99 ' + '%.3f' % p99 + ', max ' + '%.3f' % latencies.max() + '\n')
+  for image in stats['failed']:
+    out.write('  failed: ' + str(image) + '\n')
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  images = find_images(args.input, args.pattern)
+  extra = shlex.split(args.args)
+  jobs = [(image, image_args(image, args.outdir, extra)) for image in images]
+  if args.profile:
+    # The workers turn profiling on when they load the pipeline
+    open(args.profile, 'w').close()
+    os.environ['PLANTCV_PROFILE'] = os.path.abspath(args.profile)
+  if args.image_threads is not None:
+    # The workers write their images in the background, and finish writing before they exit
+    os.environ['PLANTCV_IMAGE_THREADS'] = str(args.image_threads)
+    os.environ['PLANTCV_IMAGE_EVERY'] = str(args.every)
+    if args.compression is not None:
+      os.environ['PLANTCV_PNG_COMPRESSION'] = str(args.compression)
+    if args.kinds:
+      os.environ['PLANTCV_IMAGE_KINDS'] = args.kinds
+
+  if args.result:
+    with open(args.result, 'w') as out:
+      stats = run_batch(args.pipeline, jobs, args.processes, out)
+  else:
+    stats = run_batch(args.pipeline, jobs, args.processes)
+  report(stats)
+  if args.profile:
+    from pipeline_profile import summarize
+    summarize([args.profile], sys.stderr, 10)
+  if stats['failed']:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,524 @@
+#!/usr/bin/env python
+
+# Declarative pipelines
+# A pipeline definition (JSON, or YAML when PyYAML is installed) lists pcv steps; a parameter table holds the values
+# that differ between zoom/lighting variants. The definition is compiled into an execution plan per variant:
+#   1. parameters ($name) are substituted
+#   2. steps repeated with identical inputs become copies of the first result
+#   3. adjacent pixel-wise steps (rgb2gray_hsv/rgb2gray_lab -> binary_threshold -> logical_or/logical_and, also on
+#      white/black masked copies of an image) are fused into one RGB lookup table (threshold_lut.py)
+#   4. steps whose outputs are never used are dropped
+#   5. values are released after their last use and their buffers reused by later copies and lookups
+# Copies, lookups and the steps after them keep the device numbers of the steps they replace, so debug images are
+# numbered as in the script.
+#
+# Definition format:
+#   {"name": "vis_sv",
+#    "params": {"s_threshold": 36, ...},                                   (defaults)
+#    "steps": [{"out": "s", "op": "rgb2gray_hsv", "args": ["@img", "s"]},
+#              {"out": ["roi1", "roi_hierarchy"], "op": "define_roi",
+#               "args": ["@masked2", "rectangle", "#device", null, "default", "#debug", true, 0, 0, 0, "$roi_h"]},
+#              {"op": "print_results", "args": ["@image", "@shape_header", "@shape_data"], "device": false}, ...]}
+# "@name" refers to an earlier output or to a runtime input (img, image, filename, outfile), "$name" to a parameter
+# (also allowed as "op"; a parameter value may itself be an "@name" reference). Device and debug are appended to the arguments unless placed with "#device"/"#debug",
+# steps with "device": false get neither and do not return a device number. "outputs" lists values that are kept
+# even when no step uses them.
+#
+# Parameter table format:
+#   {"defaults": {...}, "variants": {"z2500_L1": {"match": "z2500", "params": {...}}, ...}}
+# The variant is given with -v or picked by the first "match" regular expression found in the image file name.
+#
+# Usage:
+#   python pipeline_plan.py -p pipelines/vis_sv.json -t pipelines/vis_sv_params.json -i image.png -o outdir
+#   python pipeline_plan.py -p pipelines/vis_sv.json -t pipelines/vis_sv_params.json -v z2500_L1 --show
+# Check that the compiled plan gives the values and device numbers of the steps as written:
+#   python pipeline_plan.py -p pipelines/plan_check.json -i image.png --check
+# Compiled plans are kept per process, so running this script through pipeline_worker.py compiles each variant once.
+
+import argparse
+import sys, os
+import re
+import json
+from collections import OrderedDict
+import numpy as np
+import plantcv as pcv
+from threshold_lut import load_lut
+
+try:
+  import yaml
+except ImportError:
+  yaml = None
+try:
+  string_types = basestring
+except NameError:
+  string_types = str
+
+# Steps whose only effect is output
+SINK_OPS = set(['print_results'])
+# Arguments (by position) that a pcv function modifies in place
+MUTATES = {
+  'fill': (0, 1),
+  'find_objects': (1,)
+}
+# Outputs that are the same object as an argument (output index: argument index)
+ALIASES = {
+  'fill': {0: 0}
+}
+RUNTIME_INPUTS = ('img', 'image', 'filename', 'outfile')
+GRAY_OPS = {'rgb2gray_hsv': 'hsv', 'rgb2gray_lab': 'lab'}
+LOGICAL_OPS = {'logical_or': 'or', 'logical_and': 'and'}
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Run a declarative plantcv pipeline.")
+  parser.add_argument("-p", "--pipeline", help="Pipeline definition file (JSON or YAML).", required=True)
+  parser.add_argument("-t", "--table", help="Parameter table file (JSON or YAML).", required=False)
+  parser.add_argument("-v", "--variant", help="Parameter table variant. Default: first variant matching the image name.", required=False)
+  parser.add_argument("-i", "--image", help="Input image file.", required=False)
+  parser.add_argument("-o", "--outdir", help="Output directory for image files.", required=False)
+  parser.add_argument("-D", "--debug", help="Turn on debug, prints intermediate images.", action="store_true")
+  parser.add_argument("--show", help="Print the compiled plan.", action="store_true")
+  parser.add_argument("--check", help="Compare the compiled plan with the steps as written.", action="store_true")
+  args = parser.parse_args()
+  if not args.image and not args.show:
+    parser.error("an input image (-i) is required unless --show is used")
+  return args
+
+### Read a JSON or YAML file, keeping the order of mappings
+def read_document(path):
+  with open(path) as f:
+    if path.endswith(('.yaml', '.yml')):
+      if yaml is None:
+        pcv.fatal_error('PyYAML is required to read ' + str(path))
+      return yaml.safe_load(f)
+    return json.load(f, object_pairs_hook=OrderedDict)
+
+### Choose the parameters for an image
+def select_params(definition, table, variant=None, image=None):
+  params = dict(definition.get('params', {}))
+  if table is None:
+    return None, params
+  params.update(table.get('defaults', {}))
+  variants = table.get('variants', {})
+  if variant is None and image is not None:
+    name = os.path.basename(image)
+    for v, entry in variants.items():
+      if 'match' in entry and re.search(entry['match'], name):
+        variant = v
+        break
+  if variant is None:
+    pcv.fatal_error('No parameter table variant selected for ' + str(image))
+  if variant not in variants:
+    pcv.fatal_error('Variant ' + str(variant) + ' is not in the parameter table')
+  params.update(variants[variant].get('params', {}))
+  return variant, params
+
+class Ref(object):
+  # Reference to a value computed by an earlier step (or a runtime input)
+  def __init__(self, name):
+    self.name = name
+
+  def __repr__(self):
+    return '@' + self.name
+
+DEVICE = '#device'
+DEBUG = '#debug'
+
+class Step(object):
+  def __init__(self, op, args, outs, device=True, kwargs=None):
+    self.op = op
+    self.args = args
+    self.outs = outs
+    self.device = device
+    self.kwargs = kwargs or {}
+    # Set by the compiler
+    self.func = None
+    self.lut = None
+    self.note = ''
+    # Device steps of the definition this step stands for (dropped steps are counted by the next kept step)
+    self.steps = 1
+
+  def refs(self):
+    return [a.name for a in list(self.args) + list(self.kwargs.values()) if isinstance(a, Ref)]
+
+  def __repr__(self):
+    outs = ', '.join(self.outs) if self.outs else '-'
+    text = outs + ' = ' + self.op + '(' + ', '.join(repr(a) for a in self.args) + ')'
+    if self.note:
+      text += '  # ' + self.note
+    if self.steps > 1:
+      text += '  (' + str(self.steps) + ' steps)'
+    return text
+
+### Substitute parameters and build steps
+def parse_steps(definition, params):
+  def value(v):
+    if isinstance(v, string_types) and v.startswith('$'):
+      if v[1:] not in params:
+        pcv.fatal_error('Parameter ' + v[1:] + ' is not defined')
+      v = params[v[1:]]
+    if isinstance(v, string_types) and v.startswith('@'):
+      return Ref(v[1:])
+    if isinstance(v, list):
+      return tuple(value(x) for x in v)
+    return v
+
+  steps = []
+  for s in definition['steps']:
+    outs = s.get('out', [])
+    if not isinstance(outs, list):
+      outs = [outs]
+    kwargs = dict((k, value(v)) for k, v in s.get('kwargs', {}).items())
+    steps.append(Step(value(s['op']), [value(a) for a in s.get('args', [])], outs, s.get('device', True), kwargs))
+  return steps
+
+### Plan compiler
+def compile_plan(definition, params, outputs=(), optimize=True):
+  # outputs = values kept besides the ones used by steps (default: the "outputs" of the definition)
+  # optimize = False runs the steps as written (see --check)
+  outputs = tuple(outputs) + tuple(definition.get('outputs', ()))
+  steps = parse_steps(definition, params)
+  _check_refs(steps)
+  if optimize:
+    steps = _eliminate_common_steps(steps)
+    steps = _fuse_pixelwise(steps)
+    steps = _drop_unused(steps, outputs)
+  for step in steps:
+    if step.func is None:
+      if not hasattr(pcv, step.op):
+        pcv.fatal_error('plantcv has no function ' + str(step.op))
+      step.func = getattr(pcv, step.op)
+  return Plan(steps, _last_uses(steps, outputs))
+
+def _check_refs(steps):
+  known = set(RUNTIME_INPUTS)
+  for step in steps:
+    for name in step.refs():
+      if name not in known:
+        pcv.fatal_error('Step ' + repr(step) + ' uses ' + name + ' before it is defined')
+    known.update(step.outs)
+
+### Value versions: a value changes when a step modifies it (or anything it aliases) in place
+class _Versions(object):
+  def __init__(self):
+    self.root = {}
+    self.version = {}
+
+  def key(self, name):
+    root = self.root.get(name, name)
+    return (root, self.version.get(root, 0))
+
+  def record(self, step):
+    for i in MUTATES.get(step.op, ()):
+      if i < len(step.args) and isinstance(step.args[i], Ref):
+        root = self.root.get(step.args[i].name, step.args[i].name)
+        self.version[root] = self.version.get(root, 0) + 1
+    for o, name in enumerate(step.outs):
+      alias = ALIASES.get(step.op, {}).get(o)
+      if alias is not None and isinstance(step.args[alias], Ref):
+        self.root[name] = self.root.get(step.args[alias].name, step.args[alias].name)
+      else:
+        self.root[name] = name
+        self.version[name] = 0
+
+def _arg_key(arg, versions):
+  if isinstance(arg, Ref):
+    return ('ref',) + versions.key(arg.name)
+  if isinstance(arg, tuple):
+    return ('tuple',) + tuple(_arg_key(a, versions) for a in arg)
+  return ('value', arg)
+
+### Repeated steps with unchanged inputs become copies of the first result
+def _eliminate_common_steps(steps):
+  versions = _Versions()
+  seen = {}
+  out = []
+  for step in steps:
+    key = None
+    if step.device and step.op not in SINK_OPS and len(step.outs) == 1 and step.op not in ALIASES:
+      key = (step.op, tuple(_arg_key(a, versions) for a in step.args),
+             tuple(sorted((k, _arg_key(v, versions)) for k, v in step.kwargs.items())))
+    if key is not None and key in seen:
+      first, first_version = seen[key]
+      if versions.key(first) == first_version:
+        copy = Step('copy', [Ref(first)], step.outs)
+        copy.func = _copy
+        copy.note = 'repeat of ' + step.op + ', copied'
+        out.append(copy)
+        versions.record(copy)
+        continue
+    out.append(step)
+    versions.record(step)
+    if key is not None:
+      seen[key] = (step.outs[0], versions.key(step.outs[0]))
+  return out
+
+### Fuse pixel-wise threshold chains into lookup tables
+def _fuse_pixelwise(steps):
+  producers = {}
+  for i, step in enumerate(steps):
+    for name in step.outs:
+      producers[name] = i
+  consumers = _consumers(steps)
+  versions = _Versions()
+  snapshots = []
+  for step in steps:
+    snapshots.append(dict((name, versions.key(name)) for name in step.refs()))
+    versions.record(step)
+
+  # Single thresholds of a color channel
+  fused = {}
+  for i, step in enumerate(steps):
+    if step.op != 'binary_threshold' or len(step.args) != 4 or not isinstance(step.args[0], Ref):
+      continue
+    channel, threshold, max_value, object_type = step.args
+    if max_value != 255 or channel.name not in producers:
+      continue
+    gray = steps[producers[channel.name]]
+    if gray.op not in GRAY_OPS or len(gray.args) != 2 or not isinstance(gray.args[0], Ref):
+      continue
+    source = _pixel_source(gray.args[0].name, producers, steps, snapshots, i)
+    if source is None:
+      continue
+    term = {'space': GRAY_OPS[gray.op], 'channel': gray.args[1], 'threshold': threshold, 'object_type': object_type}
+    fused[i] = (source, None, [term])
+
+  # Joins of thresholds of the same source
+  for i, step in enumerate(steps):
+    if step.op not in LOGICAL_OPS or len(step.args) != 2:
+      continue
+    parts = []
+    for arg in step.args:
+      if not isinstance(arg, Ref) or arg.name not in producers or producers[arg.name] not in fused:
+        break
+      j = producers[arg.name]
+      if consumers[arg.name] != [i]:
+        break
+      parts.append(fused[j])
+    if len(parts) != 2 or parts[0][0] != parts[1][0]:
+      continue
+    combine = LOGICAL_OPS[step.op]
+    if any(p[1] not in (None, combine) for p in parts):
+      continue
+    fused[i] = (parts[0][0], combine, parts[0][2] + parts[1][2])
+
+  out = []
+  for i, step in enumerate(steps):
+    if i in fused:
+      (image, mask, color), combine, terms = fused[i]
+      lut_step = Step('lut_threshold', [Ref(image), Ref(mask) if mask else None, color], step.outs)
+      lut_step.lut = load_lut({'combine': combine or 'and', 'thresholds': terms})
+      lut_step.func = lut_step.lut.apply
+      lut_step.note = (' ' + (combine or 'and') + ' ').join(_term_text(t) for t in terms)
+      out.append(lut_step)
+    else:
+      out.append(step)
+  return out
+
+def _term_text(term):
+  return '%s %s %s %s' % (term['space'], term['channel'], '>' if term['object_type'] == 'light' else '<=',
+                          term['threshold'])
+
+### Image, mask and mask color a pixel-wise step sees, or None
+def _pixel_source(name, producers, steps, snapshots, at):
+  if name not in producers:
+    # A runtime input image
+    return (name, None, 'white') if name == 'img' else None
+  step = steps[producers[name]]
+  if step.op == 'apply_mask' and len(step.args) == 3 and all(isinstance(a, Ref) for a in step.args[:2]):
+    image, mask, color = step.args
+    if color not in ('white', 'black'):
+      return None
+    # The image and mask must not have changed between apply_mask and the threshold
+    before = snapshots[producers[name]]
+    now = snapshots[at]
+    for ref in (image.name, mask.name):
+      if ref in now and before.get(ref) != now[ref]:
+        return None
+    if image.name in producers and steps[producers[image.name]].op == 'apply_mask':
+      # Masks of masks are not fused
+      return None
+    return (image.name, mask.name, color)
+  return (name, None, 'white')
+
+def _consumers(steps):
+  consumers = {}
+  for i, step in enumerate(steps):
+    for name in step.refs():
+      consumers.setdefault(name, []).append(i)
+  return consumers
+
+### Drop steps that do not contribute to output
+def _drop_unused(steps, outputs):
+  needed = set(outputs)
+  keep = [False] * len(steps)
+  for i in range(len(steps) - 1, -1, -1):
+    step = steps[i]
+    if step.op in SINK_OPS or not step.device or any(o in needed for o in step.outs):
+      keep[i] = True
+      needed.update(step.refs())
+  # The device numbers of dropped steps (e.g. the thresholds of a fused lookup) go to the next kept step
+  out = []
+  dropped = 0
+  for step, k in zip(steps, keep):
+    if k:
+      if step.device:
+        step.steps += dropped
+        dropped = 0
+      out.append(step)
+    elif step.device:
+      dropped += step.steps
+  return out
+
+### Index of the last step that reads each value
+def _last_uses(steps, outputs):
+  last = {}
+  for i, step in enumerate(steps):
+    for name in step.refs():
+      last[name] = i
+    for name in step.outs:
+      last.setdefault(name, i)
+  for name in outputs:
+    last[name] = len(steps)
+  return last
+
+def _copy(src, out=None):
+  if out is None:
+    return np.copy(src)
+  np.copyto(out, src)
+  return out
+
+class Plan(object):
+  def __init__(self, steps, last_uses):
+    self.steps = steps
+    self.last_uses = last_uses
+
+  def __repr__(self):
+    return '\n'.join(str(i + 1) + ': ' + repr(s) for i, s in enumerate(self.steps))
+
+  ### Execute the plan on one image
+  def run(self, inputs, debug=False, trace=None):
+    # trace = optional dictionary filled with (device, copy of the value) of every step output
+    env = dict(inputs)
+    pool = {}
+    device = 0
+    for i, step in enumerate(self.steps):
+      if step.device:
+        # Steps that stand for dropped steps number their output as the last of them
+        device += step.steps - 1
+      args = [self._value(a, env, device, debug) for a in step.args]
+      kwargs = dict((k, self._value(v, env, device, debug)) for k, v in step.kwargs.items())
+      if step.op in ('copy', 'lut_threshold'):
+        # Runtime steps write into a released buffer of the right size and type when there is one (only 8-bit
+        # masks are released, so copies of color images get a new array)
+        if step.op == 'copy':
+          key = (args[0].shape, args[0].dtype.str)
+        else:
+          key = (args[0].shape[:2], np.dtype(np.uint8).str)
+        buf = pool.get(key)
+        kwargs['out'] = buf.pop() if buf else None
+        results = [step.func(*args, **kwargs)]
+        device += 1
+        if debug:
+          pcv.print_image(results[0], str(device) + '_' + step.op + '.png')
+      elif step.device:
+        if DEVICE not in step.args:
+          args = args + [device, debug]
+        out = step.func(*args, **kwargs)
+        device, results = out[0], list(out[1:])
+      else:
+        step.func(*args, **kwargs)
+        results = []
+      for name, result in zip(step.outs, results):
+        env[name] = result
+        if trace is not None:
+          trace[name] = (device, np.copy(result) if isinstance(result, np.ndarray) else result)
+      self._release(i, env, pool)
+    return env
+
+  def _value(self, arg, env, device, debug):
+    if isinstance(arg, Ref):
+      return env[arg.name]
+    if isinstance(arg, tuple):
+      return tuple(self._value(a, env, device, debug) for a in arg)
+    if arg == DEVICE:
+      return device
+    if arg == DEBUG:
+      return debug
+    return arg
+
+  ### Release values after their last use, keeping 8-bit masks for reuse
+  def _release(self, i, env, pool):
+    for name in [n for n in env if self.last_uses.get(n, -1) == i and n not in RUNTIME_INPUTS]:
+      value = env.pop(name)
+      if not isinstance(value, np.ndarray) or value.dtype != np.uint8 or value.ndim != 2:
+        continue
+      # Buffers still reachable through another name (e.g. pcv.fill returns its input) are not reused
+      if any(isinstance(v, np.ndarray) and np.may_share_memory(v, value) for v in env.values()):
+        continue
+      pool.setdefault((value.shape, value.dtype.str), []).append(value)
+
+# Compiled plans of this process
+_plans = {}
+
+### Compiled plan for a definition, parameter table and variant
+def get_plan(pipeline, table=None, variant=None, image=None, optimize=True):
+  definition = read_document(pipeline)
+  params_table = read_document(table) if table else None
+  variant, params = select_params(definition, params_table, variant, image)
+  key = (os.path.abspath(pipeline), os.path.getmtime(pipeline), table and os.path.abspath(table),
+         table and os.path.getmtime(table), variant, optimize)
+  if key not in _plans:
+    _plans[key] = compile_plan(definition, params, optimize=optimize)
+  return variant, _plans[key]
+
+### Values of the compiled plan that differ from the steps as written, as (name, reason)
+def check_plan(compiled, plain, inputs):
+  expected = {}
+  result = {}
+  plain.run(inputs, False, expected)
+  compiled.run(inputs, False, result)
+  differences = []
+  for name in sorted(result):
+    if name not in expected:
+      continue
+    (device, value), (expected_device, expected_value) = result[name], expected[name]
+    if device != expected_device:
+      differences.append((name, 'device ' + str(device) + ', expected ' + str(expected_device)))
+    elif isinstance(value, np.ndarray) and not (isinstance(expected_value, np.ndarray) and
+                                                value.shape == expected_value.shape and
+                                                np.array_equal(value, expected_value)):
+      differences.append((name, 'value differs'))
+  return differences
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  variant, plan = get_plan(args.pipeline, args.table, args.variant, args.image)
+  if args.show:
+    print('# variant: ' + str(variant))
+    print(plan)
+    if not args.image:
+      return
+
+  # Read image
+  img, path, filename = pcv.readimage(args.image)
+  outfile = False
+  if args.outdir:
+    outfile = args.outdir + '/' + filename
+  inputs = {'img': img, 'image': args.image, 'filename': filename, 'outfile': outfile}
+  if args.check:
+    plain = get_plan(args.pipeline, args.table, variant, args.image, optimize=False)[1]
+    differences = check_plan(plan, plain, inputs)
+    for name, reason in differences:
+      print(name + '\t' + reason)
+    print(args.image + '\t' + ('ok' if not differences else str(len(differences)) + ' values differ'))
+    if differences:
+      sys.exit(1)
+    return
+  plan.run(inputs, args.debug)
+
+if __name__ == '__main__':
+  main()
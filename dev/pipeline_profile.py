@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+# Per-step profiling of pipeline scripts
+# Wraps every function of the plantcv module, so each pcv.* call a pipeline makes is recorded as a step: wall time,
+# CPU time, bytes of the array arguments and results, and the peak memory allocated during the step (numpy arrays,
+# including the ones OpenCV returns, through tracemalloc; OpenCV's internal scratch buffers are not seen). Calls that
+# pcv functions make to each other are part of the outer step. Each image is one line of a JSON-lines trace file:
+#   {"image": ..., "pipeline": ..., "pid": ..., "status": ..., "wall": ..., "steps": [{"step": 1, "device": 1,
+#    "function": "rgb2gray_hsv", "wall": ..., "cpu": ..., "in_bytes": ..., "out_bytes": ..., "peak_bytes": ...,
+#    "maxrss_kb": ...}, ...]}
+#
+# Profiling is off unless PLANTCV_PROFILE names a trace file. The persistent worker and the batch runner turn it on
+# for every image they run:
+#   python pipeline_batch.py -p vis_sv_z2500_L2.py -i snapshots/ -o outdir -P trace.jsonl
+#   PLANTCV_PROFILE=trace.jsonl python pipeline_worker.py -p vis_sv_z2500_L2.py
+# Profile a single run of a script:
+#   python pipeline_profile.py -t trace.jsonl -p vis_sv_z2500_L2.py -a '-i snapshot.png -o outdir'
+# Hot steps of a run (one or more trace files):
+#   python pipeline_profile.py -s trace.jsonl -n 20
+
+import argparse
+import sys, os
+import json
+import time
+import shlex
+import functools
+import types
+import numpy as np
+try:
+  import tracemalloc
+except ImportError:
+  # Python 2
+  tracemalloc = None
+try:
+  import resource
+except ImportError:
+  resource = None
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Profile the pcv steps of a pipeline script, or summarize traces.")
+  parser.add_argument("-t", "--trace", help="Trace file (JSON lines) to append to.", required=False)
+  parser.add_argument("-p", "--pipeline", help="Pipeline script file to run once under profiling.", required=False)
+  parser.add_argument("-a", "--args", help="Arguments passed to the pipeline.", default="")
+  parser.add_argument("-s", "--summary", help="Trace files to summarize.", nargs="+", required=False)
+  parser.add_argument("-n", "--top", help="Number of hot steps to list.", type=int, default=20)
+  args = parser.parse_args()
+  if not args.summary and not (args.trace and args.pipeline):
+    parser.error("give a trace (-t) and pipeline (-p) to profile, or traces to summarize (-s)")
+  return args
+
+# Profiler state of this process
+_state = {'path': None, 'image': None, 'pipeline': None, 'start': None, 'steps': [], 'depth': 0}
+
+def _cpu_time():
+  return time.process_time() if hasattr(time, 'process_time') else time.clock()
+
+def _maxrss():
+  # Kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+
+### Bytes of the arrays in a value (arrays, lists and tuples of arrays)
+def _nbytes(value, depth=0):
+  if isinstance(value, np.ndarray):
+    return int(value.nbytes)
+  if isinstance(value, (list, tuple)) and depth < 3:
+    return sum(_nbytes(v, depth + 1) for v in value)
+  return 0
+
+def _wrap(name, func):
+  @functools.wraps(func)
+  def step(*args, **kwargs):
+    # Only the outermost pcv call of an image job is a step
+    if _state['depth'] > 0 or _state['image'] is None:
+      return func(*args, **kwargs)
+    _state['depth'] += 1
+    if tracemalloc is not None and hasattr(tracemalloc, 'reset_peak'):
+      tracemalloc.reset_peak()
+      before = tracemalloc.get_traced_memory()[0]
+    else:
+      before = None
+    wall = time.time()
+    cpu = _cpu_time()
+    try:
+      out = func(*args, **kwargs)
+    finally:
+      _state['depth'] -= 1
+    wall = time.time() - wall
+    cpu = _cpu_time() - cpu
+    peak = tracemalloc.get_traced_memory()[1] - before if before is not None else None
+    # pcv steps return (device, outputs...)
+    device = out[0] if isinstance(out, tuple) and out and isinstance(out[0], int) else None
+    _state['steps'].append({'step': len(_state['steps']) + 1, 'device': device, 'function': name, 'wall': wall,
+                            'cpu': cpu, 'in_bytes': _nbytes(args) + _nbytes(tuple(kwargs.values())),
+                            'out_bytes': _nbytes(out), 'peak_bytes': peak, 'maxrss_kb': _maxrss()})
+    return out
+  step._profiled = True
+  return step
+
+### Wrap the plantcv functions and write traces to path
+def install(path):
+  import plantcv as pcv
+  _state['path'] = os.path.abspath(path)
+  for name in dir(pcv):
+    func = getattr(pcv, name)
+    if name.startswith('_') or not isinstance(func, types.FunctionType) or getattr(func, '_profiled', False):
+      continue
+    setattr(pcv, name, _wrap(name, func))
+  if tracemalloc is not None and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+### Turn profiling on if PLANTCV_PROFILE is set
+def install_from_env():
+  path = os.getenv('PLANTCV_PROFILE')
+  if path and _state['path'] is None:
+    install(path)
+  return _state['path'] is not None
+
+def active():
+  return _state['path'] is not None
+
+### Start the trace of an image
+def start_image(job_args, pipeline=None):
+  # job_args = pipeline arguments, the image is the value of -i/--image
+  image = ' '.join(job_args)
+  for i, arg in enumerate(job_args[:-1]):
+    if arg in ('-i', '--image'):
+      image = job_args[i + 1]
+  _state['image'] = image
+  _state['pipeline'] = os.path.basename(pipeline) if pipeline else None
+  _state['start'] = time.time()
+  _state['steps'] = []
+
+### Write the trace of the current image
+def finish_image(status=None):
+  if _state['image'] is None:
+    return
+  record = {'image': _state['image'], 'pipeline': _state['pipeline'], 'pid': os.getpid(), 'status': status,
+            'wall': time.time() - _state['start'], 'steps': _state['steps']}
+  line = (json.dumps(record) + '\n').encode('utf-8')
+  # One append per image, so the workers of a batch can share the trace file
+  fd = os.open(_state['path'], os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+  try:
+    os.write(fd, line)
+  finally:
+    os.close(fd)
+  _state['image'] = None
+  _state['steps'] = []
+
+### Read the image traces of one or more files
+def read_traces(paths):
+  for path in paths:
+    with open(path) as f:
+      for line in f:
+        if line.strip():
+          yield json.loads(line)
+
+### Hot steps of a run: time and memory per (pipeline, step, function), hottest first
+def summarize(paths, out=sys.stdout, top=20):
+  steps = {}
+  images = 0
+  total = 0.0
+  for trace in read_traces(paths):
+    images += 1
+    for s in trace['steps']:
+      key = (trace['pipeline'], s['step'], s['function'])
+      steps.setdefault(key, []).append(s)
+      total += s['wall']
+  out.write('images: ' + str(images) + ', time in pcv steps: ' + '%.2f' % total + ' s\n')
+  rows = []
+  for (pipeline, step, function), records in steps.items():
+    wall = np.array([r['wall'] for r in records])
+    cpu = sum(r['cpu'] for r in records)
+    peaks = [r['peak_bytes'] for r in records if r['peak_bytes'] is not None]
+    rows.append((wall.sum(), pipeline, step, function, len(records), wall.mean(), np.percentile(wall, 90), cpu,
+                 max(peaks) if peaks else None, max(r['out_bytes'] for r in records)))
+  rows.sort(key=lambda r: -r[0])
+  out.write('\t'.join(('pipeline', 'step', 'function', 'calls', 'total_s', 'share', 'mean_s', 'p90_s', 'cpu_s',
+                       'peak_mb', 'out_mb')) + '\n')
+  for wall, pipeline, step, function, calls, mean, p90, cpu, peak, out_bytes in rows[:top]:
+    out.write('\t'.join((str(pipeline), str(step), function, str(calls), '%.3f' % wall,
+                         '%.1f%%' % (100.0 * wall / total if total else 0), '%.4f' % mean, '%.4f' % p90, '%.3f' % cpu,
+                         '%.1f' % (peak / 1048576.0) if peak is not None else '-', '%.1f' % (out_bytes / 1048576.0))) +
+              '\n')
+
+  # The same per function over all the steps that call it
+  functions = {}
+  for wall, pipeline, step, function, calls, mean, p90, cpu, peak, out_bytes in rows:
+    functions[function] = functions.get(function, 0.0) + wall
+  out.write('by function:\n')
+  for function, wall in sorted(functions.items(), key=lambda f: -f[1])[:top]:
+    out.write('  ' + function + '\t' + '%.3f' % wall + ' s\t' + '%.1f%%' % (100.0 * wall / total if total else 0) +
+              '\n')
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  if args.summary:
+    summarize(args.summary, top=args.top)
+    return
+
+  # pipeline_worker traces through the imported module, not this __main__ one
+  import pipeline_profile
+  from pipeline_worker import load_pipeline, run_job
+  pipeline_profile.install(args.trace)
+  module = load_pipeline(args.pipeline)
+  stdout, stderr, status, elapsed = run_job(module, shlex.split(args.args))
+  sys.stdout.write(stdout)
+  sys.stderr.write(stderr)
+  if status:
+    sys.exit(status)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,100 @@
+# Pipeline execution layer with common-subexpression elimination
+# Records every pcv step (function and arguments). When a step is repeated with identical arguments, for example
+# the second pcv.median_blur/pcv.binary_threshold call that only exists to give pcv.fill a throwaway copy, a copy
+# of the first result is returned instead of running the function again.
+#
+# Usage:
+#   steps = PipelineSteps(args.debug)
+#   s_mblur = steps.run(pcv.median_blur, s_thresh, 5)
+#   s_cnt = steps.run(pcv.median_blur, s_thresh, 5)    # copy of s_mblur, not recomputed
+#   steps.report()
+#
+# The device counter is threaded through the calls: positional arguments are followed by device and debug, keyword
+# arguments are passed as keywords (e.g. filename= for the analysis functions).
+# Steps whose debug argument is not last (pcv.define_roi) are called directly and hand the counter back:
+#   steps.device, roi1, roi_hierarchy = pcv.define_roi(masked2, 'rectangle', steps.device, None, 'default', args.debug, ...)
+#
+# Array arguments are matched by content (shape, dtype and checksums), so a step whose input was modified in place
+# (pcv.fill fills its input) is not mistaken for an earlier call. Results are stored as private copies for the
+# same reason.
+
+import sys
+import time
+import zlib
+import numpy as np
+
+class PipelineSteps(object):
+  # debug = passed to every pcv step
+  # device = starting device number
+  def __init__(self, debug=False, device=0):
+    self.debug = debug
+    self.device = device
+    self.cache = {}
+    self.steps = []
+    self.saved = 0.0
+    self.overhead = 0.0
+    # Arguments matched by identity are kept alive so their id() is not reused
+    self.pinned = []
+
+  ### Run (or reuse) a pcv step
+  def run(self, func, *args, **kwargs):
+    start = time.time()
+    key = (func, tuple(self._arg_key(a) for a in args), tuple(sorted((k, self._arg_key(v)) for k, v in kwargs.items())))
+    self.overhead += time.time() - start
+
+    if key in self.cache:
+      start = time.time()
+      results, elapsed = self.cache[key]
+      results = tuple(_copy(r) for r in results)
+      self.device += 1
+      cost = time.time() - start
+      self.saved += elapsed - cost
+      self.steps.append((self.device, func.__name__, True, cost))
+    else:
+      start = time.time()
+      out = func(*(args + (self.device, self.debug)), **kwargs)
+      elapsed = time.time() - start
+      self.device = out[0]
+      results = tuple(out[1:])
+      start = time.time()
+      self.cache[key] = (tuple(_copy(r) for r in results), elapsed)
+      self.overhead += time.time() - start
+      self.steps.append((self.device, func.__name__, False, elapsed))
+
+    if len(results) == 1:
+      return results[0]
+    return results
+
+  ### Summary of the run: steps, repeated steps and time saved
+  def report(self, out=None):
+    # out = stream, default sys.stderr at the time of the call (pipeline_worker.run_job replaces it per image)
+    if out is None:
+      out = sys.stderr
+    repeated = [s for s in self.steps if s[2]]
+    out.write('pipeline steps: ' + str(len(self.steps)) + ', repeated: ' + str(len(repeated)) +
+              ', time saved: ' + '%.4f' % self.saved + ' s, cache overhead: ' + '%.4f' % self.overhead + ' s\n')
+    for device, name, cached, elapsed in repeated:
+      out.write('  step ' + str(device) + ' ' + name + ' reused\n')
+
+  ### Hashable key for a step argument
+  def _arg_key(self, arg):
+    if isinstance(arg, np.ndarray) and arg.dtype != object:
+      data = np.ascontiguousarray(arg).reshape(-1).view(np.uint8)
+      return ('ndarray', arg.shape, arg.dtype.str, zlib.crc32(data) & 0xffffffff, zlib.adler32(data) & 0xffffffff)
+    if isinstance(arg, (list, tuple)):
+      return (type(arg).__name__,) + tuple(self._arg_key(a) for a in arg)
+    try:
+      hash(arg)
+    except TypeError:
+      # Other unhashable objects are only equal to themselves
+      self.pinned.append(arg)
+      return ('id', id(arg))
+    return arg
+
+### Copy a step result so callers can modify it
+def _copy(result):
+  if isinstance(result, np.ndarray):
+    return np.copy(result)
+  if isinstance(result, list):
+    return [_copy(r) for r in result]
+  return result
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# Long-lived worker for plantcv pipeline scripts
+# The pipeline script is imported once (cv2, numpy, plantcv, etc. are loaded a single time) and its main()
+# is then called once per image job. Jobs are read from stdin (default) or from a local UNIX socket.
+#
+# Protocol: each job is one line containing the pipeline arguments as they would be given on the command line,
+# e.g. -i '/path/to/image.png' -o /path/to/outdir
+# For each job the worker replies with a header line followed by the captured output of the job:
+#   JOB<TAB>stdout bytes<TAB>stderr bytes<TAB>exit status<NEWLINE><stdout><stderr>
+
+import argparse
+import sys, os, traceback
+import shlex
+import time
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+try:
+  import SocketServer as socketserver
+except ImportError:
+  import socketserver
+import pipeline_profile
+import image_writer
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Persistent worker that runs a plantcv pipeline script on many images.")
+  parser.add_argument("-p", "--pipeline", help="Pipeline script file.", required=True)
+  parser.add_argument("-s", "--socket", help="Listen on this UNIX socket path instead of reading jobs from stdin.", required=False)
+  args = parser.parse_args()
+  return args
+
+### Import a pipeline script as a module
+def load_pipeline(pipeline, from_env=True):
+  # pipeline = path to a pipeline script with a main() function
+  # from_env = install the image writer and the profiler from the environment (off to only check the script loads)
+  # With PLANTCV_IMAGE_THREADS set, debug and analysis images are written in the background (see image_writer.py)
+  # With PLANTCV_PROFILE set, the pcv steps of every job are traced (see pipeline_profile.py)
+  if from_env:
+    image_writer.install_from_env()
+    pipeline_profile.install_from_env()
+  pipeline = os.path.abspath(pipeline)
+  if not os.path.exists(pipeline):
+    raise IOError("The pipeline script " + str(pipeline) + " does not exist")
+
+  # Pipelines may import helper modules that live next to them
+  pipeline_dir = os.path.dirname(pipeline)
+  if pipeline_dir not in sys.path:
+    sys.path.insert(0, pipeline_dir)
+
+  # Script names are not always valid module names (e.g. dev/nir_sv_z2500_L2-brachy.py)
+  name = os.path.splitext(os.path.basename(pipeline))[0]
+  name = "pipeline_" + "".join(c if c.isalnum() else "_" for c in name)
+
+  try:
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(name, pipeline)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+  except ImportError:
+    # Python 2
+    import imp
+    module = imp.load_source(name, pipeline)
+
+  if not hasattr(module, 'main'):
+    raise AttributeError("The pipeline script " + str(pipeline) + " does not define main()")
+  return module
+
+### Run one job in the current process
+def run_job(module, job_args):
+  # module = pipeline module from load_pipeline
+  # job_args = list of command-line arguments for the pipeline (without the script name)
+  # Returns the captured stdout and stderr, the exit status and the run time in seconds
+  stdout = StringIO()
+  stderr = StringIO()
+  real_stdout = sys.stdout
+  real_stderr = sys.stderr
+  real_argv = sys.argv
+  status = 0
+  start = time.time()
+
+  sys.argv = [module.__file__] + list(job_args)
+  if pipeline_profile.active():
+    pipeline_profile.start_image(list(job_args), module.__file__)
+  if image_writer.active():
+    image_writer.start_image(list(job_args))
+  sys.stdout = stdout
+  sys.stderr = stderr
+  try:
+    module.main()
+  except SystemExit as e:
+    # argparse errors and explicit sys.exit() calls
+    if e.code not in (None, 0):
+      status = e.code if isinstance(e.code, int) else 1
+      if not isinstance(e.code, int):
+        stderr.write(str(e.code) + "\n")
+  except Exception:
+    status = 1
+    traceback.print_exc(file=stderr)
+  finally:
+    sys.stdout = real_stdout
+    sys.stderr = real_stderr
+    sys.argv = real_argv
+    if pipeline_profile.active():
+      pipeline_profile.finish_image(status)
+
+  return stdout.getvalue(), stderr.getvalue(), status, time.time() - start
+
+### Serialize a job result
+def format_result(stdout, stderr, status):
+  out = _to_bytes(stdout)
+  err = _to_bytes(stderr)
+  header = "JOB\t" + str(len(out)) + "\t" + str(len(err)) + "\t" + str(status) + "\n"
+  return _to_bytes(header) + out + err
+
+def _to_bytes(text):
+  if isinstance(text, bytes):
+    return text
+  return text.encode('utf-8')
+
+### Read jobs from a line-oriented stream and write results to a binary stream
+def serve_stream(module, infile, outfile):
+  # readline() instead of iteration so jobs are not held in Python 2 read-ahead buffers
+  while True:
+    line = infile.readline()
+    if not line:
+      break
+    if isinstance(line, bytes):
+      line = line.decode('utf-8')
+    line = line.strip()
+    if not line:
+      continue
+    stdout, stderr, status, elapsed = run_job(module, shlex.split(line))
+    outfile.write(format_result(stdout, stderr, status))
+    outfile.flush()
+
+def _binary_stdout():
+  return getattr(sys.stdout, 'buffer', sys.stdout)
+
+### Socket server
+# Jobs are processed one at a time; run several workers for parallelism
+class JobServer(socketserver.UnixStreamServer):
+  def __init__(self, path, module):
+    self.module = module
+    socketserver.UnixStreamServer.__init__(self, path, JobHandler)
+
+class JobHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    serve_stream(self.server.module, self.rfile, self.wfile)
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  module = load_pipeline(args.pipeline)
+
+  if args.socket:
+    if os.path.exists(args.socket):
+      os.unlink(args.socket)
+    server = JobServer(args.socket, module)
+    try:
+      server.serve_forever()
+    finally:
+      server.server_close()
+      os.unlink(args.socket)
+  else:
+    serve_stream(module, sys.stdin, _binary_stdout())
+
+if __name__ == '__main__':
+  main()
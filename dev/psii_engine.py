@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+# PSII fluorescence engine
+# Shared steps of the PSII scripts (psII_tv/psII_z*_L1.py, dev/fluor_z600_L1-brachy.py) and a batch mode for many
+# plants:
+#   - every Fdark/Fmin/Fmax frame is decoded once; the 8-bit view used for the plant mask (what pcv.readimage gives)
+#     is derived from the 16-bit data
+#   - the track autofluorescence mask only depends on the --track image, so it is built once per process
+#   - the plant mask is thresholded, median blurred and filled once (the scripts repeated the median blur and the
+#     fill only to give pcv.fill a throwaway copy)
+#   - in batch mode, Fv/Fm is computed for a chunk of plants at once on stacked arrays (fvfm_stack)
+#
+# Batch usage (one "fdark fmin fmax" triplet of image paths per line in the input file):
+#   python psii_engine.py -i triplets.txt -m track.png -o outdir -r results.txt -n 8
+#   python psii_engine.py -i triplets.txt -m track.png -o outdir -k 0 -f 5 -a -100     (brachy z600 settings)
+
+import argparse
+import sys, os
+import time
+import multiprocessing
+import cv2
+import numpy as np
+import plantcv as pcv
+from registration import read_nir
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="PSII (Fv/Fm) analysis of many plants.")
+  parser.add_argument("-i", "--input", help="File with one 'fdark fmin fmax' triplet of image paths per line.",
+                      required=True)
+  parser.add_argument("-m", "--track", help="Track image used to mask track autofluorescence.", required=False)
+  parser.add_argument("-o", "--outdir", help="Output directory for image files.", required=True)
+  parser.add_argument("-r", "--result", help="Results file or directory (see results_sink.py). Default: stdout.",
+                      required=False)
+  parser.add_argument("-F", "--format", help="Results format, text or columnar (see results_sink.py).", required=False)
+  parser.add_argument("-t", "--threshold", help="Threshold of the Fmax image.", type=int, default=20)
+  parser.add_argument("-k", "--ksize", help="Median blur kernel size.", type=int, default=5)
+  parser.add_argument("-f", "--fill", help="Fill objects up to this size.", type=int, default=110)
+  parser.add_argument("-a", "--adjust", help="ROI circle width and height adjustment.", type=int, default=-50)
+  parser.add_argument("-b", "--bins", help="Number of Fv/Fm histogram bins.", type=int, default=1000)
+  parser.add_argument("-c", "--chunk", help="Plants per Fv/Fm stack.", type=int, default=8)
+  parser.add_argument("-n", "--processes", help="Number of worker processes. Default: number of CPUs.", type=int,
+                      default=multiprocessing.cpu_count())
+  args = parser.parse_args()
+  return args
+
+### Decode a fluorescence frame once
+def read_fluor(filename):
+  # Returns the image as stored (16-bit), the 8-bit BGR view pcv.readimage gives, the path and the file name
+  img8, raw, path, img_name = read_nir(filename)
+  return raw, img8, path, img_name
+
+# Track masks of this process by file
+_tracks = {}
+
+### Inverted track autofluorescence mask (rgb2gray_hsv 'v', threshold 0 'light', invert), built once per file
+def track_mask(track, device, debug=False):
+  # track = track image file
+  # Returns device, mask (white where there is no track)
+  if debug or track not in _tracks:
+    track_img = cv2.imread(track)
+    if track_img is None:
+      pcv.fatal_error('Failed to open ' + str(track))
+    device, track1 = pcv.rgb2gray_hsv(track_img, 'v', device, debug)
+    device, track_thresh = pcv.binary_threshold(track1, 0, 255, 'light', device, debug)
+    device, track_inv = pcv.invert(track_thresh, device, debug)
+    track_inv.flags.writeable = False
+    _tracks[track] = track_inv
+    return device, track_inv
+  return device + 3, _tracks[track]
+
+### Plant mask of the 8-bit Fmax image: threshold, median blur and fill small objects
+def plant_mask(img, threshold, ksize, size, device, debug=False):
+  # img = 8-bit grayscale image (track masked)
+  # threshold = 'light' threshold
+  # ksize = median blur kernel size (1 or less leaves the image as it is)
+  # size = fill objects up to this size
+  device, fmax_thresh = pcv.binary_threshold(img, threshold, 255, 'light', device, debug)
+  if ksize > 1:
+    device, s_mblur = pcv.median_blur(fmax_thresh, ksize, device, debug)
+  else:
+    s_mblur = np.copy(fmax_thresh)
+    device += 1
+  # pcv.fill fills its first argument and finds the contours in the second one; filling twice gives the same mask
+  s_cnt = np.copy(s_mblur)
+  device, sfill_cnt = pcv.fill(s_mblur, s_cnt, size, device, debug)
+  # The repeated median blur and fill of the scripts
+  device += 2
+  return device, sfill_cnt
+
+### Fv/Fm of many plants at once (the pcv.fluor_fvfm computation on stacked arrays)
+def fvfm_stack(fdark, fmin, fmax, masks, bins=1000):
+  # fdark, fmin, fmax = (plants, rows, columns) 16-bit stacks
+  # masks = (plants, rows, columns) plant masks
+  # Returns a list of (histogram header, histogram data) per plant
+  masks = masks > 0
+  fmin = np.where(masks, fmin, 0)
+  fmax = np.where(masks, fmax, 0)
+  fv = np.where(fmax >= fmin, fmax.astype(np.float64) - fmin, 0.0)
+  fvfm = np.divide(fv, fmax, out=np.zeros(fv.shape, dtype=np.float64), where=fmax > 0)
+  # fdark QC: no bright pixels in the plant
+  qc_fdark = np.where(masks, fdark, 0).reshape(len(masks), -1).max(axis=1) <= 2000
+
+  # Histograms of the non-zero values, binned as np.histogram(values, bins, range=(0, 1))
+  edges = np.linspace(0, 1, bins + 1)
+  plant, flat = np.nonzero(fvfm.reshape(len(masks), -1) > 0)
+  values = fvfm.reshape(len(masks), -1)[plant, flat]
+  index = (values * bins).astype(np.intp)
+  index[index == bins] -= 1
+  index[values < edges[index]] -= 1
+  index[(values >= edges[index + 1]) & (index != bins - 1)] += 1
+  hists = np.bincount(plant * bins + index, minlength=len(masks) * bins).reshape(len(masks), bins)
+  midpoints = edges[:-1] + 0.5 * np.diff(edges)
+
+  # Medians of the non-zero values (values are grouped by plant)
+  starts = np.searchsorted(plant, np.arange(len(masks) + 1))
+  header = ('HEADER_HIST', 'bin-number', 'fvfm_bins', 'fvfm_hist', 'fvfm_hist_peak', 'fvfm_median', 'fdark_passed_qc')
+  results = []
+  for i in range(len(masks)):
+    median = np.median(values[starts[i]:starts[i + 1]]) if starts[i + 1] > starts[i] else float('nan')
+    data = ('FLU_DATA', bins, np.around(midpoints, decimals=len(str(bins))).tolist(), hists[i].tolist(),
+            float(midpoints[np.argmax(hists[i])]), float(np.around(median, decimals=4)), bool(qc_fdark[i]))
+    results.append((header, data))
+  return results
+
+### Shape analysis of one plant, returns (shape header, shape data, kept mask)
+def segment_plant(fmax_path, raw, mask, track_inv, args):
+  # raw, mask = 16-bit Fmax image and its 8-bit BGR view
+  device = 0
+  mask1, mask2, mask3 = cv2.split(mask)
+  if track_inv is not None:
+    device, track_masked = pcv.apply_mask(mask1, track_inv, 'black', device, False)
+  else:
+    track_masked = mask1
+  device, sfill_cnt = plant_mask(track_masked, args.threshold, args.ksize, args.fill, device)
+  device, id_objects, obj_hierarchy = pcv.find_objects(mask, sfill_cnt, device, False)
+  device, roi1, roi_hierarchy = pcv.define_roi(mask, 'circle', device, None, 'default', False, True, 0, 0,
+                                               args.adjust, args.adjust)
+  device, roi_objects, hierarchy3, kept_mask, obj_area = pcv.roi_objects(mask, 'partial', roi1, roi_hierarchy,
+                                                                         id_objects, obj_hierarchy, device, False)
+  device, obj, masked = pcv.object_composition(mask, roi_objects, hierarchy3, device, False)
+  filename = os.path.basename(fmax_path)
+  device, shape_header, shape_data, shape_img = pcv.analyze_object(mask, fmax_path, obj, masked, device, False,
+                                                                   args.outdir + '/' + filename)
+  return shape_header, shape_data, kept_mask
+
+# Settings and track mask of a worker process
+_worker = {}
+
+def _init_worker(args, track_inv):
+  _worker['args'] = args
+  _worker['track'] = track_inv
+
+def _run_chunk(triplets):
+  # Segments a chunk of plants, then computes Fv/Fm for all of them on stacked arrays
+  args = _worker['args']
+  results = []
+  stacks = []
+  start = time.time()
+  for fdark_path, fmin_path, fmax_path in triplets:
+    try:
+      fmax, mask, path, filename = read_fluor(fmax_path)
+      fdark = read_fluor(fdark_path)[0]
+      fmin = read_fluor(fmin_path)[0]
+      shape_header, shape_data, kept_mask = segment_plant(fmax_path, fmax, mask, _worker['track'], args)
+    except Exception as e:
+      results.append((fmax_path, None, str(e)))
+      continue
+    results.append((fmax_path, [(shape_header, shape_data)], None))
+    stacks.append((len(results) - 1, fdark, fmin, fmax, kept_mask))
+
+  # Plants of the same image size are stacked together
+  by_shape = {}
+  for item in stacks:
+    by_shape.setdefault(item[3].shape, []).append(item)
+  for items in by_shape.values():
+    fvfm = fvfm_stack(np.array([i[1] for i in items]), np.array([i[2] for i in items]),
+                      np.array([i[3] for i in items]), np.array([i[4] for i in items]), args.bins)
+    for item, rows in zip(items, fvfm):
+      results[item[0]][1].append(rows)
+  return results, time.time() - start
+
+### Read the triplet file
+def read_triplets(filename):
+  triplets = []
+  with open(filename) as f:
+    for line in f:
+      fields = line.split()
+      if not fields or fields[0].startswith('#'):
+        continue
+      if len(fields) != 3:
+        pcv.fatal_error('Expected fdark, fmin and fmax image paths: ' + line.strip())
+      triplets.append(tuple(fields))
+  return triplets
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  triplets = read_triplets(args.input)
+  track_inv = None
+  if args.track:
+    device, track_inv = track_mask(args.track, 0)
+  chunks = [triplets[i:i + args.chunk] for i in range(0, len(triplets), args.chunk)]
+
+  if args.result:
+    from results_sink import open_sink
+    result = open_sink(args.result, fmt=args.format)
+  else:
+    result = None
+  failed = 0
+  start = time.time()
+  pool = multiprocessing.Pool(max(1, min(args.processes, len(chunks))), _init_worker, (args, track_inv))
+  try:
+    for results, elapsed in pool.imap_unordered(_run_chunk, chunks):
+      for image, rows, error in results:
+        if error is not None:
+          sys.stderr.write(image + ': ' + error + '\n')
+          failed += 1
+          continue
+        for header, data in rows:
+          if result is not None:
+            result.add(image, header, data)
+          else:
+            pcv.print_results(image, header, data)
+        if result is not None:
+          result.commit()
+    pool.close()
+  except BaseException:
+    # Interrupted or failed while writing the results: stop the workers without running the remaining chunks
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  if result is not None:
+    result.flush()
+  sys.stderr.write('plants: ' + str(len(triplets)) + ', failed: ' + str(failed) + ', wall time: ' +
+                   '%.2f' % (time.time() - start) + ' s\n')
+  if failed:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+# VIS -> NIR mask registration
+# The VIS/NIR scripts map the VIS plant mask onto the NIR image with pcv.flip, pcv.resize and
+# pcv.crop_position_mask, three full-size passes with hard-coded scale and offsets. crop_position_mask pads, crops and
+# centers the resized mask in several stacked copies; all it does is place the mask at one position of the NIR frame,
+# so the mask is flipped, resized and pasted into the frame at that position (legacy_position), which gives the same
+# mask as the pcv chain. Transforms are 2x3 affine matrices applied with a single cv2.warpAffine straight to NIR
+# resolution, which only reads the VIS mask pixels it samples.
+#
+# Until a pair/zoom is calibrated, the script's flip/resize/crop_position_mask parameters are used
+# (get_registration(..., legacy={...})) as the equivalent matrix (legacy_matrix) and the window of the mask the center
+# crop keeps. warpAffine interpolates a little differently from cv2.resize, so the first non-empty mask of each
+# pair/zoom is also registered with legacy_mask: the warp is used if the masks differ in at most TOLERANCE of the mask
+# pixels, otherwise the process keeps using legacy_mask (the three passes). Calibrated transforms are stored in the
+# cache directory (PLANTCV_REGISTRATION_CACHE, default ~/.cache/plantcv-dev-scripts/registration) and take precedence.
+#
+# Calibration from sample pairs of VIS and NIR plant masks (binary images of the same plant):
+#   python registration.py -k vis_sv-nir_sv -z z1500_h1_h2_e82 -f vertical -m vis1_mask.png nir1_mask.png \
+#     -m vis2_mask.png nir2_mask.png
+# The scale and offset are fitted from the area and centroid of the masks; flips are given with -f.
+# To list the calibrated transforms:
+#   python registration.py -l
+# Equivalence check of legacy parameters (legacy_mask and the warp) against the pcv chain:
+#   python registration.py --check vis_mask.png NIR_SV_0_z3500_*.png -f vertical -s 0.1304 -x 65 0 -P top left
+
+import argparse
+import sys, os
+import json
+import time
+import tempfile
+import cv2
+import numpy as np
+import plantcv as pcv
+
+# Largest fraction of the mask pixels the warp of legacy parameters may get wrong (zero instead of nonzero or the
+# other way round) compared with legacy_mask
+TOLERANCE = 0.001
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Calibrate VIS to NIR mask registration transforms.")
+  parser.add_argument("-k", "--pair", help="Camera pair, e.g. vis_sv-nir_sv.", required=False)
+  parser.add_argument("-z", "--zoom", help="Zoom (setup) label, e.g. z1500_h1_h2_e82.", required=False)
+  parser.add_argument("-f", "--flip", help="Flip applied to the VIS mask (vertical or horizontal, can be repeated).",
+                      action="append", default=[])
+  parser.add_argument("-m", "--masks", help="VIS mask and NIR mask of one sample pair.", nargs=2, action="append",
+                      metavar=("VIS_MASK", "NIR_MASK"))
+  parser.add_argument("-c", "--cache", help="Registration cache directory.", required=False)
+  parser.add_argument("-l", "--list", help="List the calibrated transforms.", action="store_true")
+  parser.add_argument("--check", help="VIS mask and NIR image to compare with the pcv chain (legacy parameters).",
+                      nargs=2, action="append", metavar=("VIS_MASK", "NIR_IMAGE"))
+  parser.add_argument("-s", "--scale", help="Legacy resize factor (or x and y factors).", type=float, nargs="+")
+  parser.add_argument("-x", "--offset", help="Legacy crop_position_mask offset (x y).", type=int, nargs=2,
+                      default=[0, 0])
+  parser.add_argument("-P", "--position", help="Legacy crop_position_mask position (top|bottom left|right).", nargs=2,
+                      default=["top", "right"])
+  args = parser.parse_args()
+  if args.check:
+    if not args.scale or len(args.scale) > 2:
+      parser.error("the check needs the resize factor (-s)")
+  elif not args.list and not (args.pair and args.zoom and args.masks):
+    parser.error("calibration needs a camera pair (-k), zoom (-z) and at least one mask pair (-m)")
+  return args
+
+### Default cache directory
+def cache_dir():
+  return os.getenv('PLANTCV_REGISTRATION_CACHE',
+                   os.path.join(os.path.expanduser('~'), '.cache', 'plantcv-dev-scripts', 'registration'))
+
+def _cache_file(pair, zoom, directory=None):
+  if directory is None:
+    directory = cache_dir()
+  return os.path.join(directory, pair + '_' + zoom + '.json')
+
+### Transform of pcv.flip (in pixel coordinates, as a 3x3 matrix)
+def flip_matrix(direction, shape):
+  # direction = 'vertical' (mirror left-right, as pcv.flip) or 'horizontal' (mirror top-bottom)
+  # shape = image shape (rows, columns)
+  rows, cols = shape[:2]
+  if direction == 'vertical':
+    return np.array([[-1.0, 0, cols - 1], [0, 1.0, 0], [0, 0, 1.0]])
+  if direction == 'horizontal':
+    return np.array([[1.0, 0, 0], [0, -1.0, rows - 1], [0, 0, 1.0]])
+  pcv.fatal_error('Flip direction ' + str(direction) + ' is not "vertical" or "horizontal"!')
+
+### Placement of a mask along one axis of the image by pcv.crop_position_mask
+def _crop_position(size, frame, pad, first):
+  # size = mask size along the axis, frame = image size along the axis
+  # pad = offset padded on the aligned side (crop_position_mask already took 1 from it)
+  # first = the mask is aligned with the top (left) edge, otherwise with the bottom (right) edge
+  # Returns the image coordinate of the first mask pixel and the mask pixels kept by the center crop (start, end)
+  start = 0
+  end = size
+  # A mask as large as the image is cropped around its center first (np.rint rounds halves to even, so an odd
+  # excess is cropped by one pixel less, and an excess of one not at all)
+  if size >= frame:
+    r = size - frame
+    r1 = int(np.rint(r / 2.0))
+    r2 = r1 if r % 2 == 0 else r1 - 1
+    end = min(size - r2, size)
+    start = r1
+  # The rest is a shift: pad on the aligned side, then crop from the other side or center with the larger half
+  # before the mask
+  shift = -start
+  size = end - start
+  if first:
+    shift += pad
+  size += pad
+  if size >= frame:
+    if not first:
+      shift -= size - frame
+  else:
+    shift += int(np.ceil((frame - size) / 2.0))
+  return shift, (start, end)
+
+### Placement of a resized mask in the image by pcv.crop_position_mask
+def legacy_position(mask_shape, nir_shape, offset, position):
+  # mask_shape, nir_shape = shapes of the resized mask and the NIR image
+  # offset = (x, y) of pcv.crop_position_mask (x moves the mask vertically, y horizontally)
+  # position = (v_pos, h_pos) of pcv.crop_position_mask
+  # Returns the image (row, column) of the first mask pixel and the mask rows and columns that are not cropped
+  # around the center, as ((ty, tx), (row_start, row_end), (column_start, column_end))
+  x, y = offset
+  v_pos, h_pos = position
+  if x < 0 or y < 0:
+    pcv.fatal_error('Offsets ' + str(offset) + ' cannot be negative!')
+  if v_pos not in ('top', 'bottom'):
+    pcv.fatal_error('Vertical position ' + str(v_pos) + ' is not "top" or "bottom"!')
+  if h_pos not in ('left', 'right'):
+    pcv.fatal_error('Horizontal position ' + str(h_pos) + ' is not "left" or "right"!')
+  # crop_position_mask counts nonzero offsets from 1
+  ty, rows = _crop_position(mask_shape[0], nir_shape[0], max(x - 1, 0), v_pos == 'top')
+  tx, cols = _crop_position(mask_shape[1], nir_shape[1], max(y - 1, 0), h_pos == 'left')
+  return (ty, tx), rows, cols
+
+def _flips(flip):
+  if isinstance(flip, str):
+    return [flip]
+  return list(flip)
+
+### Size of a mask after pcv.resize (cv2.resize rounds the scaled size)
+def resized_shape(shape, scale):
+  fx, fy = scale
+  return int(round(shape[0] * fy)), int(round(shape[1] * fx))
+
+### Mask of pcv.flip -> pcv.resize -> pcv.crop_position_mask
+def legacy_mask(mask, nir_shape, flip, scale, offset, position):
+  # mask = VIS mask
+  # nir_shape = shape of the NIR image
+  # flip = flip direction or list of directions applied in order
+  # scale = (resize_x, resize_y) of pcv.resize
+  # offset, position = see legacy_position
+  if len(np.shape(mask)) == 3:
+    mask = mask[:, :, 0]
+  for direction in _flips(flip):
+    if direction == 'vertical':
+      mask = cv2.flip(mask, 1)
+    elif direction == 'horizontal':
+      mask = cv2.flip(mask, 0)
+    else:
+      pcv.fatal_error('Flip direction ' + str(direction) + ' is not "vertical" or "horizontal"!')
+  mask = cv2.resize(mask, (0, 0), fx=scale[0], fy=scale[1])
+  (ty, tx), (row_start, row_end), (col_start, col_end) = legacy_position(mask.shape, nir_shape, offset, position)
+
+  # Paste the part of the kept mask that falls inside the frame
+  rows, cols = nir_shape[:2]
+  newmask = np.zeros((rows, cols), dtype=mask.dtype)
+  top, left = max(ty + row_start, 0), max(tx + col_start, 0)
+  bottom, right = min(ty + row_end, rows), min(tx + col_end, cols)
+  if bottom > top and right > left:
+    newmask[top:bottom, left:right] = mask[top - ty:bottom - ty, left - tx:right - tx]
+  return newmask
+
+### Transform equivalent to pcv.flip -> pcv.resize -> pcv.crop_position_mask
+def legacy_matrix(vis_shape, nir_shape, flip, scale, offset, position):
+  # vis_shape, nir_shape = shapes of the VIS mask and the NIR image
+  # Other arguments as legacy_mask. The matrix does not crop the mask around the center (see legacy_window) and
+  # warpAffine interpolates a little differently from cv2.resize, legacy_mask gives the pcv mask exactly.
+  m = np.eye(3)
+  for direction in _flips(flip):
+    m = np.dot(flip_matrix(direction, vis_shape), m)
+
+  # cv2.resize maps pixel centers: dst = (src + 0.5) * f - 0.5
+  fx, fy = scale
+  m = np.dot(np.array([[fx, 0, 0.5 * fx - 0.5], [0, fy, 0.5 * fy - 0.5], [0, 0, 1.0]]), m)
+  (ty, tx), rows, cols = legacy_position(resized_shape(vis_shape, scale), nir_shape, offset, position)
+  m = np.dot(np.array([[1.0, 0, tx], [0, 1.0, ty], [0, 0, 1.0]]), m)
+  return m[:2]
+
+### Part of the NIR image the mask of pcv.crop_position_mask can cover (the rest of the mask is cropped around its center)
+def legacy_window(vis_shape, nir_shape, flip, scale, offset, position):
+  # Arguments as legacy_matrix
+  # Returns (top, bottom, left, right) in NIR image pixels
+  (ty, tx), (row_start, row_end), (col_start, col_end) = legacy_position(resized_shape(vis_shape, scale), nir_shape,
+                                                                         offset, position)
+  return (max(ty + row_start, 0), min(ty + row_end, nir_shape[0]),
+          max(tx + col_start, 0), min(tx + col_end, nir_shape[1]))
+
+### Pixels of two masks that differ as masks (zero in one, nonzero in the other)
+def mask_difference(a, b):
+  return int(np.count_nonzero((a > 0) != (b > 0)))
+
+class Registration(object):
+  # matrix = 2x3 affine transform from VIS mask pixels to NIR image pixels
+  # nir_shape = shape of the NIR image
+  # source = 'legacy' or 'calibrated'
+  # legacy = legacy_mask arguments (flip, scale, offset, position) the matrix stands for, the warp is checked against
+  #   legacy_mask on the first non-empty mask
+  # steps = pcv steps the registration replaces (counted by warp, so later debug images keep their numbers)
+  # window = (top, bottom, left, right) of the NIR image the mask is kept in (legacy_window)
+  # tolerance = see TOLERANCE
+  def __init__(self, matrix, nir_shape, source='legacy', legacy=None, steps=3, window=None, tolerance=TOLERANCE):
+    self.matrix = np.asarray(matrix, dtype=np.float64)
+    self.nir_shape = tuple(nir_shape[:2])
+    self.source = source
+    self.legacy = legacy
+    self.steps = steps
+    self.window = window
+    self.tolerance = tolerance
+    # None until the warp was checked against legacy_mask, then whether it is used
+    self.use_warp = None if legacy is not None else True
+    # (differing pixels, mask pixels) of the check
+    self.checked = None
+
+  ### VIS mask at NIR resolution with the matrix
+  def warp_mask(self, mask):
+    if len(np.shape(mask)) == 3:
+      mask = mask[:, :, 0]
+    newmask = cv2.warpAffine(mask, self.matrix, (self.nir_shape[1], self.nir_shape[0]), flags=cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    if self.window is not None:
+      top, bottom, left, right = self.window
+      newmask[:top] = 0
+      newmask[bottom:] = 0
+      newmask[:, :left] = 0
+      newmask[:, right:] = 0
+    return newmask
+
+  ### VIS mask at NIR resolution
+  def apply(self, mask):
+    if self.use_warp:
+      return self.warp_mask(mask)
+    expected = legacy_mask(mask, self.nir_shape, **self.legacy)
+    if self.use_warp is None:
+      area = int(np.count_nonzero(expected))
+      if area:
+        diff = mask_difference(self.warp_mask(mask), expected)
+        self.checked = (diff, area)
+        self.use_warp = diff <= self.tolerance * area
+        if not self.use_warp:
+          sys.stderr.write('registration: the warp differs from legacy_mask in ' + str(diff) + ' of ' + str(area) +
+                           ' mask pixels, using legacy_mask\n')
+    return expected
+
+  ### Pipeline step version of apply, counts the device and prints a debug image
+  def warp(self, mask, device, debug=False):
+    newmask = self.apply(mask)
+    device += self.steps
+    if debug:
+      pcv.print_image(newmask, (str(device) + '_registered_mask.png'))
+    return device, newmask
+
+# Transforms of this process
+_registrations = {}
+
+### Registration for a camera pair and zoom: calibrated if available, otherwise from the legacy parameters
+def get_registration(pair, zoom, vis_shape, nir_shape, legacy=None, directory=None):
+  # pair = camera pair, e.g. 'vis_sv-nir_sv'
+  # zoom = zoom (setup) label, e.g. 'z1500_h1_h2_e82'
+  # legacy = dictionary of legacy_mask arguments (flip, scale, offset, position)
+  key = (pair, zoom, tuple(vis_shape[:2]), tuple(nir_shape[:2]), directory)
+  if key not in _registrations:
+    path = _cache_file(pair, zoom, directory)
+    if os.path.exists(path):
+      with open(path) as f:
+        stored = json.load(f)
+      if tuple(stored['vis_shape']) != tuple(vis_shape[:2]) or tuple(stored['nir_shape']) != tuple(nir_shape[:2]):
+        pcv.fatal_error('Calibrated transform ' + path + ' is for VIS ' + str(stored['vis_shape']) + ' and NIR ' +
+                        str(stored['nir_shape']) + ' images!')
+      _registrations[key] = Registration(stored['matrix'], nir_shape, 'calibrated', steps=len(stored['flip']) + 2)
+    elif legacy is not None:
+      _registrations[key] = Registration(legacy_matrix(vis_shape, nir_shape, **legacy), nir_shape, 'legacy', legacy,
+                                         len(_flips(legacy['flip'])) + 2, legacy_window(vis_shape, nir_shape, **legacy))
+    else:
+      pcv.fatal_error('No transform for ' + pair + ' ' + zoom + ', run registration.py to calibrate it!')
+  return _registrations[key]
+
+### Read a NIR image once
+def read_nir(nirpath):
+  # Returns the 8-bit BGR image pcv.readimage would give, the image as stored (cv2.imread(nirpath, -1)),
+  # the path and the file name
+  raw = cv2.imread(nirpath, -1)
+  if raw is None:
+    pcv.fatal_error('Failed to open ' + str(nirpath))
+  if raw.dtype == np.uint16:
+    # cv2.imread without flags keeps the high byte of 16-bit images
+    nir8 = (raw >> 8).astype(np.uint8)
+  else:
+    nir8 = raw
+  if nir8.ndim == 2:
+    nir = cv2.cvtColor(nir8, cv2.COLOR_GRAY2BGR)
+  elif nir8.shape[2] == 4:
+    nir = cv2.cvtColor(nir8, cv2.COLOR_BGRA2BGR)
+  else:
+    nir = nir8
+  path = '/'.join(nirpath.split('/')[0:-1])
+  filename = nirpath.split('/')[-1]
+  return nir, raw, path, filename
+
+### 8-bit grayscale view of a NIR image as stored, as cv2.imread(nirpath, 0) would give
+def nir_gray(raw):
+  if raw.dtype == np.uint16:
+    raw = (raw >> 8).astype(np.uint8)
+  if raw.ndim == 3:
+    raw = cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY)
+  return raw
+
+### Fit scale and offset from pairs of VIS and NIR masks
+def fit_matrix(pairs, flip=()):
+  # pairs = list of (VIS mask, NIR mask)
+  # flip = flips applied to the VIS mask before scaling
+  vis_area = 0.0
+  nir_area = 0.0
+  centers = []
+  for vis_mask, nir_mask in pairs:
+    f = np.eye(3)
+    for direction in flip:
+      f = np.dot(flip_matrix(direction, vis_mask.shape), f)
+    vm = cv2.moments((vis_mask > 0).astype(np.uint8), True)
+    nm = cv2.moments((nir_mask > 0).astype(np.uint8), True)
+    if vm['m00'] == 0 or nm['m00'] == 0:
+      pcv.fatal_error('Empty mask in a calibration pair!')
+    vis_area += vm['m00']
+    nir_area += nm['m00']
+    vc = np.dot(f, [vm['m10'] / vm['m00'], vm['m01'] / vm['m00'], 1.0])[:2]
+    nc = np.array([nm['m10'] / nm['m00'], nm['m01'] / nm['m00']])
+    centers.append((vc, nc))
+  s = np.sqrt(nir_area / vis_area)
+  t = np.mean([nc - s * vc for vc, nc in centers], axis=0)
+  return np.dot(np.array([[s, 0, t[0]], [0, s, t[1]], [0, 0, 1.0]]), f)[:2]
+
+### Overlap of a registered VIS mask with the NIR mask
+def overlap(registered, nir_mask):
+  a = registered > 0
+  b = nir_mask > 0
+  union = np.count_nonzero(a | b)
+  if union == 0:
+    return 0.0
+  return float(np.count_nonzero(a & b)) / union
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  if args.check:
+    scale = (args.scale[0], args.scale[-1])
+    failed = 0
+    for vis_file, nir_file in args.check:
+      vis_mask = cv2.imread(vis_file, 0)
+      nir = cv2.imread(nir_file)
+      if vis_mask is None or nir is None:
+        pcv.fatal_error('Failed to open ' + str(vis_file) + ' or ' + str(nir_file))
+      device = 0
+      expected = vis_mask
+      for direction in args.flip:
+        device, expected = pcv.flip(expected, direction, device)
+      device, expected = pcv.resize(expected, scale[0], scale[1], device)
+      device, expected = pcv.crop_position_mask(nir, expected, device, args.offset[0], args.offset[1],
+                                                args.position[0], args.position[1])
+      legacy = {'flip': args.flip, 'scale': scale, 'offset': args.offset, 'position': args.position}
+      result = legacy_mask(vis_mask, nir.shape, **legacy)
+      if expected.shape != result.shape:
+        print(vis_file + '\t' + nir_file + '\tsize ' + str(result.shape) + ', pcv ' + str(expected.shape))
+        failed += 1
+        continue
+      diff = np.count_nonzero(expected != result)
+      # The warp used once it is within the tolerance
+      warped = Registration(legacy_matrix(vis_mask.shape, nir.shape, **legacy), nir.shape,
+                            window=legacy_window(vis_mask.shape, nir.shape, **legacy)).warp_mask(vis_mask)
+      warp_diff = mask_difference(warped, expected)
+      area = int(np.count_nonzero(expected))
+      print(vis_file + '\t' + nir_file + '\t' + ('ok' if diff == 0 else str(diff) + ' pixels differ') +
+            '\twarp: ' + str(warp_diff) + ' of ' + str(area) + ' mask pixels differ' +
+            ('' if warp_diff <= TOLERANCE * area else ' (over the tolerance, legacy_mask is used)'))
+      if diff:
+        failed += 1
+    if failed:
+      sys.exit(1)
+    return
+
+  directory = args.cache or cache_dir()
+  if args.list:
+    if os.path.isdir(directory):
+      for name in sorted(os.listdir(directory)):
+        if name.endswith('.json'):
+          with open(os.path.join(directory, name)) as f:
+            stored = json.load(f)
+          print(name[:-5] + '\t' + str(stored['matrix']) + '\tpairs: ' + str(stored['pairs']) +
+                '\toverlap: ' + '%.3f' % stored['overlap'])
+    return
+
+  pairs = []
+  for vis_file, nir_file in args.masks:
+    vis_mask = cv2.imread(vis_file, 0)
+    nir_mask = cv2.imread(nir_file, 0)
+    if vis_mask is None or nir_mask is None:
+      pcv.fatal_error('Failed to open ' + str(vis_file) + ' or ' + str(nir_file))
+    pairs.append((vis_mask, nir_mask))
+  shapes = set((v.shape, n.shape) for v, n in pairs)
+  if len(shapes) != 1:
+    pcv.fatal_error('All VIS masks and all NIR masks must have the same size!')
+
+  matrix = fit_matrix(pairs, args.flip)
+  registration = Registration(matrix, pairs[0][1].shape, 'calibrated')
+  scores = [overlap(registration.apply(v), n) for v, n in pairs]
+  for (vis_file, nir_file), score in zip(args.masks, scores):
+    print(vis_file + '\t' + nir_file + '\toverlap: ' + '%.3f' % score)
+
+  if not os.path.exists(directory):
+    os.makedirs(directory)
+  stored = {'pair': args.pair, 'zoom': args.zoom, 'flip': args.flip, 'matrix': matrix.tolist(),
+            'vis_shape': list(pairs[0][0].shape[:2]), 'nir_shape': list(pairs[0][1].shape[:2]),
+            'pairs': len(pairs), 'overlap': float(np.mean(scores)), 'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+  fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+  with os.fdopen(fd, 'w') as f:
+    json.dump(stored, f, indent=2)
+  os.rename(tmp, _cache_file(args.pair, args.zoom, directory))
+  print('matrix: ' + str(matrix.tolist()))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+# Buffered columnar results sink
+# Replaces the per-image result files written with '\t'.join(map(str, row)). Records are kept in memory and
+# written in batches as NumPy column files:
+#   results/schema.json                          column names, types and widths of every table (written once)
+#   results/<table>/part-<host>-<pid>-<n>.npz    one batch of rows from one process
+# A table is named after the header tag (e.g. HEADER_SHAPES, HEADER_HISTOGRAM). Numbers are stored as float64
+# (the first image fixes the schema, and a count in one image can be a fraction in the next), histograms and other
+# list values as fixed-width float64 arrays (one row per image). Every process writes its own part files, so any
+# number of workers can write to the same results directory.
+#
+# Results files keep the old tab-separated text format (still buffered and appended in one write). The columnar
+# format is used for format 'columnar' (-F columnar in the scripts) or a path ending in '/'.
+#
+# Usage in a pipeline:
+#   result = open_sink(args.result, fmt=args.format)
+#   result.add(args.image, shape_header, shape_data)
+#   result.add_rows(args.image, 'shape_img', shape_img)
+#   result.commit()
+#
+# Loading and exporting:
+#   python results_sink.py -r results                    (list tables)
+#   python results_sink.py -r results -t HEADER_SHAPES -x shapes.txt
+#   python results_sink.py -r results -c                 (merge part files)
+
+import argparse
+import sys, os
+import json
+import socket
+import tempfile
+import time
+import atexit
+import fcntl
+import multiprocessing.util
+import numpy as np
+import plantcv as pcv
+
+SCHEMA_FILE = 'schema.json'
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Inspect, export and merge a columnar results directory.")
+  parser.add_argument("-r", "--results", help="Results directory.", required=True)
+  parser.add_argument("-t", "--table", help="Table to export.", required=False)
+  parser.add_argument("-x", "--export", help="Write the table as tab-separated text to this file.", required=False)
+  parser.add_argument("-c", "--compact", help="Merge the part files of every table into one.", action="store_true")
+  args = parser.parse_args()
+  return args
+
+### Column type of a value (numbers are float64 whatever the type of the first value)
+def column_type(value):
+  if isinstance(value, (bool, np.bool_)):
+    return {'dtype': '|b1', 'shape': []}
+  if isinstance(value, (int, float, np.integer, np.floating)):
+    return {'dtype': '<f8', 'shape': []}
+  if isinstance(value, (list, tuple, np.ndarray)):
+    values = np.asarray(value)
+    if values.dtype.kind in 'biuf':
+      return {'dtype': '<f8', 'shape': list(values.shape)}
+  return {'dtype': 'str', 'shape': []}
+
+### Column types of a table from its header and first data row
+def table_schema(header, data):
+  if len(header) != len(data):
+    pcv.fatal_error('Header ' + str(header[0]) + ' has ' + str(len(header)) + ' fields but the data has ' +
+                    str(len(data)) + '!')
+  columns = [{'name': 'image', 'dtype': 'str', 'shape': []}, {'name': 'tag', 'dtype': 'str', 'shape': []}]
+  for name, value in zip(header[1:], data[1:]):
+    column = column_type(value)
+    column['name'] = str(name)
+    columns.append(column)
+  return columns
+
+# Schema of the row tables (image file rows etc.)
+ROW_COLUMNS = [{'name': 'image', 'dtype': 'str', 'shape': []}, {'name': 'row', 'dtype': '<i8', 'shape': []},
+               {'name': 'text', 'dtype': 'str', 'shape': []}]
+
+class ColumnarSink(object):
+  # path = results directory
+  # flush_every = number of committed images kept in memory before writing
+  # flush_seconds = write at the next commit once the oldest buffered image is this old
+  def __init__(self, path, flush_every=100, flush_seconds=30):
+    self.path = path
+    self.flush_every = flush_every
+    self.flush_seconds = flush_seconds
+    self.tables = {}
+    self.pending = {}
+    self.images = 0
+    self.first = None
+    self.parts = 0
+
+  ### Add a header/data record of an image
+  def add(self, image, header, data):
+    table = str(header[0])
+    self._check_table(table, lambda: table_schema(header, data), len(data) + 1)
+    self.pending.setdefault(table, []).append([image] + list(data))
+
+  ### Add free-form rows (e.g. the image file rows of the analysis functions) to a table
+  def add_rows(self, image, table, rows):
+    self._check_table(table, lambda: ROW_COLUMNS, 3)
+    for i, row in enumerate(rows):
+      self.pending.setdefault(table, []).append([image, i, '\t'.join(map(str, row))])
+
+  ### End the records of an image
+  def commit(self):
+    self.images += 1
+    if self.first is None:
+      self.first = time.time()
+    if self.images >= self.flush_every or time.time() - self.first >= self.flush_seconds:
+      self.flush()
+
+  ### Write the buffered records
+  def flush(self):
+    for table, rows in self.pending.items():
+      if not rows:
+        continue
+      columns = self.tables[table]
+      arrays = {}
+      for i, column in enumerate(columns):
+        values = [row[i] for row in rows]
+        try:
+          if column['dtype'] == 'str':
+            arrays[column['name']] = np.array([str(v) for v in values], dtype=np.str_)
+          else:
+            array = np.array(values, dtype=column['dtype']).reshape([len(rows)] + column['shape'])
+            # Integer columns (of older results directories) must not truncate fractions
+            if array.dtype.kind == 'i' and np.any(array != np.array(values, dtype=np.float64).reshape(array.shape)):
+              raise ValueError(column['name'])
+            arrays[column['name']] = array
+        except ValueError:
+          pcv.fatal_error('Values of ' + table + '.' + column['name'] + ' do not match the schema (' +
+                          column['dtype'] + ' ' + str(column['shape']) + ')!')
+      self._write_part(table, arrays)
+    self.pending = {}
+    self.images = 0
+    self.first = None
+
+  def _check_table(self, table, columns, width):
+    if table not in self.tables:
+      self.tables[table] = _register_table(self.path, table, columns())
+    if len(self.tables[table]) != width:
+      pcv.fatal_error('Table ' + table + ' has ' + str(len(self.tables[table])) + ' columns, got ' + str(width) + '!')
+
+  def _write_part(self, table, arrays):
+    directory = os.path.join(self.path, table)
+    _makedirs(directory)
+    self.parts += 1
+    name = 'part-' + socket.gethostname() + '-' + str(os.getpid()) + '-' + str(int(time.time())) + '-' + \
+           str(self.parts) + '.npz'
+    # Write and rename so readers never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+      np.savez(f, **arrays)
+    os.rename(tmp, os.path.join(directory, name))
+
+class TextSink(object):
+  # Tab-separated text results (the format the scripts used to write), buffered and appended in one write
+  def __init__(self, path, flush_every=100, flush_seconds=30):
+    self.path = path
+    self.flush_every = flush_every
+    self.flush_seconds = flush_seconds
+    self.lines = []
+    self.images = 0
+    self.first = None
+
+  def add(self, image, header, data):
+    self.lines.append('\t'.join(map(str, header)))
+    self.lines.append('\t'.join(map(str, data)))
+
+  def add_rows(self, image, table, rows):
+    for row in rows:
+      self.lines.append('\t'.join(map(str, row)))
+
+  def commit(self):
+    self.images += 1
+    if self.first is None:
+      self.first = time.time()
+    if self.images >= self.flush_every or time.time() - self.first >= self.flush_seconds:
+      self.flush()
+
+  def flush(self):
+    if self.lines:
+      text = '\n'.join(self.lines) + '\n'
+      fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+      try:
+        os.write(fd, text.encode('utf-8'))
+      finally:
+        os.close(fd)
+    self.lines = []
+    self.images = 0
+    self.first = None
+
+def _makedirs(directory):
+  if not os.path.exists(directory):
+    try:
+      os.makedirs(directory)
+    except OSError:
+      # Created by another worker in the meantime
+      pass
+  if not os.path.isdir(directory):
+    pcv.fatal_error('Results directory ' + directory + ' is a file!')
+
+### Add a table to the schema of a results directory, or check it against the stored one
+def _register_table(path, table, columns):
+  _makedirs(path)
+  with open(os.path.join(path, '.lock'), 'a') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+      schema = read_schema(path)
+      if table in schema['tables']:
+        stored = schema['tables'][table]
+        if [c['name'] for c in stored] != [c['name'] for c in columns]:
+          pcv.fatal_error('Columns of table ' + table + ' do not match ' + os.path.join(path, SCHEMA_FILE) + '!')
+        return stored
+      schema['tables'][table] = columns
+      fd, tmp = tempfile.mkstemp(dir=path, suffix='.tmp')
+      with os.fdopen(fd, 'w') as f:
+        json.dump(schema, f, indent=2)
+      os.rename(tmp, os.path.join(path, SCHEMA_FILE))
+      return columns
+    finally:
+      fcntl.flock(lock, fcntl.LOCK_UN)
+
+### Schema of a results directory
+def read_schema(path):
+  schema_file = os.path.join(path, SCHEMA_FILE)
+  if not os.path.exists(schema_file):
+    return {'version': 1, 'tables': {}}
+  with open(schema_file) as f:
+    return json.load(f)
+
+### Part files of a table
+def table_parts(path, table):
+  directory = os.path.join(path, table)
+  if not os.path.isdir(directory):
+    return []
+  return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.npz'))
+
+### Load a table as a dictionary of column arrays
+def load_table(path, table):
+  columns = read_schema(path)['tables'][table]
+  parts = [np.load(p) for p in table_parts(path, table)]
+  out = {}
+  for column in columns:
+    name = column['name']
+    if parts:
+      out[name] = np.concatenate([p[name] for p in parts])
+    else:
+      out[name] = np.zeros([0] + column['shape'], dtype=np.str_ if column['dtype'] == 'str' else column['dtype'])
+  return out
+
+### Merge the part files of a table into one
+def compact_table(path, table):
+  parts = table_parts(path, table)
+  if len(parts) < 2:
+    return len(parts)
+  data = load_table(path, table)
+  directory = os.path.join(path, table)
+  fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+  with os.fdopen(fd, 'wb') as f:
+    np.savez(f, **data)
+  os.rename(tmp, os.path.join(directory, 'part-compact-' + str(int(time.time())) + '.npz'))
+  for p in parts:
+    os.unlink(p)
+  return len(parts)
+
+### Write a table as tab-separated text (list columns as one field per value)
+def export_table(path, table, out):
+  columns = read_schema(path)['tables'][table]
+  data = load_table(path, table)
+  names = []
+  for column in columns:
+    if column['shape']:
+      names.extend(column['name'] + '_' + str(i) for i in range(int(np.prod(column['shape']))))
+    else:
+      names.append(column['name'])
+  out.write('\t'.join(names) + '\n')
+  rows = len(data['image'])
+  for i in range(rows):
+    fields = []
+    for column in columns:
+      value = data[column['name']][i]
+      if column['shape']:
+        fields.extend(map(str, np.ravel(value)))
+      else:
+        fields.append(str(value))
+    out.write('\t'.join(fields) + '\n')
+
+# Sinks of this process, flushed when the process exits
+_sinks = {}
+_sinks_pid = None
+
+### Format of a results path: 'text' unless asked for 'columnar' or the path ends in '/'
+def sink_format(path, fmt=None):
+  if fmt is None:
+    fmt = 'columnar' if path.endswith('/') else 'text'
+  if fmt not in ('text', 'columnar'):
+    pcv.fatal_error('Results format ' + str(fmt) + ' is not "text" or "columnar"!')
+  if fmt == 'columnar' and os.path.exists(path) and not os.path.isdir(path):
+    pcv.fatal_error('Results file ' + path + ' exists, columnar results need a directory!')
+  if fmt == 'text' and os.path.isdir(path):
+    pcv.fatal_error('Results path ' + path + ' is a directory, use the columnar format (-F columnar) for it!')
+  return fmt
+
+### Results sink for a path (one per path and process)
+def open_sink(path, flush_every=100, flush_seconds=30, fmt=None):
+  # fmt = 'text', 'columnar' or None (see sink_format)
+  global _sinks, _sinks_pid
+  if _sinks_pid != os.getpid():
+    # First sink of this process (forked workers start without the sinks of their parent)
+    _sinks = {}
+    _sinks_pid = os.getpid()
+    atexit.register(flush_all)
+    # multiprocessing workers leave through os._exit and only run multiprocessing finalizers
+    multiprocessing.util.Finalize(None, flush_all, exitpriority=10)
+  fmt = sink_format(path, fmt)
+  key = (os.path.abspath(path), fmt)
+  if key not in _sinks:
+    if fmt == 'text':
+      _sinks[key] = TextSink(path, flush_every, flush_seconds)
+    else:
+      _sinks[key] = ColumnarSink(path, flush_every, flush_seconds)
+  return _sinks[key]
+
+### Write the buffered records of all sinks
+def flush_all():
+  if _sinks_pid != os.getpid():
+    return
+  for sink in _sinks.values():
+    sink.flush()
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  schema = read_schema(args.results)
+  if args.compact:
+    for table in sorted(schema['tables']):
+      print(table + '\t' + str(compact_table(args.results, table)) + ' part files merged')
+  if args.table:
+    if args.table not in schema['tables']:
+      pcv.fatal_error('Table ' + str(args.table) + ' is not in ' + str(args.results) + '!')
+    if args.export:
+      with open(args.export, 'w') as out:
+        export_table(args.results, args.table, out)
+    else:
+      export_table(args.results, args.table, sys.stdout)
+  elif not args.compact:
+    for table in sorted(schema['tables']):
+      rows = sum(len(np.load(p)['image']) for p in table_parts(args.results, table))
+      print(table + '\t' + str(rows) + ' rows\t' + ', '.join(c['name'] for c in schema['tables'][table]))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,105 @@
+# ROI filtering of objects from a label image
+# pcv.roi_objects tests the contours from pcv.find_objects against the ROI one at a time ('partial' calls
+# cv2.pointPolygonTest for every point of every contour in Python), which is slow when a noisy mask has thousands of
+# fragments, and some scripts filter the same objects with several ROIs. RoiFilter labels the object mask once
+# (8-connected components, the objects pcv.find_objects returns contours for) and keeps the outer border pixels of
+# every object with their labels. An ROI is then one lookup of those pixels in the filled ROI, and the kept mask one
+# lookup of the label image.
+#
+# The results are the ones of pcv.roi_objects:
+#   partial: objects with a point of their outer contour inside or on the ROI are kept whole, except that pcv fills
+#            the hole contours of kept objects with the background, so holes lose their rim of 4-adjacent pixels and
+#            objects inside holes are dropped. pcv does not test the last point of a contour, so objects of one pixel
+#            are never kept.
+#   cutto:   the object pixels inside the ROI.
+# One difference remains for 'partial': an object of more than two pixels that only reaches the ROI with the last
+# point of its contour is kept here and not by pcv.
+#
+# Usage (drop-in for pcv.find_objects and pcv.roi_objects):
+#   objects = RoiFilter(mask)
+#   device, roi1, roi_hierarchy1 = pcv.define_roi(img, 'rectangle', device, None, 'default', args.debug, True, 0, 0, -1700, 0)
+#   device, roi_objects1, hierarchy1, kept_mask1, obj_area1 = objects.roi_objects(img, 'cutto', roi1, roi_hierarchy1,
+#                                                                                  device, args.debug)
+
+import cv2
+import numpy as np
+import plantcv as pcv
+
+CROSS = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+
+class RoiFilter(object):
+  # mask = binary mask of the objects (the mask given to pcv.find_objects)
+  def __init__(self, mask):
+    if len(np.shape(mask)) != 2:
+      pcv.fatal_error('The object mask must be a binary (single channel) image!')
+    self.mask = np.where(mask > 0, 255, 0).astype(np.uint8)
+    count, self.labels, stats, centroids = cv2.connectedComponentsWithStats(self.mask, connectivity=8)
+    self.areas = stats[:, cv2.CC_STAT_AREA]
+
+    # Background outside all objects: the 4-connected background around the image (as findContours pads it)
+    padded = cv2.copyMakeBorder(255 - self.mask, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=255)
+    background = cv2.connectedComponents(padded, connectivity=4)[1]
+    outside = np.where(background == background[0, 0], 255, 0).astype(np.uint8)
+
+    # Outer border pixels of the objects not inside a hole of another object, with their labels
+    border = cv2.dilate(outside, CROSS)[1:-1, 1:-1] & self.mask
+    border_y, border_x = np.nonzero(border)
+    border_labels = self.labels[border_y, border_x]
+    top = np.zeros(count, dtype=bool)
+    top[border_labels] = True
+    top[0] = False
+    self.top = top
+
+    # pcv does not test the last point of a contour: objects of one pixel are never kept, objects of two pixels only
+    # by their first pixel (where findContours starts, the first in raster order like np.nonzero)
+    tested = self.areas[border_labels] > 2
+    first = np.unique(border_labels, return_index=True)[1]
+    tested[first[self.areas[border_labels[first]] == 2]] = True
+    self.border_y = border_y[tested]
+    self.border_x = border_x[tested]
+    self.border_labels = border_labels[tested]
+
+    # Holes of the top-level objects and everything in them, grown by their rim
+    inner = (outside[1:-1, 1:-1] == 0) & ~top[self.labels]
+    self.holes = cv2.dilate(inner.astype(np.uint8), CROSS) > 0
+
+  ### Filled ROI contour
+  def roi_mask(self, roi_contour):
+    roi = np.zeros(self.mask.shape, dtype=np.uint8)
+    cv2.fillPoly(roi, [np.vstack(roi_contour[0])], 255)
+    return roi
+
+  ### Labels of the objects kept by an ROI ('partial'), as a lookup table of the label image
+  def kept_labels(self, roi):
+    keep = np.zeros(len(self.areas), dtype=bool)
+    keep[self.border_labels[roi[self.border_y, self.border_x] > 0]] = True
+    keep &= self.top
+    return keep
+
+  ### Drop-in for pcv.roi_objects(img, roi_type, roi_contour, roi_hierarchy, object_contour, obj_hierarchy, device, debug)
+  def roi_objects(self, img, roi_type, roi_contour, roi_hierarchy, device, debug=False):
+    # img = image the kept objects are drawn on for debug
+    # roi_type = 'partial' (keep objects touching the ROI) or 'cutto' (cut objects to the ROI)
+    # roi_contour, roi_hierarchy = ROI from pcv.define_roi
+    # Returns the kept contours and hierarchy, the kept mask and its area, as pcv.roi_objects
+    device += 1
+    roi = self.roi_mask(roi_contour)
+    if roi_type == 'partial':
+      kept_mask = np.where(self.kept_labels(roi)[self.labels] & ~self.holes, 255, 0).astype(np.uint8)
+    elif roi_type == 'cutto':
+      kept_mask = self.mask & roi
+    else:
+      pcv.fatal_error('ROI Type' + str(roi_type) + ' is not "cutto" or "partial"!')
+    obj_area = cv2.countNonZero(kept_mask)
+    # OpenCV 2/4 return (contours, hierarchy), OpenCV 3 returns (image, contours, hierarchy)
+    kept_cnt, hierarchy = cv2.findContours(np.copy(kept_mask), cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[-2:]
+
+    if debug:
+      w_back = cv2.cvtColor(255 - kept_mask, cv2.COLOR_GRAY2BGR)
+      ori_img = np.copy(img) if len(np.shape(img)) == 3 else cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+      cv2.drawContours(ori_img, kept_cnt, -1, (0, 255, 0), -1, lineType=8, hierarchy=hierarchy)
+      cv2.drawContours(ori_img, roi_contour, -1, (255, 0, 0), 5, lineType=8, hierarchy=roi_hierarchy)
+      pcv.print_image(w_back, (str(device) + '_roi_objects.png'))
+      pcv.print_image(ori_img, (str(device) + '_obj_on_img.png'))
+      pcv.print_image(kept_mask, (str(device) + '_roi_mask.png'))
+    return device, kept_cnt, hierarchy, kept_mask, obj_area
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+# RGB -> mask lookup tables for pixel-wise threshold chains
+# A chain like "HSV s > 36 AND LAB b > 138" only depends on the color of each pixel, so it can be evaluated
+# once for all 256^3 colors and stored as a lookup table. Segmenting an image is then a single gather.
+#
+# A stage is a dictionary (or JSON object):
+#   {"combine": "and", "thresholds": [{"space": "hsv", "channel": "s", "threshold": 36, "object_type": "light"},
+#                                     {"space": "lab", "channel": "b", "threshold": 138, "object_type": "light"}]}
+# space is 'hsv', 'lab' or 'gray'; object_type follows pcv.binary_threshold ('light' keeps pixels > threshold,
+# 'dark' keeps pixels <= threshold); combine is 'and' or 'or'.
+#
+# Tables are built once per stage and cached on disk (see cache_dir), so all workers share them.
+# To prebuild the tables of a parameter file (JSON object of name: stage):
+#   python threshold_lut.py -s stages.json
+
+import argparse
+import os
+import json
+import hashlib
+import tempfile
+import cv2
+import numpy as np
+import plantcv as pcv
+
+CONVERSIONS = {
+  'hsv': (cv2.COLOR_BGR2HSV, ('h', 's', 'v')),
+  'lab': (cv2.COLOR_BGR2LAB, ('l', 'a', 'b')),
+  'gray': (cv2.COLOR_BGR2GRAY, ('gray',))
+}
+# Index of a pixel in the table is (blue << 16) | (green << 8) | red
+MASK_COLOR_INDEX = {
+  'white': 0xFFFFFF,
+  'black': 0
+}
+
+### Parse command-line arguments
+def options():
+  parser = argparse.ArgumentParser(description="Build RGB to mask lookup tables for threshold stages.")
+  parser.add_argument("-s", "--stages", help="JSON file with named threshold stages.", required=True)
+  parser.add_argument("-c", "--cache", help="Lookup table cache directory.", required=False)
+  args = parser.parse_args()
+  return args
+
+### Default cache directory
+def cache_dir():
+  return os.getenv('PLANTCV_LUT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'plantcv-dev-scripts', 'luts'))
+
+### Check a stage definition and return it in canonical form
+def check_stage(stage):
+  combine = stage.get('combine', 'and')
+  if combine not in ('and', 'or'):
+    pcv.fatal_error('Combine ' + str(combine) + ' is not "and" or "or"!')
+  thresholds = []
+  for t in stage['thresholds']:
+    if t['space'] not in CONVERSIONS:
+      pcv.fatal_error('Color space ' + str(t['space']) + ' is not ' + ', '.join(sorted(CONVERSIONS)) + '!')
+    channels = CONVERSIONS[t['space']][1]
+    channel = t.get('channel', channels[0])
+    if channel not in channels:
+      pcv.fatal_error('Channel ' + str(channel) + ' is not ' + ', '.join(channels) + '!')
+    if t['object_type'] not in ('light', 'dark'):
+      pcv.fatal_error('Object type ' + str(t['object_type']) + ' is not "light" or "dark"!')
+    thresholds.append({'space': t['space'], 'channel': channel, 'threshold': int(t['threshold']),
+                       'object_type': t['object_type']})
+  return {'combine': combine, 'thresholds': thresholds}
+
+### Cache key of a stage
+def stage_key(stage):
+  text = json.dumps(check_stage(stage), sort_keys=True)
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+### Evaluate a stage for every 24-bit color
+def build_lut(stage):
+  stage = check_stage(stage)
+  lut = np.zeros((256, 256, 256), dtype=np.uint8)
+  # One blue level at a time: a 256x256 image holding every (green, red) pair
+  green, red = np.mgrid[0:256, 0:256].astype(np.uint8)
+  plane = np.zeros((256, 256, 3), dtype=np.uint8)
+  plane[:, :, 1] = green
+  plane[:, :, 2] = red
+  for blue in range(256):
+    plane[:, :, 0] = blue
+    converted = {}
+    keep = None
+    for t in stage['thresholds']:
+      if t['space'] not in converted:
+        code, channels = CONVERSIONS[t['space']]
+        img = cv2.cvtColor(plane, code)
+        converted[t['space']] = dict(zip(channels, cv2.split(img))) if img.ndim == 3 else {'gray': img}
+      values = converted[t['space']][t['channel']]
+      if t['object_type'] == 'light':
+        passed = values > t['threshold']
+      else:
+        passed = values <= t['threshold']
+      if keep is None:
+        keep = passed
+      elif stage['combine'] == 'and':
+        keep &= passed
+      else:
+        keep |= passed
+    lut[blue][keep] = 255
+  return lut.reshape(-1)
+
+### Load a stage table from the cache, building and saving it if needed
+def load_lut(stage, directory=None):
+  if directory is None:
+    directory = cache_dir()
+  path = os.path.join(directory, stage_key(stage) + '.npy')
+  if not os.path.exists(path):
+    lut = build_lut(stage)
+    if not os.path.exists(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        # Created by another worker in the meantime
+        pass
+    # Write and rename so concurrent workers never read a partial table
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.npy')
+    with os.fdopen(fd, 'wb') as f:
+      np.save(f, lut)
+    os.rename(tmp, path)
+  return ThresholdLUT(np.load(path, mmap_mode='r'), stage)
+
+class ThresholdLUT(object):
+  # lut = flat table of 256^3 mask values (0 or 255)
+  # stage = stage definition the table was built from
+  def __init__(self, lut, stage):
+    self.lut = lut
+    self.stage = check_stage(stage)
+
+  ### Mask of an image
+  def apply(self, img, mask=None, mask_color='white', out=None):
+    # img = BGR image object
+    # mask = optional binary mask; pixels outside it are evaluated as if the image had been masked with
+    #        pcv.apply_mask(img, mask, mask_color), without building the masked image
+    # out = optional uint8 array with the image height and width to write the mask into
+    index = img[:, :, 0].astype(np.uint32)
+    index <<= 8
+    index |= img[:, :, 1]
+    index <<= 8
+    index |= img[:, :, 2]
+    out = np.take(self.lut, index, out=out)
+    if mask is not None:
+      if mask_color not in MASK_COLOR_INDEX:
+        pcv.fatal_error('Mask Color ' + str(mask_color) + ' is not "white" or "black"!')
+      out[mask == 0] = self.lut[MASK_COLOR_INDEX[mask_color]]
+    return out
+
+  ### Pipeline step version of apply, counts the device and prints a debug image
+  def threshold(self, img, device, debug=False, mask=None, mask_color='white', steps=1):
+    # steps = pcv steps the table replaces (conversions, thresholds, joins), so later debug images keep their numbers
+    out = self.apply(img, mask, mask_color)
+    device += steps
+    if debug:
+      pcv.print_image(out, (str(device) + '_lut_threshold.png'))
+    return device, out
+
+### Main pipeline
+def main():
+  # Get options
+  args = options()
+
+  with open(args.stages) as f:
+    stages = json.load(f)
+  for name in sorted(stages):
+    lut = load_lut(stages[name], args.cache)
+    print(name + '\t' + stage_key(stages[name]) + '\t' + str(int(np.count_nonzero(lut.lut))) + ' colors kept')
+
+if __name__ == '__main__':
+  main()
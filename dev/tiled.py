@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# Strip-wise (tiled) processing of very large images
+# Flatbed scans and full-resolution camera frames make every pcv step allocate several full-size copies (a 3-channel
+# color conversion, its split planes, one mask per threshold, a 3-channel masked image per apply_mask). The steps that
+# only look at a pixel and a small neighbourhood (color conversions, thresholds, logical operations, masking, median
+# blur, erosion and dilation) give the same result when they are run on horizontal strips of the image, as long as
+# every strip is read with enough extra rows (a halo) for the neighbourhood. map_strips runs such a chain strip by
+# strip and stitches the core rows into one single-channel mask, so the temporaries are bounded by the strip size
+# whatever the image size. Steps that need whole objects (pcv.fill, find_objects, the analysis) run on the stitched
+# mask, the only full-size array besides the image. The histograms of analyze_color, which converts the whole image to
+# LAB and HSV, are counted strip by strip (MaskStats).
+#
+# Halo of the neighbourhood steps: median blur ksize // 2, erode/dilate iterations * (ksize // 2), pixel-wise 0.
+#
+# Usage in a pipeline:
+#   def segment(strip):
+#     s = cv2.cvtColor(strip, cv2.COLOR_BGR2HSV)[:, :, 1]
+#     return cv2.medianBlur(np.where(s > 85, 255, 0).astype(np.uint8), 5)
+#   mask = map_strips(segment, img, args.strip, halo=2)
+#   color_header, color_data = color_histogram_data(img, kept_mask, args.strip)
+
+import numpy as np
+import plantcv as pcv
+from color_histograms import channel_list, color_histograms, bin_counts, histogram_data
+
+# Default strip height (rows)
+STRIP_ROWS = 1024
+
+### Strip bounds of an image: (top, bottom) of the core rows and (lo, hi) of the rows read with the halo
+def strips(height, rows=STRIP_ROWS, halo=0):
+  if rows < 1:
+    pcv.fatal_error('Strip height ' + str(rows) + ' is not a positive number of rows!')
+  for top in range(0, height, rows):
+    bottom = min(top + rows, height)
+    yield top, bottom, max(top - halo, 0), min(bottom + halo, height)
+
+### Run a per-strip segmentation over an image and stitch the strip masks
+def map_strips(func, img, rows=STRIP_ROWS, halo=0, out=None):
+  # func = function of a strip of img (rows lo:hi) returning a single-channel mask of the same rows
+  # halo = extra rows read above and below every strip (neighbourhood of func)
+  # out = mask to write into (a new uint8 mask if None)
+  # Returns the stitched mask
+  height, width = np.shape(img)[:2]
+  if out is None:
+    out = np.empty((height, width), dtype=np.uint8)
+  for top, bottom, lo, hi in strips(height, rows, halo):
+    strip_mask = func(img[lo:hi])
+    out[top:bottom] = strip_mask[top - lo:bottom - lo]
+  return out
+
+### Strips of an image and its mask (without halo), as (top, image strip, mask strip)
+def masked_strips(img, mask, rows=STRIP_ROWS):
+  for top, bottom, lo, hi in strips(np.shape(img)[0], rows):
+    yield top, img[top:bottom], mask[top:bottom]
+
+class MaskStats(object):
+  # Color histograms of the masked pixels of an image, accumulated strip by strip
+  # channels = channel set or channel keys of color_histograms ('all' for the rows of analyze_color)
+  def __init__(self, channels='all'):
+    self.channels = channels
+    self.counts = np.zeros((len(channel_list(channels)), 256), dtype=np.int64)
+
+  ### Add a strip of the image and its mask
+  def add(self, strip, strip_mask):
+    self.counts += color_histograms(strip, strip_mask, 256, self.channels, 'even')
+
+  ### Histograms of the strips added so far (see color_histograms for the binning)
+  def histograms(self, bins=256, binning='analyze_color'):
+    return bin_counts(self.counts, bins, binning)
+
+  ### HEADER_HISTOGRAM and HISTOGRAM_DATA rows of the histograms
+  def histogram_data(self, bins=256, binning='analyze_color'):
+    return histogram_data(self.histograms(bins, binning), self.channels, binning)
+
+### Histogram rows of analyze_color(img, ..., mask, bins, ...), counted strip by strip (no color images are made)
+def color_histogram_data(img, mask, rows=STRIP_ROWS, bins=256):
+  stats = MaskStats('all')
+  for top, strip, strip_mask in masked_strips(img, mask, rows):
+    stats.add(strip, strip_mask)
+  return stats.histogram_data(bins)
@@ -5,6 +5,7 @@ import numpy as np
 import argparse
 import string
 import plantcv as pcv
+import tiled
 
 ### Parse command-line arguments
 def options():
@@ -13,9 +14,25 @@ def options():
   parser.add_argument("-m", "--roi", help="Input region of interest file.", required=False)
   parser.add_argument("-o", "--outdir", help="Output directory for image files.", required=True)
   parser.add_argument("-D", "--debug", help="Turn on debug, prints intermediate images.", action="store_true")
+  parser.add_argument("-s", "--strip", help="Segment the image in strips of this many rows (bounded memory).",
+                      type=int, required=False)
   args = parser.parse_args()
   return args
 
+### Segmentation of a strip of the image (the steps of main up to the fill, on the strip's rows)
+def segment_strip(strip):
+  # The 5 x 5 median blur needs a halo of 2 rows
+  s = cv2.cvtColor(strip, cv2.COLOR_BGR2HSV)[:, :, 1]
+  s_mblur = cv2.medianBlur(np.where(s > 85, 255, 0).astype(np.uint8), 5)
+  b = cv2.cvtColor(strip, cv2.COLOR_BGR2LAB)[:, :, 2]
+  bs = (s_mblur > 0) | (b > 160)
+  masked = np.where(bs[:, :, np.newaxis], strip, 255).astype(np.uint8)
+  masked_lab = cv2.cvtColor(masked, cv2.COLOR_BGR2LAB)
+  masked_a = masked_lab[:, :, 1]
+  masked_b = masked_lab[:, :, 2]
+  ab = (masked_a <= 115) | (masked_b > 128) | (masked_a > 135)
+  return np.where(ab, 255, 0).astype(np.uint8)
+
 ### Main pipeline
 def main():
   # Get options
@@ -28,54 +45,65 @@ def main():
   # Pipeline step
   device = 0
 
-  # Convert RGB to HSV and extract the Saturation channel
-  device, s = pcv.rgb2gray_hsv(img, 's', device, args.debug)
+  if args.strip:
+    # Segment strip by strip, only the mask is full size (the 17 steps below)
+    ab = tiled.map_strips(segment_strip, img, args.strip, halo=2)
+    ab_cnt = np.copy(ab)
+    device += 17
+  else:
+    # Convert RGB to HSV and extract the Saturation channel
+    device, s = pcv.rgb2gray_hsv(img, 's', device, args.debug)
   
-  # Threshold the Saturation image
-  device, s_thresh = pcv.binary_threshold(s, 85, 255, 'light', device, args.debug)
+    # Threshold the Saturation image
+    device, s_thresh = pcv.binary_threshold(s, 85, 255, 'light', device, args.debug)
   
-  # Median Filter
-  device, s_mblur = pcv.median_blur(s_thresh, 5, device, args.debug)
-  device, s_cnt = pcv.median_blur(s_thresh, 5, device, args.debug)
+    # Median Filter
+    device, s_mblur = pcv.median_blur(s_thresh, 5, device, args.debug)
+    device, s_cnt = pcv.median_blur(s_thresh, 5, device, args.debug)
   
-  # Fill small objects
-  #device, s_fill = pcv.fill(s_mblur, s_cnt, 0, device, args.debug)
+    # Fill small objects
+    #device, s_fill = pcv.fill(s_mblur, s_cnt, 0, device, args.debug)
   
-  # Convert RGB to LAB and extract the Blue channel
-  device, b = pcv.rgb2gray_lab(img, 'b', device, args.debug)
+    # Convert RGB to LAB and extract the Blue channel
+    device, b = pcv.rgb2gray_lab(img, 'b', device, args.debug)
   
-  # Threshold the blue image
-  device, b_thresh = pcv.binary_threshold(b, 160, 255, 'light', device, args.debug)
-  device, b_cnt = pcv.binary_threshold(b, 160, 255, 'light', device, args.debug)
+    # Threshold the blue image
+    device, b_thresh = pcv.binary_threshold(b, 160, 255, 'light', device, args.debug)
+    device, b_cnt = pcv.binary_threshold(b, 160, 255, 'light', device, args.debug)
   
-  # Fill small objects
-  #device, b_fill = pcv.fill(b_thresh, b_cnt, 10, device, args.debug)
+    # Fill small objects
+    #device, b_fill = pcv.fill(b_thresh, b_cnt, 10, device, args.debug)
   
-  # Join the thresholded saturation and blue-yellow images
-  device, bs = pcv.logical_or(s_mblur, b_cnt, device, args.debug)
+    # Join the thresholded saturation and blue-yellow images
+    device, bs = pcv.logical_or(s_mblur, b_cnt, device, args.debug)
   
-  # Apply Mask (for vis images, mask_color=white)
-  device, masked = pcv.apply_mask(img, bs, 'white', device, args.debug)
+    # Apply Mask (for vis images, mask_color=white)
+    device, masked = pcv.apply_mask(img, bs, 'white', device, args.debug)
   
-  # Convert RGB to LAB and extract the Green-Magenta and Blue-Yellow channels
-  device, masked_a = pcv.rgb2gray_lab(masked, 'a', device, args.debug)
-  device, masked_b = pcv.rgb2gray_lab(masked, 'b', device, args.debug)
+    # Convert RGB to LAB and extract the Green-Magenta and Blue-Yellow channels
+    device, masked_a = pcv.rgb2gray_lab(masked, 'a', device, args.debug)
+    device, masked_b = pcv.rgb2gray_lab(masked, 'b', device, args.debug)
   
-  # Threshold the green-magenta and blue images
-  device, maskeda_thresh = pcv.binary_threshold(masked_a, 115, 255, 'dark', device, args.debug)
-  device, maskeda_thresh1 = pcv.binary_threshold(masked_a, 135, 255, 'light', device, args.debug)
-  device, maskedb_thresh = pcv.binary_threshold(masked_b, 128, 255, 'light', device, args.debug)
+    # Threshold the green-magenta and blue images
+    device, maskeda_thresh = pcv.binary_threshold(masked_a, 115, 255, 'dark', device, args.debug)
+    device, maskeda_thresh1 = pcv.binary_threshold(masked_a, 135, 255, 'light', device, args.debug)
+    device, maskedb_thresh = pcv.binary_threshold(masked_b, 128, 255, 'light', device, args.debug)
   
-  # Join the thresholded saturation and blue-yellow images (OR)
-  device, ab1 = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
-  device, ab = pcv.logical_or(maskeda_thresh1, ab1, device, args.debug)
-  device, ab_cnt = pcv.logical_or(maskeda_thresh1, ab1, device, args.debug)
+    # Join the thresholded saturation and blue-yellow images (OR)
+    device, ab1 = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
+    device, ab = pcv.logical_or(maskeda_thresh1, ab1, device, args.debug)
+    device, ab_cnt = pcv.logical_or(maskeda_thresh1, ab1, device, args.debug)
   
   # Fill small objects
   device, ab_fill = pcv.fill(ab, ab_cnt, 200, device, args.debug)
   
   # Apply mask (for vis images, mask_color=white)
-  device, masked2 = pcv.apply_mask(masked, ab_fill, 'white', device, args.debug)
+  if args.strip:
+    # find_objects and define_roi only draw on it, skip the full-size masked copy
+    masked2 = img
+    device += 1
+  else:
+    device, masked2 = pcv.apply_mask(masked, ab_fill, 'white', device, args.debug)
   
   # Identify objects
   device, id_objects,obj_hierarchy = pcv.find_objects(masked2, ab_fill, device, args.debug)
@@ -98,7 +126,13 @@ def main():
   device, boundary_header,boundary_data, boundary_img1= pcv.analyze_bound(img, args.image,obj, mask, 1680, device,args.debug,args.outdir+'/'+filename)
   
   # Determine color properties: Histograms, Color Slices and Pseudocolored Images, output color analyzed images (optional)
-  device, color_header,color_data,norm_slice= pcv.analyze_color(img, args.image, kept_mask, 256, device, args.debug,'all','rgb','v','img',300,args.outdir+'/'+filename)
+  if args.strip:
+    # Histograms of analyze_color strip by strip, without its full-size color conversions (no color images)
+    color_header, color_data = tiled.color_histogram_data(img, kept_mask, args.strip)
+    norm_slice = []
+    device += 1
+  else:
+    device, color_header,color_data,norm_slice= pcv.analyze_color(img, args.image, kept_mask, 256, device, args.debug,'all','rgb','v','img',300,args.outdir+'/'+filename)
   
   # Output shape and color data
   pcv.print_results(args.image, shape_header, shape_data)
@@ -5,6 +5,7 @@ import numpy as np
 import argparse
 import string
 import plantcv as pcv
+import tiled
 
 ### Parse command-line arguments
 def options():
@@ -13,9 +14,17 @@ def options():
   parser.add_argument("-m", "--roi", help="Input region of interest file.", required=False)
   parser.add_argument("-o", "--outdir", help="Output directory for image files.", required=True)
   parser.add_argument("-D", "--debug", help="Turn on debug, prints intermediate images.", action="store_true")
+  parser.add_argument("-s", "--strip", help="Segment the image in strips of this many rows (bounded memory).",
+                      type=int, required=False)
   args = parser.parse_args()
   return args
 
+### Segmentation of a strip of the image (the LAB thresholds of main, on the strip's rows)
+def segment_strip(strip):
+  lab = cv2.cvtColor(strip, cv2.COLOR_BGR2LAB)
+  ab = (lab[:, :, 1] <= 135) | (lab[:, :, 2] > 140)
+  return np.where(ab, 255, 0).astype(np.uint8)
+
 ### Main pipeline
 def main():
   # Get options
@@ -57,23 +66,34 @@ def main():
   ## Apply Mask (for vis images, mask_color=white)
   #device, masked = pcv.apply_mask(img, bs, 'white', device, args.debug)
   
-  # Convert RGB to LAB and extract the Green-Magenta and Blue-Yellow channels
-  device, masked_a = pcv.rgb2gray_lab(img, 'a', device, args.debug)
-  device, masked_b = pcv.rgb2gray_lab(img, 'b', device, args.debug)
+  if args.strip:
+    # Segment strip by strip, only the mask is full size (the 6 steps below)
+    ab = tiled.map_strips(segment_strip, img, args.strip)
+    ab_cnt = np.copy(ab)
+    device += 6
+  else:
+    # Convert RGB to LAB and extract the Green-Magenta and Blue-Yellow channels
+    device, masked_a = pcv.rgb2gray_lab(img, 'a', device, args.debug)
+    device, masked_b = pcv.rgb2gray_lab(img, 'b', device, args.debug)
+  
+    # Threshold the green-magenta and blue images
+    device, maskeda_thresh = pcv.binary_threshold(masked_a, 135, 255, 'dark', device, args.debug)
+    device, maskedb_thresh = pcv.binary_threshold(masked_b, 140, 255, 'light', device, args.debug)
   
-  # Threshold the green-magenta and blue images
-  device, maskeda_thresh = pcv.binary_threshold(masked_a, 135, 255, 'dark', device, args.debug)
-  device, maskedb_thresh = pcv.binary_threshold(masked_b, 140, 255, 'light', device, args.debug)
-#  
-#  # Join the thresholded saturation and blue-yellow images (OR)
-  device, ab = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
-  device, ab_cnt = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
+    # Join the thresholded saturation and blue-yellow images (OR)
+    device, ab = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
+    device, ab_cnt = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
   
   # Fill small objects
   device, ab_fill = pcv.fill(ab, ab_cnt, 1000, device, args.debug)
   
   # Apply mask (for vis images, mask_color=white)
-  device, masked2 = pcv.apply_mask(img, ab_fill, 'white', device, args.debug)
+  if args.strip:
+    # find_objects and define_roi only draw on it, skip the full-size masked copy
+    masked2 = img
+    device += 1
+  else:
+    device, masked2 = pcv.apply_mask(img, ab_fill, 'white', device, args.debug)
   
   # Identify objects
   device, id_objects,obj_hierarchy = pcv.find_objects(masked2, ab_fill, device, args.debug)
@@ -96,7 +116,13 @@ def main():
   #device, boundary_header,boundary_data, boundary_img1= pcv.analyze_bound(img, args.image,obj, mask, 1680, device,args.debug,args.outdir+'/'+filename)
   
   # Determine color properties: Histograms, Color Slices and Pseudocolored Images, output color analyzed images (optional)
-  device, color_header,color_data,norm_slice= pcv.analyze_color(img, args.image, kept_mask, 256, device, args.debug,'all','rgb','v','img',300,args.outdir+'/'+filename)
+  if args.strip:
+    # Histograms of analyze_color strip by strip, without its full-size color conversions (no color images)
+    color_header, color_data = tiled.color_histogram_data(img, kept_mask, args.strip)
+    norm_slice = []
+    device += 1
+  else:
+    device, color_header,color_data,norm_slice= pcv.analyze_color(img, args.image, kept_mask, 256, device, args.debug,'all','rgb','v','img',300,args.outdir+'/'+filename)
   
   # Output shape and color data
   pcv.print_results(args.image, shape_header, shape_data)
@@ -8,6 +8,7 @@ import numpy as np
 import argparse
 import string
 import plantcv as pcv
+import tiled
 
 
 def options():
@@ -17,9 +18,32 @@ def options():
     parser.add_argument("-r","--result", help="result file.", required= False )
     parser.add_argument("-w","--writeimg", help="write out images.", default=False, action="store_true")
     parser.add_argument("-D", "--debug", help="Turn on debug, prints intermediate images.", default=None)
+    parser.add_argument("-s", "--strip", help="Segment the image in strips of this many rows (bounded memory).",
+                        type=int, required=False)
     args = parser.parse_args()
     return args
 
+### Brightness correction of a channel by its histogram peak (inverts the result as main does)
+def correct_brightness(gray, hmax):
+  alpha = 255 / float(hmax)
+  return 255 - np.asarray(np.where(gray <= hmax, np.multiply(alpha, gray), 255), np.uint8)
+
+### Segmentation of the image strip by strip (the steps of main up to the fill)
+def segment_strips(img, rows):
+  # cv2.calcHist(tuple(gray), ...) in main only reads the first array of the tuple, so the histogram peaks come from
+  # the first image row
+  first = cv2.cvtColor(img[:1], cv2.COLOR_BGR2HSV)
+  sat_hmax = np.argmax(np.bincount(255 - first[0, :, 1], minlength=256))
+  val_hmax = np.argmax(np.bincount(first[0, :, 2], minlength=256))
+
+  def segment_strip(strip):
+    hsv = cv2.cvtColor(strip, cv2.COLOR_BGR2HSV)
+    sat_img2 = correct_brightness(255 - hsv[:, :, 1], sat_hmax)
+    val_img2 = correct_brightness(hsv[:, :, 2], val_hmax)
+    return np.where((sat_img2 > 35) | (val_img2 > 35), 255, 0).astype(np.uint8)
+
+  return tiled.map_strips(segment_strip, img, rows)
+
 ### Main pipeline
 def main():
   # Get options
@@ -31,51 +55,56 @@ def main():
   # Pipeline step
   device = 0
   
-  # Convert RGB to HSV and extract the Value channel
-  device, img_gray_val = pcv.rgb2gray_hsv(img, 'v', device, args.debug)
+  if args.strip:
+    # Segment strip by strip, only the mask is full size (the 4 steps below)
+    img_binary = segment_strips(img, args.strip)
+    device += 4
+  else:
+    # Convert RGB to HSV and extract the Value channel
+    device, img_gray_val = pcv.rgb2gray_hsv(img, 'v', device, args.debug)
 
-  # Convert RGB to HSV and extract the Saturation channel
-  device, img_gray_sat = pcv.rgb2gray_hsv(img, 's', device, args.debug)
-  img_gray_sat = 255-img_gray_sat 
+    # Convert RGB to HSV and extract the Saturation channel
+    device, img_gray_sat = pcv.rgb2gray_hsv(img, 's', device, args.debug)
+    img_gray_sat = 255-img_gray_sat 
   
-  #Corrects image brightness using inverted Saturation image
-  #Original histogram
-  sat_hist = cv2.calcHist(tuple(img_gray_sat), [0], None, [256], [0, 256])
+    #Corrects image brightness using inverted Saturation image
+    #Original histogram
+    sat_hist = cv2.calcHist(tuple(img_gray_sat), [0], None, [256], [0, 256])
   
-  # Calculates index of maximum of histogram and finds alpha based on the peak
-  sat_hmax = np.argmax(sat_hist)
-  sat_alpha = 255 / float(sat_hmax)
+    # Calculates index of maximum of histogram and finds alpha based on the peak
+    sat_hmax = np.argmax(sat_hist)
+    sat_alpha = 255 / float(sat_hmax)
   
-  # Converts image and plots to screen
-  sat_img2 = (img_gray_sat)
-  sat_img2 = np.asarray(np.where(sat_img2 <= sat_hmax, np.multiply(sat_alpha,sat_img2), 255), np.uint8)
+    # Converts image and plots to screen
+    sat_img2 = (img_gray_sat)
+    sat_img2 = np.asarray(np.where(sat_img2 <= sat_hmax, np.multiply(sat_alpha,sat_img2), 255), np.uint8)
   
-  #Reinverts Saturation Image
-  sat_img2 = 255-sat_img2
+    #Reinverts Saturation Image
+    sat_img2 = 255-sat_img2
   
-  #Corrects image brightness using inverted Value image
-  #Original histogram
-  val_hist = cv2.calcHist(tuple(img_gray_val), [0], None, [256], [0, 256])
+    #Corrects image brightness using inverted Value image
+    #Original histogram
+    val_hist = cv2.calcHist(tuple(img_gray_val), [0], None, [256], [0, 256])
 
-  # Calculates index of maximum of histogram and finds alpha based on the peak
-  val_hmax = np.argmax(val_hist)
-  val_alpha = 255 / float(val_hmax)
+    # Calculates index of maximum of histogram and finds alpha based on the peak
+    val_hmax = np.argmax(val_hist)
+    val_alpha = 255 / float(val_hmax)
 
-  # Converts image and plots to screen
-  val_img2 = (img_gray_val)
-  val_img2 = np.asarray(np.where(val_img2 <= val_hmax, np.multiply(val_alpha,val_img2), 255), np.uint8)
+    # Converts image and plots to screen
+    val_img2 = (img_gray_val)
+    val_img2 = np.asarray(np.where(val_img2 <= val_hmax, np.multiply(val_alpha,val_img2), 255), np.uint8)
 
-  #Reinverts Value Image
-  val_img2 = 255-val_img2
+    #Reinverts Value Image
+    val_img2 = 255-val_img2
   
-  # Threshold the Saturation image
-  device, sat_img_binary = pcv.binary_threshold(sat_img2, 35, 255, 'light', device, args.debug)
+    # Threshold the Saturation image
+    device, sat_img_binary = pcv.binary_threshold(sat_img2, 35, 255, 'light', device, args.debug)
   
-  # Threshold the Value image
-  device, val_img_binary = pcv.binary_threshold(val_img2, 35, 255, 'light', device, args.debug)
+    # Threshold the Value image
+    device, val_img_binary = pcv.binary_threshold(val_img2, 35, 255, 'light', device, args.debug)
   
-  #Combines Saturation and Value Images
-  img_binary = np.where(sat_img_binary<255, val_img_binary,sat_img_binary)
+    #Combines Saturation and Value Images
+    img_binary = np.where(sat_img_binary<255, val_img_binary,sat_img_binary)
   
   # Fills in speckles using fill
   mask = np.copy(img_binary)
@@ -93,18 +122,20 @@ def main():
   # Object combine kept objects
   device, obj, mask = pcv.object_composition(img, roi_objects, roi_obj_hierarchy, device, args.debug)
   
-  # Masked image
-  device, masked = pcv.apply_mask(img, mask, 'white', device, args.debug)
+  # The infected tissue masks are not used by the analysis below, strip mode skips their full-size copies
+  if not args.strip:
+    # Masked image
+    device, masked = pcv.apply_mask(img, mask, 'white', device, args.debug)
   
-  # Identify infected tissue
-  device, img_lab = pcv.rgb2gray_lab(masked, 'a', device, args.debug)
-  device, img_hsv = pcv.rgb2gray_hsv(masked, 'v', device, args.debug)
+    # Identify infected tissue
+    device, img_lab = pcv.rgb2gray_lab(masked, 'a', device, args.debug)
+    device, img_hsv = pcv.rgb2gray_hsv(masked, 'v', device, args.debug)
 
-  device, disease_a = pcv.binary_threshold(img_lab, 35, 255, 'light', device, args.debug)
-  device, disease_b = pcv.binary_threshold(img_hsv, 35, 255, 'light', device, args.debug)
+    device, disease_a = pcv.binary_threshold(img_lab, 35, 255, 'light', device, args.debug)
+    device, disease_b = pcv.binary_threshold(img_hsv, 35, 255, 'light', device, args.debug)
+  else:
+    device += 5
   
-
-   
   # ############## VIS Analysis ################
   
   outfile=False
@@ -115,7 +146,13 @@ def main():
   device, shape_header,shape_data,shape_img = pcv.analyze_object(img, args.image, obj, mask, device,args.debug,outfile)
   
   # Determine color properties: Histograms, Color Slices and Pseudocolored Images, output color analyzed images (optional)
-  device, color_header,color_data,color_img= pcv.analyze_color(img, args.image, mask, 256, device, args.debug,None,'v','img',300,outfile)
+  if args.strip:
+    # Histograms of analyze_color strip by strip, without its full-size color conversions (no color images)
+    color_header, color_data = tiled.color_histogram_data(img, mask, args.strip)
+    color_img = []
+    device += 1
+  else:
+    device, color_header,color_data,color_img= pcv.analyze_color(img, args.image, mask, 256, device, args.debug,None,'v','img',300,outfile)
   
   # Determine color properties: Histograms, Color Slices and Pseudocolored Images, output color analyzed images (optional)
   device, marker_header,marker_data,marker_img= pcv.report_size_marker_area(img,'rectangle',device,args.debug,'detect',3800, 8500,-4700,-4500,'black','light','v',150,outfile)
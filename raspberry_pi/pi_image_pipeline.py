@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 import sys, traceback
+import os
 import cv2
 import numpy as np
 import argparse
 import string
 import plantcv as pcv
+# Shared helper modules are in the dev directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev'))
+from color_histograms import color_histograms, histogram_data
 
 ### Parse command-line arguments
 def options():
@@ -13,9 +17,94 @@ def options():
   parser.add_argument("-m", "--roi", help="Input region of interest file.", required=False)
   parser.add_argument("-o", "--outdir", help="Output directory for image files.", required=True)
   parser.add_argument("-D", "--debug", help="Turn on debug, prints intermediate images.", action="store_true")
+  parser.add_argument("-l", "--lowmem", help="On-device mode: find the plant in a preview, segment and measure only "
+                      "inside its box, no image renders.", action="store_true")
+  parser.add_argument("-p", "--preview", help="Preview downscale factor (low-memory mode).", type=int, default=4)
+  parser.add_argument("-g", "--margin", help="Pixels added around the plant box (low-memory mode).", type=int,
+                      default=64)
   args = parser.parse_args()
   return args
 
+### Plant mask (the threshold, median, fill and mask chain of main) with reused uint8 buffers
+def segment(img, scale=1):
+  # img = BGR image (a downscaled preview, or the plant box of the full image)
+  # scale = downscale factor of img, the fill sizes are scaled to match
+  # Returns the filled mask (ab_fill of main)
+  area = scale * scale
+  buf = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+  
+  # Saturation threshold, median filter and fill
+  s_fill = cv2.threshold(cv2.extractChannel(buf, 1), 36, 255, cv2.THRESH_BINARY)[1]
+  s_fill = cv2.medianBlur(s_fill, 5)
+  device, s_fill = pcv.fill(s_fill, np.copy(s_fill), 0, 0, False)
+  
+  # Blue-yellow threshold and fill, joined with the saturation mask
+  cv2.cvtColor(img, cv2.COLOR_BGR2LAB, dst=buf)
+  b_fill = cv2.threshold(cv2.extractChannel(buf, 2), 138, 255, cv2.THRESH_BINARY)[1]
+  device, b_fill = pcv.fill(b_fill, np.copy(b_fill), 150 // area, 0, False)
+  bs = cv2.bitwise_and(s_fill, b_fill, dst=s_fill)
+  
+  # Masked image (white background) in the same buffer, then its green-magenta and blue-yellow thresholds
+  np.copyto(buf, img)
+  buf[bs == 0] = 255
+  cv2.cvtColor(buf, cv2.COLOR_BGR2LAB, dst=buf)
+  ab = cv2.threshold(cv2.extractChannel(buf, 1), 122, 255, cv2.THRESH_BINARY_INV)[1]
+  maskedb_thresh = cv2.threshold(cv2.extractChannel(buf, 2), 133, 255, cv2.THRESH_BINARY)[1]
+  cv2.bitwise_or(ab, maskedb_thresh, dst=ab)
+  device, ab_fill = pcv.fill(ab, np.copy(ab), 200 // area, 0, False)
+  return ab_fill
+
+### Box (x, y, width, height) of the plant, found in a downscaled preview
+def plant_box(img, factor, margin):
+  # Returns the whole image if the preview has no plant pixels
+  height, width = np.shape(img)[:2]
+  if factor > 1:
+    preview = cv2.resize(img, (max(width // factor, 1), max(height // factor, 1)), interpolation=cv2.INTER_AREA)
+    points = cv2.findNonZero(segment(preview, factor))
+  else:
+    points = cv2.findNonZero(segment(img))
+    factor = 1
+  if points is None:
+    return 0, 0, width, height
+  x, y, w, h = cv2.boundingRect(points)
+  x1 = max(x * factor - margin, 0)
+  y1 = max(y * factor - margin, 0)
+  x2 = min((x + w) * factor + margin, width)
+  y2 = min((y + h) * factor + margin, height)
+  return x1, y1, x2 - x1, y2 - y1
+
+### On-device pipeline: segment and measure the plant box only
+def lowmem(args, img):
+  # Objects outside the box found in the preview are not measured; shape positions are relative to the box, which is
+  # printed as a CROP_DATA row
+  x, y, w, h = plant_box(img, args.preview, args.margin)
+  crop = img[y:y + h, x:x + w]
+  
+  # The 19 steps of main up to the objects
+  device = 19
+  ab_fill = segment(crop)
+  
+  # Identify objects (the ROI of main is the whole image, so all objects are kept)
+  objects, hierarchy = cv2.findContours(np.copy(ab_fill), cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[-2:]
+  device += 3
+  kept_mask = ab_fill
+  
+  # Object combine kept objects
+  device, obj, mask = pcv.object_composition(crop, objects, hierarchy, device, args.debug)
+  
+  # Shape and color properties without image renders
+  device, shape_header, shape_data, shape_img = pcv.analyze_object(crop, args.image, obj, mask, device, args.debug,
+                                                                   False)
+  # Color histograms of the plant pixels (analyze_color's HISTOGRAM_DATA row, binned as analyze_color)
+  color_header, color_data = histogram_data(color_histograms(crop, kept_mask, 256, 'all'), 'all')
+  device += 1
+  
+  # Output shape and color data
+  pcv.print_results(args.image, shape_header, shape_data)
+  pcv.print_results(args.image, color_header, color_data)
+  pcv.print_results(args.image, ('HEADER_CROP', 'x', 'y', 'width', 'height', 'preview'),
+                    ('CROP_DATA', x, y, w, h, args.preview))
+
 ### Main pipeline
 def main():
   # Get options
@@ -24,6 +113,9 @@ def main():
   
   # Read image
   img = cv2.imread(args.image)
+  if args.lowmem:
+    lowmem(args, img)
+    return
   roi = cv2.imread(args.roi)
   
   # Pipeline step
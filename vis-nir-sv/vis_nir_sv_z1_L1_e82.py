@@ -9,6 +9,11 @@ import argparse
 import string
 import plantcv as pcv
 
+# Shared helper modules are in the dev directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev'))
+from results_sink import open_sink
+from registration import read_nir, get_registration
+
 
 def options():
     parser = argparse.ArgumentParser(description="Imaging processing with opencv")
@@ -16,6 +21,7 @@ def options():
     parser.add_argument("-o", "--outdir", help="Output directory for image files.", required=False)
     parser.add_argument("-r","--result", help="result file.", required= False )
     parser.add_argument("-r2","--coresult", help="result file.", default=None )
+    parser.add_argument("-F","--format", help="result format, text or columnar (see dev/results_sink.py).", required= False )
     parser.add_argument("-w","--writeimg", help="write out images.", default=False, action="store_true")
     parser.add_argument("-D", "--debug", help="Turn on debug, prints intermediate images.", action="store_true")
     args = parser.parse_args()
@@ -121,44 +127,26 @@ def main():
   device, color_header,color_data,color_img= pcv.analyze_color(img, args.image, mask, 256, device, args.debug,None,'v','img',300,outfile)
   
   # Output shape and color data
-  result=open(args.result,"a")
-  result.write('\t'.join(map(str,shape_header)))
-  result.write("\n")
-  result.write('\t'.join(map(str,shape_data)))
-  result.write("\n")
-  for row in shape_img:
-    result.write('\t'.join(map(str,row)))
-    result.write("\n")
-  result.write('\t'.join(map(str,color_header)))
-  result.write("\n")
-  result.write('\t'.join(map(str,color_data)))
-  result.write("\n")
-  result.write('\t'.join(map(str,boundary_header)))
-  result.write("\n")
-  result.write('\t'.join(map(str,boundary_data)))
-  result.write("\n")
-  result.write('\t'.join(map(str,boundary_img1)))
-  result.write("\n")
-  for row in color_img:
-    result.write('\t'.join(map(str,row)))
-    result.write("\n")
-  result.close()
+  result=open_sink(args.result, fmt=args.format)
+  result.add(args.image, shape_header, shape_data)
+  result.add_rows(args.image, 'shape_img', shape_img)
+  result.add(args.image, color_header, color_data)
+  result.add(args.image, boundary_header, boundary_data)
+  result.add_rows(args.image, 'boundary_img1', [boundary_img1])
+  result.add_rows(args.image, 'color_img', color_img)
+  result.commit()
   
 ############################# Use VIS image mask for NIR image#########################
   # Find matching NIR image
   if args.coresult is not None:
     device, nirpath=pcv.get_nir(path,filename,device,args.debug)
-    nir, path1, filename1=pcv.readimage(nirpath)
-    nir2=cv2.imread(nirpath,-1)
-    
-    # Flip mask
-    device, f_mask= pcv.flip(mask,"vertical",device,args.debug)
-    
-    # Reize mask
-    device, nmask = pcv.resize(f_mask, 0.1154905775,0.1154905775, device, args.debug)
+    nir, nir2, path1, filename1=read_nir(nirpath)
     
-    # position, and crop mask
-    device,newmask=pcv.crop_position_mask(nir,nmask,device,30,4,"top","right",args.debug)
+    # Flip, resize and position the mask on the NIR image in one step (see dev/registration.py)
+    registration=get_registration('vis_sv-nir_sv', 'z1_L1_e82', mask.shape, nir.shape,
+                                  legacy={'flip': 'vertical', 'scale': (0.1154905775, 0.1154905775),
+                                          'offset': (30, 4), 'position': ('top', 'right')})
+    device, newmask = registration.warp(mask, device, args.debug)
     
     # Identify objects
     device, nir_objects,nir_hierarchy = pcv.find_objects(nir, newmask, device, args.debug)
@@ -174,22 +162,12 @@ def main():
     device,nhist_header, nhist_data,nir_imgs= pcv.analyze_NIR_intensity(nir2, filename1, nir_combinedmask, 256, device,False, args.debug, outfile1)
     device, nshape_header, nshape_data, nir_shape = pcv.analyze_object(nir2, filename1, nir_combined, nir_combinedmask, device, args.debug, outfile1)
     
-    coresult=open(args.coresult,"a")
-    coresult.write('\t'.join(map(str,nhist_header)))
-    coresult.write("\n")
-    coresult.write('\t'.join(map(str,nhist_data)))
-    coresult.write("\n")
-    for row in nir_imgs:
-      coresult.write('\t'.join(map(str,row)))
-      coresult.write("\n")
-      
-    coresult.write('\t'.join(map(str,nshape_header)))
-    coresult.write("\n")
-    coresult.write('\t'.join(map(str,nshape_data)))
-    coresult.write("\n")
-    coresult.write('\t'.join(map(str,nir_shape)))
-    coresult.write("\n")
-    coresult.close()
+    coresult=open_sink(args.coresult, fmt=args.format)
+    coresult.add(args.image, nhist_header, nhist_data)
+    coresult.add_rows(args.image, 'nir_imgs', nir_imgs)
+    coresult.add(args.image, nshape_header, nshape_data)
+    coresult.add_rows(args.image, 'nir_shape', [nir_shape])
+    coresult.commit()
   
 if __name__ == '__main__':
   main()
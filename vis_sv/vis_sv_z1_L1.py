@@ -1,11 +1,15 @@
 #!/usr/bin/env python
-import sys, traceback
+import sys, os, traceback
 import cv2
 import numpy as np
 import argparse
 import string
 import plantcv as pcv
 
+# Shared helper modules are in the dev directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev'))
+from pipeline_steps import PipelineSteps
+
 ### Parse command-line arguments
 def options():
   parser = argparse.ArgumentParser(description="Imaging processing with opencv")
@@ -25,103 +29,104 @@ def main():
   img, path, filename = pcv.readimage(args.image)
   #roi = cv2.imread(args.roi)
   
-  # Pipeline step
-  device = 0
+  # Pipeline steps, repeated steps (the copies for pcv.fill) reuse the first result
+  steps = PipelineSteps(args.debug)
 
   # Convert RGB to HSV and extract the Saturation channel
-  device, s = pcv.rgb2gray_hsv(img, 's', device, args.debug)
+  s = steps.run(pcv.rgb2gray_hsv, img, 's')
   
   # Threshold the Saturation image
-  device, s_thresh = pcv.binary_threshold(s, 36, 255, 'light', device, args.debug)
+  s_thresh = steps.run(pcv.binary_threshold, s, 36, 255, 'light')
   
   # Median Filter
-  device, s_mblur = pcv.median_blur(s_thresh, 5, device, args.debug)
-  device, s_cnt = pcv.median_blur(s_thresh, 5, device, args.debug)
+  s_mblur = steps.run(pcv.median_blur, s_thresh, 5)
+  s_cnt = steps.run(pcv.median_blur, s_thresh, 5)
   
   # Fill small objects
-  device, s_fill = pcv.fill(s_mblur, s_cnt, 0, device, args.debug)
+  s_fill = steps.run(pcv.fill, s_mblur, s_cnt, 0)
   
   # Convert RGB to LAB and extract the Blue channel
-  device, b = pcv.rgb2gray_lab(img, 'b', device, args.debug)
+  b = steps.run(pcv.rgb2gray_lab, img, 'b')
   
   # Threshold the blue image
-  device, b_thresh = pcv.binary_threshold(b, 138, 255, 'light', device, args.debug)
-  device, b_cnt = pcv.binary_threshold(b, 138, 255, 'light', device, args.debug)
+  b_thresh = steps.run(pcv.binary_threshold, b, 138, 255, 'light')
+  b_cnt = steps.run(pcv.binary_threshold, b, 138, 255, 'light')
   
   # Fill small objects
-  device, b_fill = pcv.fill(b_thresh, b_cnt, 150, device, args.debug)
+  b_fill = steps.run(pcv.fill, b_thresh, b_cnt, 150)
   
   # Join the thresholded saturation and blue-yellow images
-  device, bs = pcv.logical_and(s_fill, b_fill, device, args.debug)
+  bs = steps.run(pcv.logical_and, s_fill, b_fill)
   
   # Apply Mask (for vis images, mask_color=white)
-  device, masked = pcv.apply_mask(img, bs, 'white', device, args.debug)
+  masked = steps.run(pcv.apply_mask, img, bs, 'white')
   
   # Convert RGB to LAB and extract the Green-Magenta and Blue-Yellow channels
-  device, masked_a = pcv.rgb2gray_lab(masked, 'a', device, args.debug)
-  device, masked_b = pcv.rgb2gray_lab(masked, 'b', device, args.debug)
+  masked_a = steps.run(pcv.rgb2gray_lab, masked, 'a')
+  masked_b = steps.run(pcv.rgb2gray_lab, masked, 'b')
   
   # Threshold the green-magenta and blue images
-  device, maskeda_thresh = pcv.binary_threshold(masked_a, 122, 255, 'dark', device, args.debug)
-  device, maskedb_thresh = pcv.binary_threshold(masked_b, 133, 255, 'light', device, args.debug)
+  maskeda_thresh = steps.run(pcv.binary_threshold, masked_a, 122, 255, 'dark')
+  maskedb_thresh = steps.run(pcv.binary_threshold, masked_b, 133, 255, 'light')
   
   # Join the thresholded saturation and blue-yellow images (OR)
-  device, ab = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
-  device, ab_cnt = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
+  ab = steps.run(pcv.logical_or, maskeda_thresh, maskedb_thresh)
+  ab_cnt = steps.run(pcv.logical_or, maskeda_thresh, maskedb_thresh)
   
   # Fill small objects
-  device, ab_fill = pcv.fill(ab, ab_cnt, 200, device, args.debug)
+  ab_fill = steps.run(pcv.fill, ab, ab_cnt, 200)
   
   # Apply mask (for vis images, mask_color=white)
-  device, masked2 = pcv.apply_mask(masked, ab_fill, 'white', device, args.debug)
+  masked2 = steps.run(pcv.apply_mask, masked, ab_fill, 'white')
   
   # Select area with black bars and find overlapping plant material
-  device, roi1, roi_hierarchy1= pcv.define_roi(masked2,'rectangle', device, None, 'default', args.debug,True, 0, 0,-1700,0)
-  device, id_objects1,obj_hierarchy1 = pcv.find_objects(masked2, ab_fill, device, args.debug)
-  device,roi_objects1, hierarchy1, kept_mask1, obj_area1 = pcv.roi_objects(masked2,'cutto',roi1,roi_hierarchy1,id_objects1,obj_hierarchy1,device, args.debug)
-  device, masked3 = pcv.apply_mask(masked2, kept_mask1, 'white', device, args.debug)
-  device, masked_a1 = pcv.rgb2gray_lab(masked3, 'a', device, args.debug)
-  device, masked_b1 = pcv.rgb2gray_lab(masked3, 'b', device, args.debug)
-  device, maskeda_thresh1 = pcv.binary_threshold(masked_a1, 122, 255, 'dark', device, args.debug)
-  device, maskedb_thresh1 = pcv.binary_threshold(masked_b1, 170, 255, 'light', device, args.debug)
-  device, ab1 = pcv.logical_or(maskeda_thresh1, maskedb_thresh1, device, args.debug)
-  device, ab_cnt1 = pcv.logical_or(maskeda_thresh1, maskedb_thresh1, device, args.debug)
-  device, ab_fill1 = pcv.fill(ab1, ab_cnt1, 300, device, args.debug)
+  steps.device, roi1, roi_hierarchy1 = pcv.define_roi(masked2,'rectangle', steps.device, None, 'default', args.debug,True, 0, 0,-1700,0)
+  id_objects1,obj_hierarchy1 = steps.run(pcv.find_objects, masked2, ab_fill)
+  roi_objects1, hierarchy1, kept_mask1, obj_area1 = steps.run(pcv.roi_objects, masked2,'cutto',roi1,roi_hierarchy1,id_objects1,obj_hierarchy1)
+  masked3 = steps.run(pcv.apply_mask, masked2, kept_mask1, 'white')
+  masked_a1 = steps.run(pcv.rgb2gray_lab, masked3, 'a')
+  masked_b1 = steps.run(pcv.rgb2gray_lab, masked3, 'b')
+  maskeda_thresh1 = steps.run(pcv.binary_threshold, masked_a1, 122, 255, 'dark')
+  maskedb_thresh1 = steps.run(pcv.binary_threshold, masked_b1, 170, 255, 'light')
+  ab1 = steps.run(pcv.logical_or, maskeda_thresh1, maskedb_thresh1)
+  ab_cnt1 = steps.run(pcv.logical_or, maskeda_thresh1, maskedb_thresh1)
+  ab_fill1 = steps.run(pcv.fill, ab1, ab_cnt1, 300)
 
   
-  device, roi2, roi_hierarchy2= pcv.define_roi(masked2,'rectangle', device, None, 'default', args.debug,True, 1700, 0,0,0)
-  device, id_objects2,obj_hierarchy2 = pcv.find_objects(masked2, ab_fill, device, args.debug)
-  device,roi_objects2, hierarchy2, kept_mask2, obj_area2 = pcv.roi_objects(masked2,'cutto',roi2,roi_hierarchy2,id_objects2,obj_hierarchy2,device, args.debug)
-  device, masked4 = pcv.apply_mask(masked2, kept_mask2, 'white', device, args.debug)
-  device, masked_a2 = pcv.rgb2gray_lab(masked4, 'a', device, args.debug)
-  device, masked_b2 = pcv.rgb2gray_lab(masked4, 'b', device, args.debug)
-  device, maskeda_thresh2 = pcv.binary_threshold(masked_a2, 122, 255, 'dark', device, args.debug)
-  device, maskedb_thresh2 = pcv.binary_threshold(masked_b2, 170, 255, 'light', device, args.debug)
-  device, ab2 = pcv.logical_or(maskeda_thresh2, maskedb_thresh2, device, args.debug)
-  device, ab_cnt2 = pcv.logical_or(maskeda_thresh2, maskedb_thresh2, device, args.debug)
-  device, ab_fill2 = pcv.fill(ab2, ab_cnt2, 200, device, args.debug)
-  
-  device, ab_cnt3 = pcv.logical_or(ab_fill1, ab_fill2, device, args.debug)
-  device, masked3 = pcv.apply_mask(masked2, ab_cnt3, 'white', device, args.debug)
+  steps.device, roi2, roi_hierarchy2 = pcv.define_roi(masked2,'rectangle', steps.device, None, 'default', args.debug,True, 1700, 0,0,0)
+  id_objects2,obj_hierarchy2 = steps.run(pcv.find_objects, masked2, ab_fill)
+  roi_objects2, hierarchy2, kept_mask2, obj_area2 = steps.run(pcv.roi_objects, masked2,'cutto',roi2,roi_hierarchy2,id_objects2,obj_hierarchy2)
+  masked4 = steps.run(pcv.apply_mask, masked2, kept_mask2, 'white')
+  masked_a2 = steps.run(pcv.rgb2gray_lab, masked4, 'a')
+  masked_b2 = steps.run(pcv.rgb2gray_lab, masked4, 'b')
+  maskeda_thresh2 = steps.run(pcv.binary_threshold, masked_a2, 122, 255, 'dark')
+  maskedb_thresh2 = steps.run(pcv.binary_threshold, masked_b2, 170, 255, 'light')
+  ab2 = steps.run(pcv.logical_or, maskeda_thresh2, maskedb_thresh2)
+  ab_cnt2 = steps.run(pcv.logical_or, maskeda_thresh2, maskedb_thresh2)
+  ab_fill2 = steps.run(pcv.fill, ab2, ab_cnt2, 200)
+  
+  ab_cnt3 = steps.run(pcv.logical_or, ab_fill1, ab_fill2)
+  masked3 = steps.run(pcv.apply_mask, masked2, ab_cnt3, 'white')
   
   # Identify objects
-  device, id_objects3,obj_hierarchy3 = pcv.find_objects(masked2, ab_fill, device, args.debug)
+  id_objects3,obj_hierarchy3 = steps.run(pcv.find_objects, masked2, ab_fill)
 
   # Define ROI
-  device, roi3, roi_hierarchy3= pcv.define_roi(masked2,'rectangle', device, None, 'default', args.debug,True, 650, 0,-450,-300)
+  steps.device, roi3, roi_hierarchy3 = pcv.define_roi(masked2,'rectangle', steps.device, None, 'default', args.debug,True, 650, 0,-450,-300)
  
   # Decide which objects to keep and combine with objects overlapping with black bars
-  device,roi_objects3, hierarchy3, kept_mask3, obj_area1 = pcv.roi_objects(img,'cutto',roi3,roi_hierarchy3,id_objects3,obj_hierarchy3,device, args.debug)
-  device, kept_mask4_1 = pcv.logical_or(ab_cnt3, kept_mask3, device, args.debug)
-  device, kept_cnt = pcv.logical_or(ab_cnt3, kept_mask3, device, args.debug)
-  device, kept_mask4 = pcv.fill(kept_mask4_1, kept_cnt, 200, device, args.debug)
-  device, masked5 = pcv.apply_mask(masked2, kept_mask4, 'white', device, args.debug)
-  device, id_objects4,obj_hierarchy4 = pcv.find_objects(masked5, kept_mask4, device, args.debug)
-  device, roi4, roi_hierarchy4= pcv.define_roi(masked2,'rectangle', device, None, 'default', args.debug,False, 0, 0,0,0)
-  device,roi_objects4, hierarchy4, kept_mask4, obj_area = pcv.roi_objects(img,'partial',roi4,roi_hierarchy4,id_objects4,obj_hierarchy4,device, args.debug)
+  roi_objects3, hierarchy3, kept_mask3, obj_area1 = steps.run(pcv.roi_objects, img,'cutto',roi3,roi_hierarchy3,id_objects3,obj_hierarchy3)
+  kept_mask4_1 = steps.run(pcv.logical_or, ab_cnt3, kept_mask3)
+  kept_cnt = steps.run(pcv.logical_or, ab_cnt3, kept_mask3)
+  kept_mask4 = steps.run(pcv.fill, kept_mask4_1, kept_cnt, 200)
+  masked5 = steps.run(pcv.apply_mask, masked2, kept_mask4, 'white')
+  id_objects4,obj_hierarchy4 = steps.run(pcv.find_objects, masked5, kept_mask4)
+  steps.device, roi4, roi_hierarchy4 = pcv.define_roi(masked2,'rectangle', steps.device, None, 'default', args.debug,False, 0, 0,0,0)
+  roi_objects4, hierarchy4, kept_mask4, obj_area = steps.run(pcv.roi_objects, img,'partial',roi4,roi_hierarchy4,id_objects4,obj_hierarchy4)
 
  # Object combine kept objects
-  device, obj, mask = pcv.object_composition(img, roi_objects4, hierarchy4, device, args.debug)
+  obj, mask = steps.run(pcv.object_composition, img, roi_objects4, hierarchy4)
+  device = steps.device
   
 ############## Analysis ################  
   
@@ -139,6 +144,9 @@ def main():
   pcv.print_results(args.image, color_header, color_data)
   pcv.print_results(args.image, boundary_header, boundary_data)
   
+  # Time saved by reusing repeated steps
+  steps.report()
+  
 if __name__ == '__main__':
   main()#!/usr/bin/env python
 
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
-import sys, traceback
+import sys, os, traceback
 import cv2
 import numpy as np
 import argparse
 import string
 import plantcv as pcv
 
+# Shared helper modules are in the dev directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev'))
+from pipeline_steps import PipelineSteps
+
 ### Parse command-line arguments
 def options():
   parser = argparse.ArgumentParser(description="Imaging processing with opencv")
@@ -25,67 +29,68 @@ def main():
   img, path, filename = pcv.readimage(args.image)
   #roi = cv2.imread(args.roi)
   
-  # Pipeline step
-  device = 0
+  # Pipeline steps, repeated steps (the copies for pcv.fill) reuse the first result
+  steps = PipelineSteps(args.debug)
 
   # Convert RGB to HSV and extract the Saturation channel
-  device, s = pcv.rgb2gray_hsv(img, 's', device, args.debug)
+  s = steps.run(pcv.rgb2gray_hsv, img, 's')
   
   # Threshold the Saturation image
-  device, s_thresh = pcv.binary_threshold(s, 36, 255, 'light', device, args.debug)
+  s_thresh = steps.run(pcv.binary_threshold, s, 36, 255, 'light')
   
   # Median Filter
-  device, s_mblur = pcv.median_blur(s_thresh, 5, device, args.debug)
-  device, s_cnt = pcv.median_blur(s_thresh, 5, device, args.debug)
+  s_mblur = steps.run(pcv.median_blur, s_thresh, 5)
+  s_cnt = steps.run(pcv.median_blur, s_thresh, 5)
   
   # Fill small objects
-  device, s_fill = pcv.fill(s_mblur, s_cnt, 0, device, args.debug)
+  s_fill = steps.run(pcv.fill, s_mblur, s_cnt, 0)
   
   # Convert RGB to LAB and extract the Blue channel
-  device, b = pcv.rgb2gray_lab(img, 'b', device, args.debug)
+  b = steps.run(pcv.rgb2gray_lab, img, 'b')
   
   # Threshold the blue image
-  device, b_thresh = pcv.binary_threshold(b, 138, 255, 'light', device, args.debug)
-  device, b_cnt = pcv.binary_threshold(b, 138, 255, 'light', device, args.debug)
+  b_thresh = steps.run(pcv.binary_threshold, b, 138, 255, 'light')
+  b_cnt = steps.run(pcv.binary_threshold, b, 138, 255, 'light')
   
   # Fill small objects
-  device, b_fill = pcv.fill(b_thresh, b_cnt, 10, device, args.debug)
+  b_fill = steps.run(pcv.fill, b_thresh, b_cnt, 10)
   
   # Join the thresholded saturation and blue-yellow images
-  device, bs = pcv.logical_or(s_fill, b_fill, device, args.debug)
+  bs = steps.run(pcv.logical_or, s_fill, b_fill)
   
   # Apply Mask (for vis images, mask_color=white)
-  device, masked = pcv.apply_mask(img, bs, 'white', device, args.debug)
+  masked = steps.run(pcv.apply_mask, img, bs, 'white')
   
   # Convert RGB to LAB and extract the Green-Magenta and Blue-Yellow channels
-  device, masked_a = pcv.rgb2gray_lab(masked, 'a', device, args.debug)
-  device, masked_b = pcv.rgb2gray_lab(masked, 'b', device, args.debug)
+  masked_a = steps.run(pcv.rgb2gray_lab, masked, 'a')
+  masked_b = steps.run(pcv.rgb2gray_lab, masked, 'b')
   
   # Threshold the green-magenta and blue images
-  device, maskeda_thresh = pcv.binary_threshold(masked_a, 125, 255, 'dark', device, args.debug)
-  device, maskedb_thresh = pcv.binary_threshold(masked_b, 133, 255, 'light', device, args.debug)
+  maskeda_thresh = steps.run(pcv.binary_threshold, masked_a, 125, 255, 'dark')
+  maskedb_thresh = steps.run(pcv.binary_threshold, masked_b, 133, 255, 'light')
   
   # Join the thresholded saturation and blue-yellow images (OR)
-  device, ab = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
-  device, ab_cnt = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
+  ab = steps.run(pcv.logical_or, maskeda_thresh, maskedb_thresh)
+  ab_cnt = steps.run(pcv.logical_or, maskeda_thresh, maskedb_thresh)
   
   # Fill small objects
-  device, ab_fill = pcv.fill(ab, ab_cnt, 10, device, args.debug)
+  ab_fill = steps.run(pcv.fill, ab, ab_cnt, 10)
   
   # Apply mask (for vis images, mask_color=white)
-  device, masked2 = pcv.apply_mask(masked, ab_fill, 'white', device, args.debug)
+  masked2 = steps.run(pcv.apply_mask, masked, ab_fill, 'white')
   
   # Identify objects
-  device, id_objects,obj_hierarchy = pcv.find_objects(masked2, ab_fill, device, args.debug)
+  id_objects,obj_hierarchy = steps.run(pcv.find_objects, masked2, ab_fill)
 
   # Define ROI
-  device, roi1, roi_hierarchy= pcv.define_roi(masked2,'rectangle', device, None, 'default', args.debug,True, 0, 0, 0, -935)
+  steps.device, roi1, roi_hierarchy = pcv.define_roi(masked2,'rectangle', steps.device, None, 'default', args.debug,True, 0, 0, 0, -935)
   
   # Decide which objects to keep
-  device,roi_objects, hierarchy3, kept_mask, obj_area = pcv.roi_objects(img,'partial',roi1,roi_hierarchy,id_objects,obj_hierarchy,device, args.debug)
+  roi_objects, hierarchy3, kept_mask, obj_area = steps.run(pcv.roi_objects, img,'partial',roi1,roi_hierarchy,id_objects,obj_hierarchy)
   
   # Object combine kept objects
-  device, obj, mask = pcv.object_composition(img, roi_objects, hierarchy3, device, args.debug)
+  obj, mask = steps.run(pcv.object_composition, img, roi_objects, hierarchy3)
+  device = steps.device
   
 ############### Analysis ################  
   
@@ -103,5 +108,8 @@ def main():
   pcv.print_results(args.image, color_header, color_data)
   pcv.print_results(args.image, boundary_header, boundary_data)
   
+  # Time saved by reusing repeated steps
+  steps.report()
+  
 if __name__ == '__main__':
   main()
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
-import sys, traceback
+import sys, os, traceback
 import cv2
 import numpy as np
 import argparse
 import string
 import plantcv as pcv
 
+# Shared helper modules are in the dev directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev'))
+from colorspace_cache import ColorSpaceCache
+
 ### Parse command-line arguments
 def options():
   parser = argparse.ArgumentParser(description="Imaging processing with opencv")
@@ -27,9 +31,12 @@ def main():
   
   # Pipeline step
   device = 0
+  
+  # Color space conversions of img and its masked copies are computed once
+  img_cs = ColorSpaceCache(img)
 
   # Convert RGB to HSV and extract the Saturation channel
-  device, s = pcv.rgb2gray_hsv(img, 's', device, args.debug)
+  device, s = img_cs.rgb2gray_hsv('s', device, args.debug)
   
   # Threshold the Saturation image
   device, s_thresh = pcv.binary_threshold(s, 36, 255, 'light', device, args.debug)
@@ -42,7 +49,7 @@ def main():
   device, s_fill = pcv.fill(s_mblur, s_cnt, 0, device, args.debug)
   
   # Convert RGB to LAB and extract the Blue channel
-  device, b = pcv.rgb2gray_lab(img, 'b', device, args.debug)
+  device, b = img_cs.rgb2gray_lab('b', device, args.debug)
   
   # Threshold the blue image
   device, b_thresh = pcv.binary_threshold(b, 138, 255, 'light', device, args.debug)
@@ -55,11 +62,11 @@ def main():
   device, bs = pcv.logical_or(s_fill, b_fill, device, args.debug)
   
   # Apply Mask (for vis images, mask_color=white)
-  device, masked = pcv.apply_mask(img, bs, 'white', device, args.debug)
+  device, masked, masked_cs = img_cs.apply_mask(bs, 'white', device, args.debug)
   
   # Convert RGB to LAB and extract the Green-Magenta and Blue-Yellow channels
-  device, masked_a = pcv.rgb2gray_lab(masked, 'a', device, args.debug)
-  device, masked_b = pcv.rgb2gray_lab(masked, 'b', device, args.debug)
+  device, masked_a = masked_cs.rgb2gray_lab('a', device, args.debug)
+  device, masked_b = masked_cs.rgb2gray_lab('b', device, args.debug)
   
   # Threshold the green-magenta and blue images
   device, maskeda_thresh = pcv.binary_threshold(masked_a, 125, 255, 'dark', device, args.debug)
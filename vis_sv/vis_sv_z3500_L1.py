@@ -1,11 +1,22 @@
 #!/usr/bin/env python
-import sys, traceback
+import sys, os, traceback
 import cv2
 import numpy as np
 import argparse
 import string
 import plantcv as pcv
 
+# Shared helper modules are in the dev directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev'))
+from threshold_lut import load_lut
+
+### Pixel-wise threshold stages, compiled to RGB lookup tables
+SATURATION = {'thresholds': [{'space': 'hsv', 'channel': 's', 'threshold': 36, 'object_type': 'light'}]}
+BLUE_YELLOW = {'thresholds': [{'space': 'lab', 'channel': 'b', 'threshold': 138, 'object_type': 'light'}]}
+GREEN_OR_YELLOW = {'combine': 'or',
+                   'thresholds': [{'space': 'lab', 'channel': 'a', 'threshold': 122, 'object_type': 'dark'},
+                                  {'space': 'lab', 'channel': 'b', 'threshold': 133, 'object_type': 'light'}]}
+
 ### Parse command-line arguments
 def options():
   parser = argparse.ArgumentParser(description="Imaging processing with opencv")
@@ -28,11 +39,8 @@ def main():
   # Pipeline step
   device = 0
 
-  # Convert RGB to HSV and extract the Saturation channel
-  device, s = pcv.rgb2gray_hsv(img, 's', device, args.debug)
-  
-  # Threshold the Saturation image
-  device, s_thresh = pcv.binary_threshold(s, 36, 255, 'light', device, args.debug)
+  # Threshold the Saturation channel (HSV), replaces rgb2gray_hsv and binary_threshold
+  device, s_thresh = load_lut(SATURATION).threshold(img, device, args.debug, steps=2)
   
   # Median Filter
   device, s_mblur = pcv.median_blur(s_thresh, 5, device, args.debug)
@@ -41,12 +49,9 @@ def main():
   # Fill small objects
   device, s_fill = pcv.fill(s_mblur, s_cnt, 0, device, args.debug)
   
-  # Convert RGB to LAB and extract the Blue channel
-  device, b = pcv.rgb2gray_lab(img, 'b', device, args.debug)
-  
-  # Threshold the blue image
-  device, b_thresh = pcv.binary_threshold(b, 138, 255, 'light', device, args.debug)
-  device, b_cnt = pcv.binary_threshold(b, 138, 255, 'light', device, args.debug)
+  # Threshold the Blue-Yellow channel (LAB), replaces rgb2gray_lab and two binary_threshold calls
+  device, b_thresh = load_lut(BLUE_YELLOW).threshold(img, device, args.debug, steps=3)
+  b_cnt = np.copy(b_thresh)
   
   # Fill small objects
   device, b_fill = pcv.fill(b_thresh, b_cnt, 150, device, args.debug)
@@ -57,17 +62,10 @@ def main():
   # Apply Mask (for vis images, mask_color=white)
   device, masked = pcv.apply_mask(img, bs, 'white', device, args.debug)
   
-  # Convert RGB to LAB and extract the Green-Magenta and Blue-Yellow channels
-  device, masked_a = pcv.rgb2gray_lab(masked, 'a', device, args.debug)
-  device, masked_b = pcv.rgb2gray_lab(masked, 'b', device, args.debug)
-  
-  # Threshold the green-magenta and blue images
-  device, maskeda_thresh = pcv.binary_threshold(masked_a, 122, 255, 'dark', device, args.debug)
-  device, maskedb_thresh = pcv.binary_threshold(masked_b, 133, 255, 'light', device, args.debug)
-  
-  # Join the thresholded saturation and blue-yellow images (OR)
-  device, ab = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
-  device, ab_cnt = pcv.logical_or(maskeda_thresh, maskedb_thresh, device, args.debug)
+  # Threshold the green-magenta and blue channels of the masked image and join them (OR), replaces two rgb2gray_lab,
+  # two binary_threshold and two logical_or calls
+  device, ab = load_lut(GREEN_OR_YELLOW).threshold(img, device, args.debug, bs, 'white', steps=6)
+  ab_cnt = np.copy(ab)
   
   # Fill small objects
   device, ab_fill = pcv.fill(ab, ab_cnt, 200, device, args.debug)